@@ -3,7 +3,10 @@ if __name__ == "__main__":
 
     os.environ["FLASK_ENV"] = "dev"
     from src import create_app
+    from src.migrations import migrate
+    from src.utils import engine
 
     app = create_app()
-    # from src import populate_db # uncomment this to populate the database
+    migrate(engine, log=print)
+    # python -m src.populate_db --help, to populate the database
     app.run(debug=True)
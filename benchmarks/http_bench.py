@@ -0,0 +1,359 @@
+"""
+Drive concurrent request mixes through the app and record throughput and latency percentiles.
+
+The app comes from `create_app` with the prod config, on a copy of a SQLite file filled by
+`src.populate_db`. The file is kept between runs (see `--db`), so a large dataset is only
+generated once, and every run starts from the same rows. Pass `--regenerate` after schema
+changes. Each worker thread has its own test client, so the numbers cover the app and the
+database but not a WSGI server or the network.
+
+Results are written as JSON. Pass an earlier result to `--compare` to print the change per
+route, the run fails when a p99 grew by more than `--max-regression`.
+
+Usage:
+    python -m benchmarks.http_bench --mix all --requests 5000 --concurrency 8 \\
+        --output baseline.json [--compare previous.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from random import Random
+from types import SimpleNamespace
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Dataset:
+    """Ids and tokens the operations draw from, shared by every worker."""
+
+    def __init__(self, conn, app, desk_users: int, seed):
+        from flask_jwt_extended import create_access_token
+        from sqlalchemy import text
+
+        from src.utils import hash_password
+
+        self.rng = Random(seed)
+        self.lock = threading.Lock()
+        scalars = lambda sql: conn.execute(text(sql)).scalars().all()  # noqa: E731
+        self.book_ids = scalars("SELECT id FROM book")
+        self.categories = scalars("SELECT id FROM category")
+        self.words = [
+            title.split()[0].strip(".").lower()
+            for title in scalars("SELECT title FROM book ORDER BY id LIMIT 200")
+        ]
+        admin_id = conn.execute(text("SELECT id FROM user_account WHERE role = 'admin'")).scalar()
+        member_id = conn.execute(
+            text(
+                """SELECT borrowed_by_id FROM borrow GROUP BY borrowed_by_id
+                ORDER BY COUNT(*) DESC LIMIT 1"""
+            )
+        ).scalar()
+        self.outstanding = deque(
+            scalars("SELECT id FROM borrow WHERE NOT is_returned ORDER BY RANDOM()")
+        )
+        # One entry per copy on the shelf, so no checkout finds its book out of stock
+        copies = [
+            book_id
+            for book_id, quantity in conn.execute(
+                text("SELECT id, current_quantity FROM book WHERE current_quantity > 0")
+            )
+            for _ in range(quantity)
+        ]
+        self.rng.shuffle(copies)
+        self.copies = deque(copies)
+        self.rows = {
+            table: conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+            for table in ("user_account", "book", "borrow", "fine")
+        }
+
+        # Each checkout goes to a user with no loans or fines yet, so none is turned away
+        # by the loan limit or the unpaid fines limit
+        first_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) + 1 FROM user_account")).scalar()
+        password = hash_password("password")
+        conn.execute(
+            text(
+                """INSERT INTO user_account (id, email, first_name, last_name, password, role)
+                VALUES (:id, :email, 'Desk', 'Borrower', :password, 'student')"""
+            ),
+            [
+                {"id": i, "email": f"desk{i}@example.com", "password": password}
+                for i in range(first_id, first_id + desk_users)
+            ],
+        )
+        conn.commit()
+        self.borrowers = deque(range(first_id, first_id + desk_users))
+
+        with app.app_context():
+            self.admin = self.headers(create_access_token, admin_id, "admin")
+            self.member = self.headers(create_access_token, member_id, "student")
+
+    @staticmethod
+    def headers(create_access_token, user_id, role):
+        token = create_access_token(
+            identity=SimpleNamespace(id=user_id), additional_claims={"role": role}
+        )
+        return {"Authorization": f"Bearer {token}"}
+
+    def choice(self, values):
+        with self.lock:
+            return self.rng.choice(values)
+
+    def pop(self, values: deque):
+        with self.lock:
+            return values.popleft() if values else None
+
+
+def browse_books(client, data):
+    return client.get("/books")
+
+
+def search_books(client, data):
+    return client.get(f"/books?title={data.choice(data.words)}")
+
+
+def book_detail(client, data):
+    return client.get(f"/books/{data.choice(data.book_ids)}")
+
+
+def list_categories(client, data):
+    return client.get("/categories")
+
+
+def category_detail(client, data):
+    return client.get(f"/categories/{data.choice(data.categories)}")
+
+
+def member_borrows(client, data):
+    return client.get("/borrows", headers=data.member)
+
+
+def member_fines(client, data):
+    return client.get("/fines", headers=data.member)
+
+
+def checkout(client, data):
+    borrower, book_id = data.pop(data.borrowers), data.pop(data.copies)
+    if borrower is None or book_id is None:
+        return None
+    payload = {"book_id": book_id, "borrower_id": borrower}
+    return client.post("/borrow-book", json=payload, headers=data.admin)
+
+
+def return_book(client, data):
+    borrow_id = data.pop(data.outstanding)
+    if borrow_id is None:
+        return None
+    return client.post("/return-book", json={"borrow_id": borrow_id}, headers=data.admin)
+
+
+def overdue_report(client, data):
+    return client.get("/overdue-report", headers=data.admin)
+
+
+def fines_report(client, data):
+    return client.get("/fines-report", headers=data.admin)
+
+
+def trends(client, data):
+    return client.get("/borrowing-trends?time=day", headers=data.admin)
+
+
+def trend_series(client, data):
+    return client.get("/borrowing-trends/series?period=day", headers=data.admin)
+
+
+# Operations and their weights in each mix
+MIXES = {
+    "catalog": {
+        browse_books: 4,
+        search_books: 4,
+        book_detail: 6,
+        list_categories: 1,
+        category_detail: 1,
+        member_borrows: 2,
+        member_fines: 1,
+    },
+    "desk": {checkout: 1, return_book: 1},
+    "reports": {overdue_report: 1, fines_report: 1, trends: 1, trend_series: 1},
+}
+MIXES["all"] = {
+    **{op: weight * 4 for op, weight in MIXES["catalog"].items()},
+    **{op: weight * 6 for op, weight in MIXES["desk"].items()},
+    **MIXES["reports"],
+}
+
+
+def run_mix(app, data, mix: dict, requests: int, concurrency: int, seed):
+    """Run `requests` operations drawn from `mix`. Returns the timings and failures per operation."""
+    operations = Random(seed).choices(list(mix), weights=list(mix.values()), k=requests)
+    timings, failures = defaultdict(list), defaultdict(int)
+    local = threading.local()
+    lock = threading.Lock()
+
+    def call(op):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        start = time.perf_counter()
+        response = op(local.client, data)
+        elapsed = time.perf_counter() - start
+        if response is None:
+            return
+        with lock:
+            timings[op.__name__].append(elapsed)
+            if response.status_code >= 400:
+                failures[op.__name__] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(call, operations))
+    return timings, failures, time.perf_counter() - start
+
+
+def summarize(timings: dict, failures: dict, wall: float) -> dict:
+    def stats(values, errors):
+        values = sorted(values)
+        return {
+            "requests": len(values),
+            "errors": errors,
+            "throughput": round(len(values) / wall, 1),
+            **{f"p{p}_ms": round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)},
+        }
+
+    routes = {name: stats(values, failures[name]) for name, values in sorted(timings.items())}
+    everything = [value for values in timings.values() for value in values]
+    return {"routes": routes, "total": stats(everything, sum(failures.values()))}
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> bool:
+    """Print the p99 change per operation. Returns False when one regressed too far."""
+    ok = True
+    print(f"\n{'p99 vs baseline':<20} {'before':>10} {'after':>10} {'change':>8}")
+    rows = dict(result["routes"], total=result["total"])
+    before_rows = dict(baseline["routes"], total=baseline["total"])
+    for name, row in rows.items():
+        before = before_rows.get(name)
+        if not before or not before["p99_ms"]:
+            continue
+        change = row["p99_ms"] / before["p99_ms"] - 1
+        flag = ""
+        if change > max_regression:
+            ok, flag = False, "  REGRESSED"
+        print(
+            f"{name:<20} {before['p99_ms']:>8.2f}ms {row['p99_ms']:>8.2f}ms {change:>+7.0%}{flag}"
+        )
+    return ok
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mix", choices=sorted(MIXES), default="all")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=200, help="requests run before measuring")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--borrows", type=int, default=100000)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument(
+        "--db",
+        default=os.path.join(tempfile.gettempdir(), "library-bench.sqlite"),
+        help="SQLite file holding the dataset, generated when missing",
+    )
+    parser.add_argument("--regenerate", action="store_true", help="generate the dataset again")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p99 growth")
+    args = parser.parse_args()
+
+    work_dir = tempfile.TemporaryDirectory()
+    work_db = os.path.join(work_dir.name, "bench.sqlite")
+    # The database is picked from the environment when src.utils is first imported
+    os.environ["FLASK_ENV"] = "prod"
+    os.environ["DATABASE_URL"] = f"sqlite:///{work_db}"
+    from sqlalchemy import create_engine
+
+    from src import create_app
+    from src.models import Base
+    from src.populate_db import LOAD_PRAGMAS, generate
+    from src.utils import config, configure_sqlite, engine
+
+    if args.regenerate and os.path.exists(args.db):
+        os.remove(args.db)
+    if not os.path.exists(args.db):
+        print(f"Generating {args.users} users, {args.books} books, {args.borrows} borrows")
+        source = create_engine(f"sqlite:///{args.db}")
+        configure_sqlite(source, LOAD_PRAGMAS)
+        generate(source, args.users, args.books, args.borrows, seed=args.seed, log=print)
+        source.dispose()
+    shutil.copyfile(args.db, work_db)
+    Base.metadata.create_all(engine)
+    app = create_app(config=config)
+    app.logger.disabled = True
+
+    desk_users = args.requests + args.warmup
+    with engine.connect() as conn:
+        data = Dataset(conn, app, desk_users, args.seed)
+
+    mix = MIXES[args.mix]
+    run_mix(app, data, mix, args.warmup, args.concurrency, f"{args.seed}-warmup")
+    timings, failures, wall = run_mix(app, data, mix, args.requests, args.concurrency, args.seed)
+    summary = summarize(timings, failures, wall)
+
+    print(
+        f"\n{'operation':<20} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9}"
+    )
+    for name, row in dict(summary["routes"], total=summary["total"]).items():
+        print(
+            f"{name:<20} {row['requests']:>6} {row['errors']:>6} {row['throughput']:>8.1f}"
+            f" {row['p50_ms']:>7.2f}ms {row['p95_ms']:>7.2f}ms {row['p99_ms']:>7.2f}ms"
+        )
+
+    result = {
+        "commit": current_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "settings": {
+            **{name: getattr(args, name) for name in ("mix", "requests", "concurrency", "seed")},
+            "rows": data.rows,
+        },
+        **summary,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != result["settings"]:
+            print("\nWarning: the baseline was recorded with different settings")
+        if not compare(result, baseline, args.max_regression):
+            raise SystemExit(1)
+    engine.dispose()
+    work_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
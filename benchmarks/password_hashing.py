@@ -0,0 +1,54 @@
+"""
+Measure password checks per second, and per core, for hash methods and pool sizes.
+
+Each login verifies one password, so the numbers are the login throughput the hashing
+alone allows. Workers 0 hashes on the calling threads, as a request thread would without
+the pool. Pick PASSWORD_HASH_METHOD so one core still keeps up with the sign-in peak.
+
+Usage:
+    python -m benchmarks.password_hashing [--logins 64] [--workers 0 1 2 4]
+        [--method scrypt:32768:8:1 pbkdf2:sha256:600000]
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils.passwords import PasswordHasher
+
+
+def logins_per_second(method: str, workers: int, logins: int) -> float:
+    # Enough request threads to keep every worker busy
+    threads = max(workers, 1) * 2
+    hasher = PasswordHasher(method, workers, max_pending=threads)
+    try:
+        password_hash = hasher.hash("password")
+        hasher.verify("password", password_hash)  # start the pool outside the timing
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            assert all(pool.map(lambda _: hasher.verify("password", password_hash), range(logins)))
+        return logins / (time.perf_counter() - start)
+    finally:
+        hasher.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=sorted({0, 1, os.cpu_count() or 1})
+    )
+    parser.add_argument("--method", nargs="+", default=["scrypt:32768:8:1", "pbkdf2:sha256:600000"])
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores")
+    print(f"{'method':<24} {'workers':>8} {'logins/s':>10} {'per core':>10}")
+    for method in args.method:
+        for workers in args.workers:
+            rate = logins_per_second(method, workers, args.logins)
+            print(f"{method:<24} {workers:>8} {rate:>10.1f} {rate / max(workers, 1):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare per-row model_validate/model_dump + jsonify with the batch serializer.
+
+Rows are plain attribute objects shaped like the ORM rows the routes serialize, so the
+numbers only measure serialization.
+
+Usage:
+    python -m benchmarks.serialization [--rows 10000] [--repeat 5]
+"""
+
+import argparse
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from faker import Faker
+from flask import Flask, jsonify
+
+import src.p_models as pmd
+from src.utils.serialization import json_response, serialize_rows
+
+fake = Faker()
+
+
+def make_user(i):
+    return SimpleNamespace(
+        id=i,
+        email=f"user{i}@example.com",
+        first_name=fake.first_name(),
+        last_name=fake.last_name(),
+        is_active=True,
+        role="student",
+    )
+
+
+def make_fine(i, borrow_title):
+    return SimpleNamespace(
+        id=i,
+        borrow=borrow_title,
+        amount=100.0 * (i % 30),
+        paid=i % 2 == 0,
+        date_created=datetime.now(),
+        date_paid=datetime.now() if i % 2 == 0 else None,
+        payment_method="cash" if i % 2 == 0 else None,
+        transaction_id=None,
+        collected_by="Admin" if i % 2 == 0 else None,
+    )
+
+
+def make_borrow(i):
+    title = fake.sentence(3)
+    return SimpleNamespace(
+        id=i,
+        borrowed_book=title,
+        borrow_date=datetime.now(),
+        is_returned=False,
+        fines=[make_fine(i, title)],
+        given_by="Admin",
+        due_date=datetime.now(),
+        received_by=None,
+        borrowed_by=make_user(i),
+    )
+
+
+def make_rows(count):
+    borrows = [make_borrow(i) for i in range(count)]
+    fines = []
+    for borrow in borrows:
+        fine = make_fine(borrow.id, borrow.borrowed_book)
+        fine.borrow = borrow
+        fines.append(fine)
+    return {
+        pmd.ListUsersSchema: [borrow.borrowed_by for borrow in borrows],
+        pmd.AdminListBorrowSchema: borrows,
+        pmd.AdminFineListSchema: fines,
+    }
+
+
+def per_row(schema, rows):
+    items = [schema.model_validate(row) for row in rows]
+    return jsonify({"items": [item.model_dump() for item in items]}).get_data()
+
+
+def batch(schema, rows):
+    return json_response({"items": serialize_rows(schema, rows)}).get_data()
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    with app.app_context():
+        print(f"{'schema':<24} {'per row':>10} {'batch':>10} {'speedup':>8}")
+        for schema, rows in make_rows(args.rows).items():
+            before = best_of(args.repeat, per_row, schema, rows)
+            after = best_of(args.repeat, batch, schema, rows)
+            print(f"{schema.__name__:<24} {before:>9.3f}s {after:>9.3f}s {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
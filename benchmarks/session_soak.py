@@ -0,0 +1,121 @@
+"""
+Run a long read-heavy request mix through the app and check that its memory stays flat.
+
+The catalog and report mixes of `benchmarks.http_bench` run on the same generated dataset,
+with one test client per worker thread, so each thread serves request after request as a
+threaded server would. The resident set size is printed every `--interval` requests, and
+the run fails when it grew by more than `--max-growth` MB between the end of the first
+interval and the end of the run.
+
+Usage:
+    python -m benchmarks.session_soak --requests 1000000 --concurrency 8 [--interval 50000]
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+
+from benchmarks.http_bench import MIXES, Dataset
+
+
+def rss_mb() -> float:
+    """The current resident set size, or the peak one where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def soak(app, data, mix: dict, requests: int, concurrency: int, interval: int, seed):
+    """Run `requests` operations drawn from `mix`. Returns (requests done, RSS) samples."""
+    rng = Random(seed)
+    local = threading.local()
+
+    def call(op) -> bool:
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        response = op(local.client, data)
+        return response is not None and response.status_code >= 400
+
+    samples = []
+    done = errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        while done < requests:
+            # Drawn a batch at a time, a million operations up front would show up in the RSS
+            batch = rng.choices(
+                list(mix), weights=list(mix.values()), k=min(interval, requests - done)
+            )
+            errors += sum(pool.map(call, batch))
+            done += len(batch)
+            samples.append((done, rss_mb()))
+            print(
+                f"{done:>10} {samples[-1][1]:>9.1f}MB {errors:>8}"
+                f" {done / (time.perf_counter() - start):>8.0f}/s"
+            )
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=1_000_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--interval", type=int, default=50_000, help="requests between samples")
+    parser.add_argument("--max-growth", type=float, default=20, help="allowed RSS growth in MB")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--borrows", type=int, default=100000)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument(
+        "--db",
+        default=os.path.join(tempfile.gettempdir(), "library-soak.sqlite"),
+        help="SQLite file holding the dataset, generated when missing",
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.TemporaryDirectory()
+    work_db = os.path.join(work_dir.name, "soak.sqlite")
+    # The database is picked from the environment when src.utils is first imported
+    os.environ["FLASK_ENV"] = "prod"
+    os.environ["DATABASE_URL"] = f"sqlite:///{work_db}"
+    from sqlalchemy import create_engine
+
+    from src import create_app
+    from src.migrations import migrate
+    from src.populate_db import LOAD_PRAGMAS, generate
+    from src.utils import config, configure_sqlite, engine
+
+    if not os.path.exists(args.db):
+        print(f"Generating {args.users} users, {args.books} books, {args.borrows} borrows")
+        source = create_engine(f"sqlite:///{args.db}")
+        configure_sqlite(source, LOAD_PRAGMAS)
+        generate(source, args.users, args.books, args.borrows, seed=args.seed, log=print)
+        source.dispose()
+    shutil.copyfile(args.db, work_db)
+    migrate(engine)
+    app = create_app(config=config)
+    app.logger.disabled = True
+
+    with engine.connect() as conn:
+        data = Dataset(conn, app, 1, args.seed)
+
+    mix = {**MIXES["catalog"], **MIXES["reports"]}
+    print(f"\n{'requests':>10} {'rss':>11} {'errors':>8} {'rate':>10}")
+    samples = soak(app, data, mix, args.requests, args.concurrency, args.interval, args.seed)
+    growth = samples[-1][1] - samples[0][1]
+    print(f"\nRSS grew {growth:+.1f}MB after the first {samples[0][0]} requests")
+    engine.dispose()
+    work_dir.cleanup()
+    if growth > args.max_growth:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
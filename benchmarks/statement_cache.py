@@ -0,0 +1,133 @@
+"""
+Compare f-string SQL with the named statements in `src.queries` on the hot routes.
+
+Each f-string statement is a new SQL string, so SQLAlchemy compiles it again and SQLite
+prepares it again on every request. The named statements are compiled once and the
+driver reuses the prepared statement.
+
+Usage:
+    python -m benchmarks.statement_cache [--requests 5000]
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from faker import Faker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.default import CACHE_HIT
+
+import src.models as md
+import src.queries as qs
+
+fake = Faker()
+
+HOT_ROUTES = {
+    "GET /books/<id>": (
+        qs.BOOK,
+        lambda i: {"book_id": i},
+        lambda i: qs.BOOK.text.replace(":book_id", str(i)),
+    ),
+    "GET /borrows/<id>": (
+        qs.USER_BORROW,
+        lambda i: {"user_id": 1, "borrow_id": i},
+        lambda i: qs.USER_BORROW.text.replace(":user_id", "1").replace(":borrow_id", str(i)),
+    ),
+    "POST /login": (
+        qs.LOGIN_USER,
+        lambda i: {"email": f"user{i}@example.com"},
+        lambda i: qs.LOGIN_USER.text.replace(":email", f"'user{i}@example.com'"),
+    ),
+}
+
+
+def populate(engine, rows):
+    md.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            md.UserAccount.__table__.insert(),
+            [
+                {
+                    "email": f"user{i}@example.com",
+                    "first_name": fake.first_name(),
+                    "last_name": fake.last_name(),
+                    "password": "x",
+                    "role": "student",
+                }
+                for i in range(1, rows + 1)
+            ],
+        )
+        conn.execute(md.Category.__table__.insert(), [{"name": "fiction", "added_by_id": 1}])
+        conn.execute(
+            md.Book.__table__.insert(),
+            [
+                {
+                    "title": fake.sentence(3),
+                    "author": fake.name(),
+                    "category_id": 1,
+                    "isbn": fake.isbn13(),
+                    "original_quantity": 1,
+                    "current_quantity": 1,
+                    "location": "A1",
+                    "date_added": datetime.now(),
+                    "added_by_id": 1,
+                }
+                for _ in range(rows)
+            ],
+        )
+        conn.execute(
+            md.Borrow.__table__.insert(),
+            [
+                {
+                    "book_id": i,
+                    "borrowed_by_id": 1,
+                    "given_by_id": 1,
+                    "received_by_id": 1,
+                    "borrow_date": datetime.now(),
+                    "due_date": datetime.now() + timedelta(days=14),
+                }
+                for i in range(1, rows + 1)
+            ],
+        )
+
+
+def run(conn, requests, make_statement):
+    """Execute `requests` statements and return (seconds, statements compiled)."""
+    compiled = 0
+
+    def count_compiles(conn, cursor, statement, parameters, context, executemany):
+        nonlocal compiled
+        if context.cache_hit is not CACHE_HIT:
+            compiled += 1
+
+    event.listen(conn, "before_cursor_execute", count_compiles)
+    start = time.perf_counter()
+    for i in range(requests):
+        statement, params = make_statement(i % 1000 + 1)
+        conn.execute(statement, params).all()
+    elapsed = time.perf_counter() - start
+    event.remove(conn, "before_cursor_execute", count_compiles)
+    return elapsed, compiled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    populate(engine, 1000)
+    print(f"{'route':<20} {'f-string':>12} {'named':>12} {'saved/req':>12} {'compiles':>16}")
+    with engine.connect() as conn:
+        for route, (statement, params, literal) in HOT_ROUTES.items():
+            before, before_compiled = run(conn, args.requests, lambda i: (text(literal(i)), {}))
+            after, after_compiled = run(conn, args.requests, lambda i: (statement, params(i)))
+            saved = (before - after) / args.requests * 1e6
+            print(
+                f"{route:<20} {before:>11.3f}s {after:>11.3f}s {saved:>10.1f}us"
+                f" {before_compiled:>7} -> {after_compiled:<6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os
 from datetime import timedelta
 
 from sqlalchemy.dialects.postgresql import dialect as PostgresDialect  # noqa
@@ -18,6 +19,33 @@ class Config:
     SQLALCHEMY_ECHO = True
     DEBUG = True
     JWT_VERIFY_SUB = False
+    # JWT user lookups are cached per process, entries live at most USER_CACHE_TTL seconds
+    USER_CACHE_TTL = 60
+    USER_CACHE_SIZE = 1024
+    # Category pages are cached per process. Writes through this process drop them at once,
+    # other processes serve them for at most CATALOG_CACHE_TTL seconds after a write
+    CATALOG_CACHE_TTL = 300
+    CATALOG_CACHE_SIZE = 256
+    # Applied to every new SQLite connection, see src.utils.sqlite
+    SQLITE_PRAGMAS = {}
+    SQLITE_OPTIMIZE_ON_CLOSE = False
+    # Warn when one statement shape runs this many times in a request
+    N_PLUS_ONE_THRESHOLD = 5
+    # Passwords are hashed in a pool of PASSWORD_HASH_WORKERS processes, 0 hashes on the
+    # request thread. Past PASSWORD_HASH_MAX_PENDING waiting hashes, logins get a 503.
+    # Stored hashes made with another method are replaced on the next login.
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    PASSWORD_HASH_WORKERS = os.cpu_count() or 1
+    PASSWORD_HASH_MAX_PENDING = 32
+    # GET /notifications/stream sends a comment line after this many idle seconds, so
+    # proxies keep the connection open. The broker keeps the last NOTIFICATION_BACKLOG events,
+    # and a reconnecting client catches up on at most that many at a time.
+    NOTIFICATION_KEEPALIVE = 15
+    NOTIFICATION_BACKLOG = 1000
+    # Every request gets its own session, removed when it ends. With expire_on_commit off,
+    # objects stay readable after a commit without being loaded again, but no longer show
+    # what other sessions write later in the same request.
+    SESSION_EXPIRE_ON_COMMIT = True
 
 
 class DevConfig(Config):
@@ -29,9 +57,28 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = False
+    PASSWORD_HASH_WORKERS = 0
+
+
+class ProdConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "sqlite:///db.sqlite")
+    SQLALCHEMY_ECHO = False
+    DEBUG = False
+    # WAL lets readers run alongside the writer, and with synchronous=NORMAL a commit no
+    # longer fsyncs; only a checkpoint does
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,  # KiB, so 64 MB per connection
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,  # ms
+    }
+    SQLITE_OPTIMIZE_ON_CLOSE = True
 
 
 config_dict: dict[str, Config] = {
     "dev": DevConfig,
     "testing": TestConfig,
+    "prod": ProdConfig,
 }
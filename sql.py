@@ -1,185 +1,57 @@
-CREATE_SQLITE = """CREATE TABLE IF NOT EXISTS "user_account" (
-	id INTEGER PRIMARY KEY AUTOINCREMENT,
-	email TEXT NOT NULL CHECK (LENGTH(email) <= 50) UNIQUE,
-	first_name TEXT NOT NULL CHECK (LENGTH(first_name) <= 20),
-	last_name TEXT NOT NULL CHECK (LENGTH(last_name) <= 20), 
-	password TEXT NOT NULL, 
-	is_active BOOLEAN DEFAULT 1 NOT NULL, 
-	role TEXT DEFAULT 'student' NOT NULL CHECK (role IN ('student', 'admin', 'external') AND LENGTH(role) <= 20)
-);
-
-CREATE TABLE IF NOT EXISTS "category" (
-	id INTEGER PRIMARY KEY AUTOINCREMENT,
-	name TEXT NOT NULL CHECK (LENGTH(name) <= 20) UNIQUE, 
-    added_by_id INTEGER NOT NULL,
-    FOREIGN KEY(added_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "book" (
-	id INTEGER PRIMARY KEY AUTOINCREMENT,
-	title TEXT NOT NULL CHECK (LENGTH(title) <= 100), 
-	author TEXT NOT NULL CHECK (LENGTH(author) <= 50), 
-	isbn TEXT NOT NULL CHECK (LENGTH(isbn) <= 25) UNIQUE, 
-	category_id INTEGER NOT NULL, 
-	original_quantity INTEGER DEFAULT '1' NOT NULL, 
-	current_quantity INTEGER DEFAULT '1' NOT NULL, 
-	date_added DATETIME NOT NULL, 
-	added_by_id INTEGER NOT NULL, 
-	is_available BOOLEAN DEFAULT 1 NOT NULL,
-    location TEXT CHECK (LENGTH(location) <= 20) NOT NULL DEFAULT 'shelf', 
-	FOREIGN KEY(category_id) REFERENCES category (id), 
-	FOREIGN KEY(added_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "borrow" (
-	id INTEGER PRIMARY KEY AUTOINCREMENT,
-	book_id INTEGER NOT NULL, 
-	borrowed_by_id INTEGER NOT NULL, 
-	given_by_id INTEGER NOT NULL, 
-	received_by_id INTEGER, 
-	borrow_date DATETIME NOT NULL, 
-	due_date DATETIME NOT NULL, 
-	return_date DATETIME, 
-	comments TEXT, 
-	is_returned BOOLEAN DEFAULT 0 NOT NULL, 
-	FOREIGN KEY(book_id) REFERENCES book (id), 
-	FOREIGN KEY(borrowed_by_id) REFERENCES user_account (id), 
-	FOREIGN KEY(given_by_id) REFERENCES user_account (id), 
-	FOREIGN KEY(received_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "fine" (
-	id INTEGER PRIMARY KEY AUTOINCREMENT,
-	borrow_id INTEGER NOT NULL UNIQUE, 
-	amount REAL NOT NULL, 
-	paid BOOLEAN DEFAULT 0 NOT NULL, 
-	date_created DATETIME NOT NULL, 
-	date_paid DATETIME, 
-	payment_method TEXT CHECK (LENGTH(payment_method) <= 15), 
-	transaction_id TEXT CHECK (LENGTH(transaction_id) <= 100) UNIQUE, 
-	collected_by_id INTEGER,
-	FOREIGN KEY(borrow_id) REFERENCES borrow (id), 
-	FOREIGN KEY(collected_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "notification" (
-	id INTEGER PRIMARY KEY AUTOINCREMENT,
-	user_id INTEGER NOT NULL, 
-	message TEXT NOT NULL, 
-	sent_date DATETIME NOT NULL, 
-	is_read BOOLEAN DEFAULT 0 NOT NULL, 
-	FOREIGN KEY(user_id) REFERENCES user_account (id)
-);
-
-CREATE INDEX idx_book_category_id ON book (category_id);
-CREATE INDEX idx_book_added_by_id ON book (added_by_id);
-CREATE INDEX idx_book_isbn ON book (isbn);
-
-CREATE INDEX idx_borrow_book_id ON borrow (book_id);
-CREATE INDEX idx_borrow_borrowed_by_id ON borrow (borrowed_by_id);
-CREATE INDEX idx_borrow_given_by_id ON borrow (given_by_id);
-CREATE INDEX idx_borrow_received_by_id ON borrow (received_by_id);
-
-CREATE INDEX idx_fine_borrow_id ON fine (borrow_id);
-CREATE INDEX idx_fine_collected_by_id ON fine (collected_by_id);
-
-CREATE INDEX idx_category_added_by_id ON category (added_by_id);
-
-CREATE INDEX idx_user_account_email ON user_account (email);
-"""
-
-
-CREATE_POSTGRES = """CREATE TABLE IF NOT EXISTS "user_account" (
-	id SERIAL PRIMARY KEY,
-	email VARCHAR(50) NOT NULL,
-	first_name VARCHAR(20) NOT NULL,
-	last_name VARCHAR(20) NOT NULL, 
-	password VARCHAR NOT NULL, 
-	is_active BOOLEAN DEFAULT '1' NOT NULL, 
-	role VARCHAR(20) DEFAULT 'student' NOT NULL CHECK (role IN ('student', 'admin', 'external')),
-	UNIQUE (email)
-);
-
-CREATE TABLE IF NOT EXISTS "category" (
-	id SERIAL PRIMARY KEY,
-	name VARCHAR(20) NOT NULL, 
-    added_by_id INTEGER NOT NULL,
-	UNIQUE (name),
-    FOREIGN KEY(added_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "book" (
-	id SERIAL PRIMARY KEY,
-	title VARCHAR(100) NOT NULL, 
-	author VARCHAR(50) NOT NULL, 
-	isbn VARCHAR(25) NOT NULL, 
-	category_id INTEGER NOT NULL, 
-	original_quantity INTEGER DEFAULT '1' NOT NULL, 
-	current_quantity INTEGER DEFAULT '1' NOT NULL, 
-	date_added TIMESTAMP NOT NULL, 
-	added_by_id INTEGER NOT NULL, 
-	is_available BOOLEAN DEFAULT '1' NOT NULL, 
-    location VARCHAR(20) DEFAULT 'shelf' NOT NULL,
-	UNIQUE (isbn), 
-	FOREIGN KEY(category_id) REFERENCES category (id), 
-	FOREIGN KEY(added_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "borrow" (
-	id SERIAL PRIMARY KEY,
-	book_id INTEGER NOT NULL, 
-	borrowed_by_id INTEGER NOT NULL, 
-	given_by_id INTEGER NOT NULL, 
-	received_by_id INTEGER, 
-	borrow_date TIMESTAMP NOT NULL, 
-	due_date TIMESTAMP NOT NULL, 
-	return_date TIMESTAMP, 
-	comments VARCHAR, 
-	is_returned BOOLEAN DEFAULT '0' NOT NULL, 
-	FOREIGN KEY(book_id) REFERENCES book (id), 
-	FOREIGN KEY(borrowed_by_id) REFERENCES user_account (id), 
-	FOREIGN KEY(given_by_id) REFERENCES user_account (id), 
-	FOREIGN KEY(received_by_id) REFERENCES user_account (id)
-);
-
-CREATE TABLE IF NOT EXISTS "fine" (
-	id SERIAL PRIMARY KEY,
-	borrow_id INTEGER NOT NULL, 
-	amount FLOAT NOT NULL, 
-	paid BOOLEAN DEFAULT '0' NOT NULL, 
-	date_created TIMESTAMP NOT NULL, 
-	date_paid TIMESTAMP, 
-	payment_method VARCHAR(15), 
-	transaction_id VARCHAR(100), 
-	collected_by_id INTEGER,
-	FOREIGN KEY(borrow_id) REFERENCES borrow (id), 
-	FOREIGN KEY(collected_by_id) REFERENCES user_account (id),
-	UNIQUE (transaction_id),
-    UNIQUE (borrow_id)
-);
-
-CREATE TABLE IF NOT EXISTS "notification" (
-	id SERIAL PRIMARY KEY,
-	user_id INTEGER NOT NULL, 
-	message VARCHAR NOT NULL, 
-	sent_date TIMESTAMP NOT NULL, 
-	is_read BOOLEAN DEFAULT '0' NOT NULL, 
-	FOREIGN KEY(user_id) REFERENCES user_account (id)
-);
-
-CREATE INDEX idx_book_category_id ON book (category_id);
-CREATE INDEX idx_book_added_by_id ON book (added_by_id);
-CREATE INDEX idx_book_isbn ON book (isbn);
-
-CREATE INDEX idx_borrow_book_id ON borrow (book_id);
-CREATE INDEX idx_borrow_borrowed_by_id ON borrow (borrowed_by_id);
-CREATE INDEX idx_borrow_given_by_id ON borrow (given_by_id);
-CREATE INDEX idx_borrow_received_by_id ON borrow (received_by_id);
-
-CREATE INDEX idx_fine_borrow_id ON fine (borrow_id);
-CREATE INDEX idx_fine_collected_by_id ON fine (collected_by_id);
-
-CREATE INDEX idx_category_added_by_id ON category (added_by_id);
-
-CREATE INDEX idx_user_account_email ON user_account (email);
-"""
+# Full-text search over the book catalog, created with the tables from the models and by
+# the migrations. Each entry is a single statement, as trigger bodies contain semicolons.
+SEARCH_SQLITE = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+	title, 
+	author, 
+	content='book', 
+	content_rowid='id', 
+	tokenize='unicode61 remove_diacritics 2'
+)""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book BEGIN
+	INSERT INTO book_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book BEGIN
+	INSERT INTO book_fts (book_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_update AFTER UPDATE OF title, author ON book BEGIN
+	INSERT INTO book_fts (book_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+	INSERT INTO book_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+END""",
+    "INSERT INTO book_fts (book_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_SQLITE = ["DROP TABLE IF EXISTS book_fts"]
+
+
+# Postgres keeps the column in step with a trigger rather than as a generated column, so it
+# can be added to a populated table without rewriting it, then backfilled in batches.
+# Title terms carry weight A and author terms weight B so they can be filtered per column.
+SEARCH_POSTGRES_TRIGGER = [
+    """CREATE OR REPLACE FUNCTION book_search_vector(title VARCHAR, author VARCHAR) RETURNS tsvector
+LANGUAGE sql IMMUTABLE AS $$
+	SELECT setweight(to_tsvector('simple', coalesce(title, '')), 'A') || 
+	setweight(to_tsvector('simple', coalesce(author, '')), 'B')
+$$""",
+    """CREATE OR REPLACE FUNCTION book_search_vector_update() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+	NEW.search_vector := book_search_vector(NEW.title, NEW.author);
+	RETURN NEW;
+END
+$$""",
+    "DROP TRIGGER IF EXISTS book_search_vector_update ON book",
+    """CREATE TRIGGER book_search_vector_update BEFORE INSERT OR UPDATE OF title, author ON book
+FOR EACH ROW EXECUTE FUNCTION book_search_vector_update()""",
+]
+
+SEARCH_POSTGRES_BACKFILL = (
+    "UPDATE book SET search_vector = book_search_vector(title, author) WHERE search_vector IS NULL"
+)
+
+SEARCH_POSTGRES = [
+    "ALTER TABLE book ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    *SEARCH_POSTGRES_TRIGGER,
+    SEARCH_POSTGRES_BACKFILL,
+    "CREATE INDEX IF NOT EXISTS idx_book_search_vector ON book USING GIN (search_vector)",
+]
@@ -1,17 +1,35 @@
+from http import HTTPStatus
+
+import click
 from flask import Flask
 from flask_jwt_extended import JWTManager
 from flask_restx import Api
 from sqlalchemy import select, text  # noqa
 
-from config import config_dict, DevConfig
-from sql import CREATE_POSTGRES, CREATE_SQLITE
+from config import config_dict
 from src import models as md
 from src.auth.routes import auth_namespace
 from src.books import book_namespace
 from src.borrows import borrow_namespace
+from src.holds import holds_namespace
+from src.migrations import MIGRATIONS, applied_migrations, migrate
 from src.reports import reports_namespace
 from src.notifications import notifications_namespace
-from src.utils import session
+from src.utils import (
+    CatalogCache,
+    HasherBusy,
+    InvalidCursor,
+    LocalBroker,
+    PasswordHasher,
+    TTLCache,
+    engine,
+    expire_holds,
+    init_query_stats,
+    rebuild_rollups,
+    repair_counters,
+    session,
+    sweep_overdue_fines,
+)
 from flask_cors import CORS
 
 
@@ -30,17 +48,24 @@ def create_app(db="sqlite", config=config_dict['dev']):
 
     api = Api(app, authorizations=authorizations, security="Bearer Auth")
     jwt = JWTManager(app)
+    init_query_stats(app)
+    app.extensions["user_cache"] = user_cache = TTLCache(
+        app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"]
+    )
+    app.extensions["password_hasher"] = PasswordHasher(
+        app.config["PASSWORD_HASH_METHOD"],
+        app.config["PASSWORD_HASH_WORKERS"],
+        app.config["PASSWORD_HASH_MAX_PENDING"],
+    )
+    app.extensions["notification_broker"] = LocalBroker(app.config["NOTIFICATION_BACKLOG"])
+    app.extensions["catalog_cache"] = CatalogCache(
+        app.config["CATALOG_CACHE_SIZE"], app.config["CATALOG_CACHE_TTL"]
+    )
 
-    if config.DB == "sqlite":
-        statements = CREATE_SQLITE.split(";")
-    elif config.DB == "postgres":
-        statements = CREATE_POSTGRES.split(";")  # noqa
-
-    if isinstance(config, DevConfig):
-        print("Creating tables")
-        # for stmt in statements:
-        #     session.execute(text(stmt))
-        # session.commit()
+    @app.teardown_appcontext
+    def remove_session(_exception=None):
+        # A thread serves many requests, its session must not keep their objects around
+        session.remove()
 
     @jwt.user_identity_loader
     def user_identity_lookup(user):
@@ -49,16 +74,71 @@ def create_app(db="sqlite", config=config_dict['dev']):
     @jwt.user_lookup_loader
     def user_lookup_callback(_jwt_header, jwt_data):
         identity = jwt_data["sub"]
+        res = user_cache.get(identity)
+        if res is not None:
+            return res
         stmt = select(md.UserAccount.id, md.UserAccount.first_name, md.UserAccount.role).where(
             md.UserAccount.id == identity
         )
         res = session.execute(stmt).mappings().first()
+        if res is not None:
+            user_cache.set(identity, res)
         return res
 
+    @api.errorhandler(InvalidCursor)
+    def handle_invalid_cursor(error):
+        return {"error": str(error)}, HTTPStatus.BAD_REQUEST
+
+    @api.errorhandler(HasherBusy)
+    def handle_hasher_busy(error):
+        return (
+            {"error": "Too many sign-ins at once, try again shortly"},
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            {"Retry-After": "1"},
+        )
+
+    @app.cli.command("overdue-sweep")
+    def overdue_sweep():
+        """Fine overdue borrows, notify the borrowers and expire uncollected holds."""
+        fines, notifications, _ = sweep_overdue_fines()
+        holds = expire_holds(session)
+        session.commit()
+        click.echo(f"{fines} fines created or updated, {notifications} borrowers notified")
+        click.echo(f"{holds} uncollected holds expired")
+
+    @app.cli.command("rollup-backfill")
+    def rollup_backfill():
+        """Rebuild the borrowing-trends rollups from the whole borrow history."""
+        rows = rebuild_rollups(session, config.DB)
+        session.commit()
+        click.echo(f"{rows} rollup rows written")
+
+    @app.cli.command("repair-counters")
+    def repair_counters_command():
+        """Recount every user's active loans and outstanding balance."""
+        users = repair_counters(session)
+        session.commit()
+        click.echo(f"{users} users had drifted counters repaired")
+
+    @app.cli.command("db-upgrade")
+    @click.option("--target", type=int, help="Stop after this migration version.")
+    def db_upgrade(target):
+        """Apply the pending schema migrations."""
+        applied = migrate(engine, target, log=click.echo)
+        click.echo(f"{len(applied)} migrations applied")
+
+    @app.cli.command("db-status")
+    def db_status():
+        """List the schema migrations and when each was applied."""
+        applied = applied_migrations(engine)
+        for migration in MIGRATIONS:
+            click.echo(f"{migration}: {applied.get(migration.version, 'pending')}")
+
     api.add_namespace(book_namespace, path="")
     api.add_namespace(auth_namespace, path="")
     api.add_namespace(borrow_namespace, path="")
     api.add_namespace(reports_namespace, path="")
     api.add_namespace(notifications_namespace, path="")
+    api.add_namespace(holds_namespace, path="")
 
     return app
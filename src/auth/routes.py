@@ -1,7 +1,7 @@
 from datetime import datetime
 from http import HTTPStatus
 
-from flask import jsonify, make_response, request
+from flask import current_app, jsonify, make_response, request
 from flask_jwt_extended import (
     create_access_token,
     create_refresh_token,
@@ -12,8 +12,24 @@ from flask_restx import Namespace, Resource, fields
 from sqlalchemy import text
 
 from src import p_models as pmd
+from src import queries as qs
 from src.auth.oauth import admin_required
-from src.utils import atomic_transaction, check_password, hash_password, session, sql_compile
+from src.utils import (
+    PasswordHasher,
+    atomic_transaction,
+    invalidate_catalog,
+    invalidate_user,
+    json_response,
+    keyset_sql,
+    order_sql,
+    page_args,
+    paginate,
+    config,
+    serialize_rows,
+    session,
+    shift_rollups,
+    sql_compile,
+)
 
 auth_namespace = Namespace("Auth", description="Authentication operations", path="/")
 
@@ -76,18 +92,27 @@ class Register(Resource):
                 jsonify(message="Invalid role. Must be one of student or external"),
                 HTTPStatus.BAD_REQUEST,
             )
-        stmt = f"SELECT EXISTS (SELECT 1 FROM user_account WHERE email = '{email}') AS user_exists"
-        queries = [stmt]
-        user = session.execute(text(stmt)).mappings().first()
+        stmt = qs.EMAIL_EXISTS
+        queries = [sql_compile(stmt)]
+        user = session.execute(stmt, {"email": email}).mappings().first()
         if user["user_exists"]:
             return make_response(
                 jsonify(message="User with email already exists", query=sql_compile(stmt)),
                 HTTPStatus.BAD_REQUEST,
             )
-        password = hash_password(password)
-        stmt = f"INSERT INTO user_account (email, first_name, last_name, password, role) VALUES ('{email}', '{first_name}', '{last_name}', '{password}', '{role}')"
-        queries.append(stmt)
-        session.execute(text(stmt))
+        password = current_app.extensions["password_hasher"].hash(password)
+        stmt = qs.INSERT_USER
+        queries.append(sql_compile(stmt))
+        session.execute(
+            stmt,
+            {
+                "email": email,
+                "first_name": first_name,
+                "last_name": last_name,
+                "password": password,
+                "role": role,
+            },
+        )
         return make_response(
             jsonify(message="User created successfully", queries=[queries]), HTTPStatus.CREATED
         )
@@ -99,18 +124,27 @@ class Login(Resource):
     def post(self):
         email = request.json.get("email", None)
         password = request.json.get("password", None)
-        stmt = f"SELECT id, email, password, role, is_active FROM user_account WHERE email = '{email}'"
-        user = session.execute(text(stmt)).mappings().first()
-        if not user or not user.is_active or not check_password(password, user.password):
+        stmt = qs.LOGIN_USER
+        user = session.execute(stmt, {"email": email}).mappings().first()
+        queries = [sql_compile(stmt)]
+        hasher: PasswordHasher = current_app.extensions["password_hasher"]
+        if not user or not user.is_active or not hasher.verify(password, user.password):
             return make_response(
-                jsonify(message="Wrong username or password", queries=[stmt]),
+                jsonify(message="Wrong username or password", queries=queries),
                 HTTPStatus.UNAUTHORIZED,
             )
+        if hasher.needs_rehash(user.password):
+            # The password is only ever known here, so old hashes are upgraded on login
+            stmt = qs.REHASH_PASSWORD
+            queries.append(sql_compile(stmt))
+            params = {"user_id": user.id, "old_password": user.password}
+            session.execute(stmt, {**params, "password": hasher.hash(password)})
+            session.commit()
 
         additional_claims = {"role": user.role}
         access_token = create_access_token(identity=user, additional_claims=additional_claims)
         refresh_token = create_refresh_token(identity=user, additional_claims=additional_claims)
-        return jsonify(access_token=access_token, refresh_token=refresh_token, queries=[stmt])
+        return jsonify(access_token=access_token, refresh_token=refresh_token, queries=queries)
 
 
 @auth_namespace.route("/refresh")
@@ -133,19 +167,21 @@ class MakeAdmin(Resource):
         """Make a user an admin"""
         data = request.json
         email = data.get("email", None)
-        stmt = (
-            f"SELECT id, email, role FROM user_account WHERE email = '{email}' AND role != 'admin'"
-        )
-        queries = [stmt]
-        user = session.execute(text(stmt)).scalars().first()
+        stmt = qs.NON_ADMIN_USER
+        queries = [sql_compile(stmt)]
+        user = session.execute(stmt, {"email": email}).scalars().first()
         if not user:
             return make_response(
                 jsonify(message="User not found or already an admin", queries=queries),
                 HTTPStatus.NOT_FOUND,
             )
-        stmt = f"UPDATE user_account SET role = 'admin' WHERE email = '{email}'"
-        queries.append(stmt)
-        session.execute(text(stmt))
+        # The user's borrows move to the admin counts of the rollups
+        queries.extend(shift_rollups(session, config.DB, -1, "borrowed_by_id", [user]))
+        stmt = qs.MAKE_ADMIN
+        queries.append(sql_compile(stmt))
+        session.execute(stmt, {"email": email})
+        queries.extend(shift_rollups(session, config.DB, 1, "borrowed_by_id", [user]))
+        invalidate_user(session, user)
         return make_response(
             jsonify(message="User is now an admin", queries=queries), HTTPStatus.OK
         )
@@ -155,25 +191,43 @@ class MakeAdmin(Resource):
 class ListUsers(Resource):
     @admin_required
     def get(self):
+        limit, cursor = page_args()
         stmt = "SELECT id, email, first_name, last_name, is_active, role FROM user_account \n"
+        params = {"limit": limit + 1}
         email = request.args.get("email")
         ors = []
         if email:
-            ors.append(f"LOWER(email) LIKE LOWER('%{email}%')")
+            params["email"] = f"%{email.lower()}%"
+            ors.append("LOWER(email) LIKE :email")
 
         name = request.args.get("name")
         if name:
-            ors.append(
-                f"LOWER(first_name) LIKE LOWER('%{name}%') OR LOWER(last_name) LIKE LOWER('%{name}%')"
-            )
+            params["name"] = f"%{name.lower()}%"
+            ors.append("LOWER(first_name) LIKE :name OR LOWER(last_name) LIKE :name")
 
+        where = []
         if ors:
-            stmt += "\n WHERE " + " OR ".join(ors)
-
-        stmt += "\nORDER BY first_name"
-        users = session.execute(text(stmt)).mappings().all()
-        users = [pmd.ListUsersSchema.model_validate(user) for user in users]
-        return {"users": [user.model_dump() for user in users], "queries": [sql_compile(stmt)]}
+            where.append("(" + " OR ".join(ors) + ")")
+
+        order_keys = [("first_name", False), ("id", False)]
+        if cursor:
+            cursor_stmt, cursor_params = keyset_sql(order_keys, cursor)
+            where.append(cursor_stmt)
+            params.update(cursor_params)
+
+        if where:
+            stmt += "\n WHERE " + " AND ".join(where)
+
+        stmt += f"\nORDER BY {order_sql(order_keys)} LIMIT :limit"
+        users = session.execute(text(stmt), params).mappings().all()
+        users, next_cursor = paginate(users, limit, lambda user: [user.first_name, user.id])
+        return json_response(
+            {
+                "users": serialize_rows(pmd.ListUsersSchema, users),
+                "next_cursor": next_cursor,
+                "queries": [sql_compile(stmt)],
+            }
+        )
 
 
 @auth_namespace.route("/users/<int:user_id>")
@@ -185,47 +239,30 @@ class GetUser(Resource):
         books_given = tuple()
         fines_collected = tuple()
         borrows = tuple()
-        stmt = f"SELECT id, email, first_name, last_name, is_active, role FROM user_account WHERE id = {user_id}"
-        user = session.execute(text(stmt)).mappings().first()
+        params = {"user_id": user_id}
+        stmt = qs.USER
+        user = session.execute(stmt, params).mappings().first()
         if not user:
             return make_response(
                 jsonify(message="User not found", queries=[sql_compile(stmt)]),
                 HTTPStatus.NOT_FOUND,
             )
-        queries = [stmt]
+        queries = [sql_compile(stmt)]
         if request.args.get("detail") == "true":
-            stmt = f"""SELECT borrow.id AS borrow_id, borrow.borrow_date, borrow.received_by_id, borrow.is_returned, borrow.book_id, book.title AS borrowed_book, fine.id AS fine_id, fine.amount AS fine_amount, fine.paid AS fine_paid, fine.date_created AS fine_date_created, fine.collected_by_id AS fine_collected_by_id, fine.date_paid AS fine_date_paid
-                      FROM borrow
-                      JOIN book ON book.id = borrow.book_id
-                      LEFT JOIN fine ON fine.borrow_id = borrow.id
-                      WHERE borrow.borrowed_by_id = {user_id};
-            """
+            stmt = qs.USER_BOOKS_BORROWED
             queries.append(sql_compile(stmt))
-            borrows = session.execute(text(stmt)).mappings().all()
+            borrows = session.execute(stmt, params).mappings().all()
             if user.role == "admin":
-                stmt = f"""SELECT borrow.id AS borrow_id, borrow.borrow_date, borrow.borrowed_by_id, borrow.is_returned, borrow.book_id, borrow.return_date, book.title AS borrowed_book
-                          FROM borrow
-                          JOIN book ON book.id = borrow.book_id
-                          WHERE borrow.received_by_id = {user_id};
-                    """
+                stmt = qs.USER_BOOKS_RECEIVED
                 queries.append(sql_compile(stmt))
-                books_received = session.execute(text(stmt)).mappings().all()
-
-                stmt = f"""
-                        SELECT fine.id AS fine_id, fine.borrow_id, fine.amount AS fine_amount, fine.paid AS fine_paid, fine.date_created AS fine_date_created, fine.collected_by_id, fine.date_paid AS fine_date_paid, borrow.borrow_date, borrow.borrowed_by_id, borrow.received_by_id, borrow.is_returned, borrow.book_id, book.title AS borrowed_book
-                        FROM fine
-                        JOIN borrow ON borrow.id = fine.borrow_id
-                        JOIN book ON book.id = borrow.book_id
-                        WHERE fine.collected_by_id = {user_id};
-                    """
-                fines_collected = session.execute(text(stmt)).mappings().all()
-
-                stmt = f"""SELECT borrow.id AS borrow_id, borrow.borrow_date, borrow.borrowed_by_id, borrow.is_returned, borrow.book_id, book.title AS borrowed_book
-                          FROM borrow
-                          JOIN book ON book.id = borrow.book_id
-                          WHERE borrow.given_by_id = {user_id};"""
+                books_received = session.execute(stmt, params).mappings().all()
+
+                stmt = qs.USER_FINES_COLLECTED
+                fines_collected = session.execute(stmt, params).mappings().all()
+
+                stmt = qs.USER_BOOKS_GIVEN
                 queries.append(sql_compile(stmt))
-                books_given = session.execute(text(stmt)).mappings().all()
+                books_given = session.execute(stmt, params).mappings().all()
 
         user = {
             "email": user.email,
@@ -305,18 +342,28 @@ class GetUser(Resource):
                 jsonify(message=f"Invalid role. Must be one of {valid_roles}", queries=[]),
                 HTTPStatus.BAD_REQUEST,
             )
-        update_data = []
+        update_data = {}
         for name in tuple(update_user_input.keys()):
             if name in data:
-                update_data.append(f"{name}='{request.json[name]}'")
-
-        update_stmt = f"UPDATE user_account SET {', '.join(update_data)} WHERE id={user_id}"
-        queries = [update_stmt]
-        result = session.execute(text(update_stmt))
+                update_data[name] = request.json[name]
+
+        update_stmt = qs.update_statement("user_account", tuple(update_data))
+        queries = []
+        if "role" in update_data:
+            # The user's borrows move to the counts of their new role
+            queries.extend(shift_rollups(session, config.DB, -1, "borrowed_by_id", [user_id]))
+        queries.append(sql_compile(update_stmt))
+        result = session.execute(update_stmt, {**update_data, "id": user_id})
         if result.rowcount == 0:
             return make_response(
                 jsonify(message="User not found", queries=queries), HTTPStatus.NOT_FOUND
             )
+        if "role" in update_data:
+            queries.extend(shift_rollups(session, config.DB, 1, "borrowed_by_id", [user_id]))
+        invalidate_user(session, user_id)
+        if "first_name" in update_data or "last_name" in update_data:
+            # Admin category pages name who added the category
+            invalidate_catalog(session)
         return make_response(
             jsonify(message="User updated successfully", queries=queries), HTTPStatus.OK
         )
@@ -329,14 +376,15 @@ class DeactivateUser(Resource):
     def post(self):
         data = request.json
         email = data.get("email", None)
-        stmt = f"UPDATE user_account SET is_active = FALSE WHERE email = '{email}' AND is_active = TRUE"
-        queries = [stmt]
-        result = session.execute(text(stmt))
-        if result.rowcount == 0:
+        stmt = qs.DEACTIVATE_USER
+        queries = [sql_compile(stmt)]
+        user_ids = session.execute(stmt, {"email": email}).scalars().all()
+        if not user_ids:
             return make_response(
                 jsonify(message="User not found or already deactivated", queries=queries),
                 HTTPStatus.NOT_FOUND,
             )
+        invalidate_user(session, *user_ids)
         return make_response(
             jsonify(message="User deactivated successfully", queries=queries), HTTPStatus.OK
         )
@@ -349,14 +397,15 @@ class ActivateUser(Resource):
     def post(self):
         data = request.json
         email = data.get("email", None)
-        stmt = f"UPDATE user_account SET is_active = TRUE WHERE email = '{email}' AND is_active = FALSE"
-        queries = [stmt]
-        result = session.execute(text(stmt))
-        if result.rowcount == 0:
+        stmt = qs.ACTIVATE_USER
+        queries = [sql_compile(stmt)]
+        user_ids = session.execute(stmt, {"email": email}).scalars().all()
+        if not user_ids:
             return make_response(
                 jsonify(message="User not found or already active", queries=queries),
                 HTTPStatus.NOT_FOUND,
             )
+        invalidate_user(session, *user_ids)
         return make_response(
             jsonify(message="User activated successfully", queries=queries), HTTPStatus.OK
         )
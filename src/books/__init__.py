@@ -1,14 +1,35 @@
 from datetime import datetime
 from http import HTTPStatus
 
-from flask import jsonify, make_response, request
+from flask import current_app, jsonify, make_response, request
 from flask_jwt_extended import current_user, jwt_required
 from flask_restx import Namespace, Resource, fields
 from sqlalchemy import text
 
 import src.p_models as pmd
+import src.queries as qs
 from src.auth.oauth import admin_required
-from src.utils import atomic_transaction, session, sql_compile
+from src.utils import (
+    IMPORT_FORMATS,
+    CatalogCache,
+    atomic_transaction,
+    config,
+    fts_match_expression,
+    import_books,
+    invalidate_catalog,
+    json_response,
+    keyset_sql,
+    order_sql,
+    page_args,
+    paginate,
+    read_feed,
+    serialize_rows,
+    serve_waiting_holds,
+    session,
+    shift_rollups,
+    sql_compile,
+    tsquery_expression,
+)
 
 book_namespace = Namespace("Books", description="Book operations", path="/")
 
@@ -37,18 +58,36 @@ update_book_input = book_namespace.model(
 )
 
 
+def cached_catalog(key, load):
+    """
+    Serve a catalog page from the app's catalog cache, loading it on a miss.
+
+    `load` returns the page without its `queries`, which are only reported when they ran.
+    """
+    cache: CatalogCache = current_app.extensions["catalog_cache"]
+    queries = []
+
+    def load_page():
+        page, page_queries = load()
+        queries.extend(page_queries)
+        return page
+
+    page, hit = cache.get_or_load(key, load_page)
+    response = json_response({**page, "queries": queries})
+    response.headers["X-Cache"] = "HIT" if hit else "MISS"
+    return response
+
+
 @book_namespace.route("/categories")
 class Categories(Resource):
     def get(self):
-        stmt = "SELECT category.id, category.name \nFROM category"
-        categories = session.execute(text(stmt)).mappings().all()
-        categories = [pmd.ListCategorySchema.model_validate(category) for category in categories]
-        return jsonify(
-            {
-                "categories": [category.model_dump() for category in categories],
-                "queries": [sql_compile(stmt)],
-            }
-        )
+        def load():
+            stmt = qs.CATEGORIES
+            categories = session.execute(stmt).mappings().all()
+            page = {"categories": serialize_rows(pmd.ListCategorySchema, categories)}
+            return page, [sql_compile(stmt)]
+
+        return cached_catalog("categories", load)
 
 
 @book_namespace.route("/categories/<int:category_id>")
@@ -57,86 +96,133 @@ class Category(Resource):
     @jwt_required(optional=True)
     def get(self, category_id):
         detail = False
-        stmt = "SELECT category.id, category.name, category.added_by_id, book.id AS book_id, book.author, book.is_available, book.location, book.title"
+        stmt = qs.CATEGORY
         if request.args.get("detail") == "true" and current_user and current_user.role == "admin":
             detail = True
-            stmt += """,user_account.id AS added_by_user_id, user_account.first_name || ' ' || user_account.last_name AS category_added_by
-                FROM category
-                LEFT OUTER JOIN user_account ON user_account.id = category.added_by_id
-                LEFT OUTER JOIN book ON category.id = book.category_id"""
-        else:
-            stmt += "\nFROM category \n LEFT OUTER JOIN book ON category.id = book.category_id"
-        stmt += f" \nWHERE category.id = {category_id}"
-        category = session.execute(text(stmt)).mappings().all()
-        organized_data = {
-            "id": None,
-            "name": None,
-            "added_by_id": None,
-            "books": [],
-        }
-        if detail:
-            organized_data["category_added_by"] = None
-
-        for row in category:
-            if organized_data["id"] is None:
-                organized_data["id"] = row.id
-                organized_data["name"] = row.name
-                organized_data["added_by_id"] = row.added_by_id
-                if detail:
-                    organized_data["category_added_by"] = row.category_added_by
-
-            if row.book_id is not None:
-                organized_data["books"].append(
-                    {
-                        "id": row.book_id,
-                        "author": row.author,
-                        "is_available": row.is_available,
-                        "location": row.location,
-                        "title": row.title,
-                    }
-                )
-
-        return jsonify({"category": organized_data, "queries": [sql_compile(stmt)]})
+            stmt = qs.CATEGORY_DETAIL
+
+        def load():
+            category = session.execute(stmt, {"category_id": category_id}).mappings().all()
+            organized_data = {
+                "id": None,
+                "name": None,
+                "added_by_id": None,
+                "books": [],
+            }
+            if detail:
+                organized_data["category_added_by"] = None
+
+            for row in category:
+                if organized_data["id"] is None:
+                    organized_data["id"] = row.id
+                    organized_data["name"] = row.name
+                    organized_data["added_by_id"] = row.added_by_id
+                    if detail:
+                        organized_data["category_added_by"] = row.category_added_by
+
+                if row.book_id is not None:
+                    organized_data["books"].append(
+                        {
+                            "id": row.book_id,
+                            "author": row.author,
+                            "is_available": row.is_available,
+                            "location": row.location,
+                            "title": row.title,
+                        }
+                    )
+            return {"category": organized_data}, [sql_compile(stmt)]
+
+        return cached_catalog(("category", category_id, detail), load)
+
+
+@book_namespace.route("/catalog-cache")
+class CatalogCacheStats(Resource):
+    @admin_required
+    def get(self):
+        """Hits, misses and size of this process's category page cache."""
+        return jsonify(current_app.extensions["catalog_cache"].stats())
 
 
 @book_namespace.route("/books")
 class Books(Resource):
     def get(self):
-        stmt = """SELECT book.id, book.title, book.author, book.isbn, book.category_id, book.original_quantity, book.current_quantity, book.date_added, book.added_by_id, book.is_available, book.location, category.name as book_category
+        limit, cursor = page_args()
+        stmt = """SELECT book.id, book.title, book.author, book.isbn, book.category_id, book.original_quantity, book.current_quantity, book.date_added, book.added_by_id, book.is_available, book.location, category.name as book_category"""
+        from_stmt = """
         FROM book JOIN category ON category.id = book.category_id
         """
-        title = request.args.get("title")
+        params = {"limit": limit + 1}
         or_list = []
-        if title:
-            # or_list.append(md.Book.title.ilike(f"%{title}%"))
-            or_list.append(f"lower(book.title) LIKE lower('%{title}%')")
+        order_keys = [("book.title", False), ("book.id", False)]
 
+        # Title and author go through the full-text index, ranked by relevance
+        title = request.args.get("title")
         author = request.args.get("author")
-        if author:
-            # or_list.append(md.Book.author.ilike(f"%{author}%"))
-            or_list.append(f"lower(book.author) LIKE lower('%{author}%')")
+        if config.DB == "postgres":
+            search = tsquery_expression(title=title, author=author)
+            search_stmt = """LEFT OUTER JOIN (
+                SELECT book.id AS book_id, ts_rank(book.search_vector, query) AS rank
+                FROM book, to_tsquery('simple', :search) AS query
+                WHERE book.search_vector @@ query
+            ) AS search ON search.book_id = book.id
+            """
+            rank_key = ("COALESCE(search.rank, 0)", True)
+        else:
+            search = fts_match_expression(title=title, author=author)
+            search_stmt = """LEFT OUTER JOIN (
+                SELECT rowid AS book_id, bm25(book_fts, 10.0, 5.0) AS rank
+                FROM book_fts WHERE book_fts MATCH :search
+            ) AS search ON search.book_id = book.id
+            """
+            rank_key = (
+                "COALESCE(search.rank, 0)",
+                False,
+            )  # bm25 scores are negative, lower is better
+
+        if search:
+            stmt += f", {rank_key[0]} AS search_rank"
+            from_stmt += search_stmt
+            params["search"] = search
+            or_list.append("search.book_id IS NOT NULL")
+            order_keys.insert(0, rank_key)
 
         isbn = request.args.get("isbn")
         if isbn:
-            # or_list.append(md.Book.isbn.ilike(f"%{isbn}%"))
-            or_list.append(f"lower(book.isbn) LIKE ('%{isbn}%')")
+            params["isbn"] = f"%{isbn.lower()}%"
+            or_list.append("lower(book.isbn) LIKE :isbn")
 
         category = request.args.get("category")
         if category:
-            # or_list.append(md.Category.name == category)
-            or_list.append(f"category.name = '{category}'")
+            params["category"] = category
+            or_list.append("category.name = :category")
 
+        stmt += from_stmt
+        where = []
         if or_list:
-            stmt = stmt + " WHERE " + " OR ".join(or_list)
+            where.append("(" + " OR ".join(or_list) + ")")
 
-        stmt += " ORDER BY book.title ASC"
+        if cursor:
+            cursor_stmt, cursor_params = keyset_sql(order_keys, cursor)
+            where.append(cursor_stmt)
+            params.update(cursor_params)
 
-        books = session.execute(text(stmt)).mappings().all()
-        books = [pmd.ListBookSchema.model_validate(book) for book in books]
-        return make_response(
-            jsonify(
-                {"books": [book.model_dump() for book in books], "queries": [sql_compile(stmt)]}
-            )
+        if where:
+            stmt = stmt + " WHERE " + " AND ".join(where)
+
+        stmt += f" ORDER BY {order_sql(order_keys)} LIMIT :limit"
+
+        books = session.execute(text(stmt), params).mappings().all()
+        books, next_cursor = paginate(
+            books,
+            limit,
+            lambda book: ([book.search_rank] if search else []) + [book.title, book.id],
+        )
+        return json_response(
+            {
+                "books": serialize_rows(pmd.ListBookSchema, books),
+                "next_cursor": next_cursor,
+                "queries": [sql_compile(stmt)],
+            }
         )
 
     @admin_required
@@ -144,15 +230,41 @@ class Books(Resource):
     @book_namespace.expect(new_book_input)
     def post(self):
         data = request.json
-        stmt = f"""INSERT INTO book (title, author, isbn, category_id, original_quantity, current_quantity, date_added, added_by_id, is_available, location)
-            VALUES ('{data["title"]}', '{data["author"]}', '{data["isbn"]}', {data["category_id"]}, {data["quantity"]}, '{data["quantity"]}', '{datetime.now()}', {current_user.id}, 1, '{data["location"]}')
-        """
-        queries = [stmt]
-        session.execute(text(stmt))
-        stmt = "SELECT id FROM book ORDER BY id DESC LIMIT 1"
-        queries.append(stmt)
-        book = session.execute(text(stmt)).mappings().first()
-        return make_response(jsonify(book_id=book.id, queries=queries), HTTPStatus.CREATED)
+        stmt = qs.INSERT_BOOK
+        params = {name: data[name] for name in new_book_input.keys()}
+        params.update(
+            isbn=pmd.normalize_isbn(params["isbn"]),
+            date_added=datetime.now(),
+            added_by_id=current_user.id,
+        )
+        book_id = session.execute(stmt, params).scalar_one()
+        invalidate_catalog(session)
+        return make_response(
+            jsonify(book_id=book_id, queries=[sql_compile(stmt)]), HTTPStatus.CREATED
+        )
+
+
+@book_namespace.route("/books/import")
+class BookImport(Resource):
+    @admin_required
+    @book_namespace.doc(
+        params={"format": f"The feed format, one of {', '.join(IMPORT_FORMATS)}"},
+        description="Upsert books by ISBN from a CSV or newline delimited JSON request body, "
+        "with the columns of POST /books. Invalid rows are reported and skipped.",
+    )
+    def post(self):
+        fmt = request.args.get("format") or next(
+            (name for name, mimetype in IMPORT_FORMATS.items() if mimetype == request.mimetype),
+            None,
+        )
+        if fmt not in IMPORT_FORMATS:
+            return make_response(
+                jsonify(error=f"Send the feed as one of {', '.join(IMPORT_FORMATS.values())}"),
+                HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+            )
+        result = import_books(session, read_feed(request.stream, fmt), current_user.id, config.DB)
+        # The ids of the books created and updated, and why each rejected line was rejected
+        return make_response(jsonify(result), HTTPStatus.OK)
 
 
 @book_namespace.route("/books/<int:book_id>")
@@ -161,16 +273,12 @@ class Book(Resource):
     @jwt_required(optional=True)
     def get(self, book_id):
         detail = False
-        stmt = "SELECT book.id, book.title, book.author, book.isbn, book.category_id, book.current_quantity, book.is_available, book.location, book.date_added, category.name AS category_name"
+        stmt = qs.BOOK
         if request.args.get("detail") == "true" and current_user and current_user.role == "admin":
             detail = True
-            stmt += ",     book.original_quantity, book.added_by_id, added_by.first_name AS added_by_first_name, added_by.last_name AS added_by_last_name, borrow.borrow_date, borrow.due_date, borrow.is_returned, borrowed_by.first_name AS borrowed_by_first_name, borrowed_by.last_name AS borrowed_by_last_name"
-            stmt += "\nFROM book \n JOIN category ON category.id = book.category_id \n JOIN user_account AS added_by ON added_by.id = book.added_by_id \n LEFT OUTER JOIN borrow ON book.id = borrow.book_id \n LEFT OUTER JOIN user_account AS borrowed_by ON borrowed_by.id = borrow.borrowed_by_id"
-        else:
-            stmt += "\nFROM book \n JOIN category ON category.id = book.category_id"
-        stmt += f"\nWHERE book.id = {book_id}"
+            stmt = qs.BOOK_DETAIL
 
-        book = session.execute(text(stmt)).mappings().all()
+        book = session.execute(stmt, {"book_id": book_id}).mappings().all()
         data = {
             "id": None,
             "author": None,
@@ -220,14 +328,16 @@ class Book(Resource):
     @atomic_transaction
     def put(self, book_id):
         # Get the fields to update from the request
-        update_data = []
+        update_data = {}
         field_names = list(update_book_input.keys())
         for name in field_names:
             if name in request.json:
                 if name == "quantity":
-                    update_data.append(f"current_quantity={request.json[name]}")
+                    update_data["current_quantity"] = request.json[name]
+                elif name == "isbn":
+                    update_data[name] = pmd.normalize_isbn(request.json[name])
                 else:
-                    update_data.append(f"{name}='{request.json[name]}'")
+                    update_data[name] = request.json[name]
 
         # If no fields to update, return an error
         if not update_data:
@@ -236,11 +346,20 @@ class Book(Resource):
             )
 
         # Build the update statement dynamically
-        update_stmt = f"UPDATE book SET {', '.join(update_data)} WHERE id={book_id}"
-        queries = [sql_compile(update_stmt)]
-        result = session.execute(text(update_stmt))
+        update_stmt = qs.update_statement("book", tuple(update_data))
+        queries = []
+        if "category_id" in update_data:
+            # The book's borrows move to the counts of its new category
+            queries.extend(shift_rollups(session, config.DB, -1, "book_id", [book_id]))
+        queries.append(sql_compile(update_stmt))
+        result = session.execute(update_stmt, {**update_data, "id": book_id})
         if result.rowcount == 0:
             return make_response(jsonify(error="Book not found"), 404)
+        if "category_id" in update_data:
+            queries.extend(shift_rollups(session, config.DB, 1, "book_id", [book_id]))
+        if "current_quantity" in update_data:
+            queries.extend(serve_waiting_holds(session, [book_id], datetime.now()))
+        invalidate_catalog(session)
         return make_response(
             jsonify(message="Book updated successfully", queries=queries), HTTPStatus.OK
         )
@@ -248,17 +367,18 @@ class Book(Resource):
     @admin_required
     @atomic_transaction
     def delete(self, book_id):
-        stmt = f"SELECT id FROM book WHERE id = {book_id}"
-        queries = [stmt]
-        book_exists = session.execute(text(stmt)).mappings().first()
+        params = {"book_id": book_id}
+        stmt = qs.BOOK_EXISTS
+        queries = [sql_compile(stmt)]
+        book_exists = session.execute(stmt, params).mappings().first()
         if not book_exists:
             return make_response(
                 jsonify(error="Book not found", queries=queries), HTTPStatus.NOT_FOUND
             )
 
-        stmt = f"SELECT EXISTS (SELECT 1 FROM borrow WHERE borrow.book_id = {book_id}) AS borrow_exists"
+        stmt = qs.BOOK_HAS_BORROWS
         queries.append(sql_compile(stmt))
-        borrow_exists = book_exists = session.execute(text(stmt)).mappings().first()
+        borrow_exists = session.execute(stmt, params).mappings().first()
         if borrow_exists["borrow_exists"]:
             return make_response(
                 jsonify(
@@ -268,9 +388,10 @@ class Book(Resource):
                 HTTPStatus.BAD_REQUEST,
             )
 
-        stmt = f"DELETE FROM book WHERE book.id = {book_id}"
-        queries.append(stmt)
-        session.execute(text(stmt))
+        stmt = qs.DELETE_BOOK
+        queries.append(sql_compile(stmt))
+        session.execute(stmt, params)
+        invalidate_catalog(session)
         return make_response(
             jsonify(message="Book deleted successfully", queries=queries), HTTPStatus.OK
         )
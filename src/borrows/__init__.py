@@ -1,3 +1,4 @@
+from collections import defaultdict
 from datetime import datetime
 from http import HTTPStatus
 from uuid import uuid4
@@ -5,16 +6,31 @@ from uuid import uuid4
 from flask import jsonify, make_response, request
 from flask_jwt_extended import current_user, jwt_required
 from flask_restx import Namespace, Resource, fields
-from sqlalchemy import and_, func, select, text, update
+from sqlalchemy import and_, bindparam, select, text, update
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
 
 import src.models as md
 import src.p_models as pmd
+import src.queries as qs
 from src.auth.oauth import admin_required
 from src.utils import (
+    MAX_BATCH_ITEMS,
     PAYMENT_METHODS,
     atomic_transaction,
-    calculate_due_date,
     check_overdue_and_create_fine,
+    checkout_book,
+    checkout_books,
+    fine_totals,
+    json_response,
+    keyset_select,
+    keyset_sql,
+    order_sql,
+    page_args,
+    paginate,
+    record_return,
+    release_copy,
+    return_books,
+    serialize_rows,
     session,
     sql_compile,
 )
@@ -37,6 +53,21 @@ return_book_input = borrow_namespace.model(
     },
 )
 
+borrow_batch_input = borrow_namespace.model(
+    "BorrowBatchInput",
+    {
+        "borrower_id": fields.Integer(required=True, description="Borrower ID"),
+        "book_ids": fields.List(fields.Integer, required=True, description="Book IDs"),
+    },
+)
+
+return_batch_input = borrow_namespace.model(
+    "ReturnBatchInput",
+    {
+        "borrow_ids": fields.List(fields.Integer, required=True, description="Borrow IDs"),
+    },
+)
+
 pay_fine_input = borrow_namespace.model(
     "PayFineInput",
     {
@@ -56,44 +87,55 @@ class BorrowBook(Resource):
     @atomic_transaction
     def post(self):
         data = request.json
-        book_id = data["book_id"]
-        borrower_id = data["borrower_id"]
-        stmt = f"SELECT COUNT(*) AS borrow_count FROM borrow WHERE borrowed_by_id = {borrower_id}"
-        queries = [stmt]
-        borrow_count = session.execute(text(stmt)).mappings().first()
-        if borrow_count["borrow_count"] >= 5:
-            return make_response(
-                jsonify(
-                    error="Borrower has reached the maximum limit of 5 borrowed books",
-                    queries=queries,
-                ),
-                HTTPStatus.BAD_REQUEST,
-            )
+        error, queries = checkout_book(data["book_id"], data["borrower_id"], current_user.id)
+        if error:
+            message, status = error
+            return make_response(jsonify(error=message, queries=queries), status)
 
-        stmt = select(md.Book.id, md.Book.current_quantity).where(md.Book.id == book_id)
-        stmt = f"SELECT id, current_quantity FROM book WHERE id = {book_id}"
-        queries.append(stmt)
-        book = session.execute(text(stmt)).mappings().first()
-        if not book:
-            return make_response(
-                jsonify(error="Book not found", queries=queries), HTTPStatus.NOT_FOUND
-            )
+        return make_response(
+            jsonify(message="Book borrowed successfully", queries=queries), HTTPStatus.CREATED
+        )
 
-        if book.current_quantity == 0:
-            return make_response(
-                jsonify(error="Book is out of stock or is borrowed", queries=queries),
-                HTTPStatus.BAD_REQUEST,
-            )
 
-        due_date = calculate_due_date()
-        stmt = f"INSERT INTO borrow (book_id, borrowed_by_id, given_by_id, borrow_date, due_date) VALUES ({book_id}, {borrower_id}, {current_user.id}, CURRENT_TIMESTAMP, '{due_date}')"
-        queries.append(stmt)
-        session.execute(text(stmt))
-        stmt = f"UPDATE book SET current_quantity = current_quantity - 1 WHERE id = {book_id}"
-        queries.append(stmt)
-        session.execute(text(stmt))
+def batch_ids(data, key):
+    """The list of ids a batch request names, or an error response."""
+    ids = data.get(key)
+    if (
+        not isinstance(ids, list)
+        or not ids
+        or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)
+    ):
+        error = f"`{key}` must be a non-empty list of ids"
+    elif len(ids) > MAX_BATCH_ITEMS:
+        error = f"A batch may list at most {MAX_BATCH_ITEMS} items"
+    else:
+        return ids, None
+    return None, make_response(jsonify(error=error, queries=[]), HTTPStatus.BAD_REQUEST)
+
+
+@borrow_namespace.route("/borrow-book/batch")
+class BorrowBatch(Resource):
+    @borrow_namespace.expect(borrow_batch_input)
+    @admin_required
+    @atomic_transaction
+    def post(self):
+        data = request.json
+        book_ids, response = batch_ids(data, "book_ids")
+        if response:
+            return response
+        error, results, queries = checkout_books(book_ids, data["borrower_id"], current_user.id)
+        if error:
+            message, status = error
+            return make_response(jsonify(error=message, queries=queries), status)
+
+        borrowed = sum("borrow_id" in result for result in results)
         return make_response(
-            jsonify(message="Book borrowed successfully", queries=queries), HTTPStatus.CREATED
+            jsonify(
+                message=f"{borrowed} of {len(results)} books borrowed",
+                results=results,
+                queries=queries,
+            ),
+            HTTPStatus.OK,
         )
 
 
@@ -105,9 +147,9 @@ class ReturnBook(Resource):
     def post(self):
         data = request.json
         borrow_id = data["borrow_id"]
-        stmt = f"SELECT * FROM borrow WHERE id = {borrow_id};"
-        queries = [stmt]
-        borrow = session.execute(text(stmt)).mappings().first()
+        stmt = qs.BORROW
+        queries = [sql_compile(stmt)]
+        borrow = session.execute(stmt, {"borrow_id": borrow_id}).mappings().first()
         if not borrow:
             return make_response(
                 jsonify(error="Borrow record not found", queries=queries), HTTPStatus.NOT_FOUND
@@ -117,42 +159,84 @@ class ReturnBook(Resource):
                 jsonify(error="Book already returned", queries=queries), HTTPStatus.BAD_REQUEST
             )
         now = datetime.now()
-        stmt = f"UPDATE borrow SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP, received_by_id = {current_user.id} WHERE id = {borrow_id};"
-        queries.append(stmt)
-        session.execute(text(stmt))
-        stmt = (
-            f"UPDATE book SET current_quantity = current_quantity + 1 WHERE id = {borrow.book_id};"
-        )
-        queries.append(stmt)
-        session.execute(text(stmt))
+        # Settle the fine while the borrow still counts as unreturned
         overdue_query = check_overdue_and_create_fine(borrow, now, commit=False)
         if overdue_query:
             queries.extend(list(overdue_query))
 
+        stmt = qs.MARK_RETURNED
+        queries.append(sql_compile(stmt))
+        if not session.execute(
+            stmt, {"borrow_id": borrow_id, "received_by_id": current_user.id}
+        ).rowcount:
+            # Returned by a concurrent request since it was read above
+            return make_response(
+                jsonify(error="Book already returned", queries=queries), HTTPStatus.BAD_REQUEST
+            )
+        queries.append(sql_compile(qs.END_LOAN))
+        session.execute(qs.END_LOAN, {"user_id": borrow.borrowed_by_id})
+        # Back on the shelf, or to the next patron holding the book
+        queries.extend(release_copy(session, borrow.book_id, now))
+        queries.append(sql_compile(record_return(session, borrow_id, borrow.borrow_date)))
         session.commit()
         return make_response(
             jsonify(message="Book returned successfully", queries=queries), HTTPStatus.OK
         )
 
 
+@borrow_namespace.route("/return-book/batch")
+class ReturnBatch(Resource):
+    @borrow_namespace.expect(return_batch_input)
+    @admin_required
+    @atomic_transaction
+    def post(self):
+        borrow_ids, response = batch_ids(request.json, "borrow_ids")
+        if response:
+            return response
+        results, queries = return_books(borrow_ids, current_user.id)
+        returned = sum("error" not in result for result in results)
+        return make_response(
+            jsonify(
+                message=f"{returned} of {len(results)} books returned",
+                results=results,
+                queries=queries,
+            ),
+            HTTPStatus.OK,
+        )
+
+
 @borrow_namespace.route("/borrows")
 class Borrows(Resource):
     @jwt_required()
     def get(self):
-        stmt = f"""SELECT borrow.id AS borrow_id, borrow.borrowed_by_id, borrow.received_by_id, borrow.given_by_id, borrow.is_returned, borrow.due_date, borrow.borrow_date, user_account.first_name as borrowed_by_first_name, user_account.last_name as borrowed_by_last_name, given_by.first_name as given_by_first_name, given_by.last_name as given_by_last_name, received_by.first_name as received_by_first_name, received_by.last_name as received_by_last_name, book.title as book_title
+        limit, cursor = page_args()
+        params = {"user_id": current_user.id, "limit": limit + 1}
+        stmt = """SELECT borrow.id AS borrow_id, borrow.borrowed_by_id, borrow.received_by_id, borrow.given_by_id, borrow.is_returned, borrow.due_date, borrow.borrow_date, user_account.first_name as borrowed_by_first_name, user_account.last_name as borrowed_by_last_name, given_by.first_name as given_by_first_name, given_by.last_name as given_by_last_name, received_by.first_name as received_by_first_name, received_by.last_name as received_by_last_name, book.title as book_title
             FROM borrow
             JOIN user_account ON borrow.borrowed_by_id = user_account.id
             JOIN user_account AS given_by ON borrow.given_by_id = given_by.id
             JOIN user_account AS received_by ON borrow.received_by_id = received_by.id
             JOIN book ON borrow.book_id = book.id
-        WHERE borrowed_by_id = {current_user.id}"""
+        WHERE borrowed_by_id = :user_id"""
+        order_keys = [("borrow.id", False)]
+        if cursor:
+            cursor_stmt, cursor_params = keyset_sql(order_keys, cursor)
+            stmt += f" AND {cursor_stmt}"
+            params.update(cursor_params)
+        stmt += f" ORDER BY {order_sql(order_keys)} LIMIT :limit"
         queries = [sql_compile(stmt)]
-        borrows = session.execute(text(stmt)).mappings().all()
-        fines = tuple()
+        borrows = session.execute(text(stmt), params).mappings().all()
+        borrows, next_cursor = paginate(borrows, limit, lambda borrow: [borrow.borrow_id])
+        fines = defaultdict(list)
         if borrows:
-            stmt = f"SELECT id, amount, paid, date_created, date_paid FROM fine WHERE borrow_id IN (SELECT id FROM borrow WHERE borrowed_by_id = {current_user.id})"
-            queries.append(stmt)
-            fines = session.execute(text(stmt)).mappings().all()
+            # Only the fines of the borrows on this page
+            stmt = text(
+                "SELECT id, borrow_id, amount, paid, date_created, date_paid FROM fine WHERE borrow_id IN :borrow_ids"
+            ).bindparams(bindparam("borrow_ids", expanding=True))
+            queries.append(sql_compile(stmt.text))
+            borrow_ids = [borrow.borrow_id for borrow in borrows]
+            for fine in session.execute(stmt, {"borrow_ids": borrow_ids}).mappings():
+                fines[fine.borrow_id].append(fine)
 
         data = [
             {
@@ -171,7 +255,7 @@ class Borrows(Resource):
                             datetime.fromisoformat(fine.date_paid) if fine.date_paid else None
                         ),
                     }
-                    for fine in fines
+                    for fine in fines[borrow.borrow_id]
                 ],
                 "borrowed_by": f"{borrow.borrowed_by_first_name} {borrow.borrowed_by_last_name}",
                 "given_by": f"{borrow.given_by_first_name} {borrow.given_by_last_name}",
@@ -184,6 +268,7 @@ class Borrows(Resource):
             jsonify(
                 {
                     "borrows": data,
+                    "next_cursor": next_cursor,
                     "queries": queries,
                 }
             )
@@ -194,24 +279,19 @@ class Borrows(Resource):
 class Borrow(Resource):
     @jwt_required()
     def get(self, borrow_id):
-        stmt = f"""SELECT borrow.id AS borrow_id, borrow.borrowed_by_id, borrow.received_by_id, borrow.given_by_id, borrow.is_returned, borrow.due_date, borrow.borrow_date, user_account.first_name as borrowed_by_first_name, user_account.last_name as borrowed_by_last_name, given_by.first_name as given_by_first_name, given_by.last_name as given_by_last_name, received_by.first_name as received_by_first_name, received_by.last_name as received_by_last_name, book.title as book_title
-            FROM borrow
-            JOIN user_account ON borrow.borrowed_by_id = user_account.id
-            JOIN user_account AS given_by ON borrow.given_by_id = given_by.id
-            JOIN user_account AS received_by ON borrow.received_by_id = received_by.id
-            JOIN book ON borrow.book_id = book.id
-        WHERE borrowed_by_id = {current_user.id} AND borrow.id = {borrow_id}"""
+        params = {"user_id": current_user.id, "borrow_id": borrow_id}
+        stmt = qs.USER_BORROW
         queries = [sql_compile(stmt)]
-        borrow = session.execute(text(stmt)).mappings().first()
+        borrow = session.execute(stmt, params).mappings().first()
         fines = tuple()
         if not borrow:
             return make_response(
                 jsonify(error="Borrow record not found", queries=[sql_compile(stmt)]),
                 HTTPStatus.NOT_FOUND,
             )
-        stmt = f"SELECT id, amount, paid, date_created, date_paid FROM fine WHERE borrow_id IN (SELECT id FROM borrow WHERE borrowed_by_id = {current_user.id})"
-        queries.append(stmt)
-        fines = session.execute(text(stmt)).mappings().all()
+        stmt = qs.USER_FINES
+        queries.append(sql_compile(stmt))
+        fines = session.execute(stmt, params).mappings().all()
         data = {
             "id": borrow.borrow_id,
             "borrowed_book": borrow.book_title,
@@ -243,17 +323,28 @@ class BorrowsAdmin(Resource):
     @admin_required
     @borrow_namespace.doc(params={"user_id": "User ID"})
     def get(self, user_id):
-        stmt = select(md.Borrow).where(md.Borrow.borrowed_by_id == user_id)
-        borrows = session.execute(stmt).scalars().all()
-        borrows = [pmd.ListBorrowSchema.model_validate(borrow) for borrow in borrows]
-        return make_response(
-            jsonify(
-                {
-                    "borrows": [borrow.model_dump() for borrow in borrows],
-                    "queries": [sql_compile(stmt)],
-                }
+        limit, cursor = page_args()
+        stmt = (
+            select(md.Borrow)
+            .where(md.Borrow.borrowed_by_id == user_id)
+            .options(
+                joinedload(md.Borrow.borrowed_book),
+                joinedload(md.Borrow.borrowed_by),
+                joinedload(md.Borrow.given_by),
+                joinedload(md.Borrow.received_by),
+                selectinload(md.Borrow.fines),
             )
         )
+        stmt = keyset_select(stmt, [(md.Borrow.id, False)], cursor, limit)
+        borrows = session.execute(stmt).scalars().all()
+        borrows, next_cursor = paginate(borrows, limit, lambda borrow: [borrow.id])
+        return json_response(
+            {
+                "borrows": serialize_rows(pmd.ListBorrowSchema, borrows),
+                "next_cursor": next_cursor,
+                "queries": [sql_compile(stmt)],
+            }
+        )
 
 
 @borrow_namespace.route("/borrows-admin/<int:user_id>/<int:borrow_id>")
@@ -280,48 +371,39 @@ class BorrowAdmin(Resource):
 class Fines(Resource):
     @jwt_required()
     def get(self):
-        stmt = select(md.Fine).where(
-            md.Fine.borrow.has(md.Borrow.borrowed_by_id == current_user.id)
+        # A join rather than EXISTS, so the borrower's borrows are found through their index
+        stmt = (
+            select(md.Fine)
+            .join(md.Fine.borrow)
+            .where(md.Borrow.borrowed_by_id == current_user.id)
+            .options(contains_eager(md.Fine.borrow).joinedload(md.Borrow.borrowed_book))
         )
-        # Calculate total fines using the same filters
-        total_query = (
-            select(func.sum(md.Fine.amount).label("total_fines"))
-            .join(md.Borrow, md.Fine.borrow_id == md.Borrow.id)
-            .join(md.UserAccount, md.Borrow.borrowed_by_id == md.UserAccount.id)
-        ).where(md.UserAccount.id == current_user.id)
-
-        queries = []
+        criteria = [md.UserAccount.id == current_user.id]
         status = request.args.get("status")
-        paid_query = total_query.where(md.Fine.paid.is_(True))
-        unpaid_query = total_query.where(md.Fine.paid.is_(False))
-        paid = None
-        unpaid = None
-
         if status == "paid":
-            stmt = stmt.where(md.Fine.paid.is_(True))
-            queries = [sql_compile(paid_query)]
-            paid = session.execute(paid_query).scalar()
+            criteria.append(md.Fine.paid.is_(True))
         elif status == "unpaid":
-            stmt = stmt.where(md.Fine.paid.is_(False))
-            queries = [sql_compile(unpaid_query)]
-            unpaid = session.execute(unpaid_query).scalar()
-        else:
-            paid = session.execute(paid_query).scalar()
-            unpaid = session.execute(unpaid_query).scalar()
-            queries = [sql_compile(stmt), sql_compile(paid_query), sql_compile(unpaid_query)]
+            criteria.append(md.Fine.paid.is_(False))
+        stmt = stmt.where(*criteria[1:])
+
+        # Both totals in one pass, using the same filters
+        total_query = fine_totals(*criteria)
+        queries = [sql_compile(total_query)]
+        paid, unpaid, _ = session.execute(total_query).one()
 
+        limit, cursor = page_args()
+        stmt = keyset_select(stmt, [(md.Fine.id, False)], cursor, limit)
         queries.insert(0, sql_compile(stmt))
         fines = session.execute(stmt).scalars().all()
-        fines = [pmd.FineListSchema.model_validate(fine) for fine in fines]
-        return make_response(
-            jsonify(
-                {
-                    "fines": [fine.model_dump() for fine in fines],
-                    "total_paid": paid,
-                    "total_unpaid": unpaid,
-                    "queries": queries,
-                }
-            )
+        fines, next_cursor = paginate(fines, limit, lambda fine: [fine.id])
+        return json_response(
+            {
+                "fines": serialize_rows(pmd.FineListSchema, fines),
+                "next_cursor": next_cursor,
+                "total_paid": paid,
+                "total_unpaid": unpaid,
+                "queries": queries,
+            }
         )
 
 
@@ -350,16 +432,22 @@ class Fine(Resource):
 class FinesAdmin(Resource):
     @admin_required
     def get(self, user_id):
-        stmt = select(md.Fine).where(md.Fine.borrow.has(md.Borrow.borrowed_by_id == user_id))
+        limit, cursor = page_args()
+        stmt = (
+            select(md.Fine)
+            .join(md.Fine.borrow)
+            .where(md.Borrow.borrowed_by_id == user_id)
+            .options(contains_eager(md.Fine.borrow).joinedload(md.Borrow.borrowed_book))
+        )
+        stmt = keyset_select(stmt, [(md.Fine.id, False)], cursor, limit)
         fines = session.execute(stmt).scalars().all()
-        fines = [pmd.FineListSchema.model_validate(fine) for fine in fines]
-        return make_response(
-            jsonify(
-                {
-                    "fines": [fine.model_dump() for fine in fines],
-                    "queries": [sql_compile(stmt)],
-                }
-            )
+        fines, next_cursor = paginate(fines, limit, lambda fine: [fine.id])
+        return json_response(
+            {
+                "fines": serialize_rows(pmd.FineListSchema, fines),
+                "next_cursor": next_cursor,
+                "queries": [sql_compile(stmt)],
+            }
         )
 
 
@@ -448,8 +536,16 @@ class PayFine(Resource):
                     collected_by_id=current_user.id if current_user.role == "admin" else None,
                 )
             )
+        # Only the request that marks the fine paid takes it off the borrower's balance
+        stmt = stmt.where(md.Fine.paid.is_(False))
         queries.append(sql_compile(stmt))
-        session.execute(stmt)
+        if not session.execute(stmt).rowcount:
+            return make_response(
+                jsonify(error="Fine not found or is already paid", queries=queries),
+                HTTPStatus.NOT_FOUND,
+            )
+        queries.append(sql_compile(qs.SETTLE_BALANCE))
+        session.execute(qs.SETTLE_BALANCE, {"amount": fine.amount, "user_id": fine.borrowed_by_id})
         return make_response(
             jsonify(message="Fine paid successfully", queries=queries), HTTPStatus.OK
         )
@@ -0,0 +1,67 @@
+from datetime import datetime
+from http import HTTPStatus
+
+from flask import jsonify, make_response, request
+from flask_jwt_extended import current_user, jwt_required
+from flask_restx import Namespace, Resource, fields
+
+import src.p_models as pmd
+import src.queries as qs
+from src.utils import (
+    atomic_transaction,
+    cancel_hold,
+    json_response,
+    place_hold,
+    serialize_rows,
+    session,
+    sql_compile,
+)
+
+holds_namespace = Namespace("Holds", description="Hold queue operations", path="/")
+
+place_hold_input = holds_namespace.model(
+    "PlaceHoldInput",
+    {
+        "book_id": fields.Integer(required=True, description="Book ID"),
+    },
+)
+
+
+@holds_namespace.route("/holds")
+class Holds(Resource):
+    @jwt_required()
+    def get(self):
+        stmt = qs.USER_HOLDS
+        holds = session.execute(stmt, {"user_id": current_user.id}).all()
+        return json_response(
+            {"holds": serialize_rows(pmd.HoldListSchema, holds), "queries": [sql_compile(stmt)]}
+        )
+
+    @holds_namespace.expect(place_hold_input)
+    @jwt_required()
+    @atomic_transaction
+    def post(self):
+        error, hold, queries = place_hold(
+            session, request.json["book_id"], current_user.id, datetime.now()
+        )
+        if error:
+            message, status = error
+            return make_response(jsonify(error=message, queries=queries), status)
+        return make_response(
+            jsonify(hold_id=hold.id, position=hold.position, queries=queries), HTTPStatus.CREATED
+        )
+
+
+@holds_namespace.route("/holds/<int:hold_id>")
+@holds_namespace.doc(params={"hold_id": "Hold ID"})
+class Hold(Resource):
+    @jwt_required()
+    @atomic_transaction
+    def delete(self, hold_id):
+        error, queries = cancel_hold(session, hold_id, current_user.id, datetime.now())
+        if error:
+            message, status = error
+            return make_response(jsonify(error=message, queries=queries), status)
+        return make_response(
+            jsonify(message="Hold cancelled successfully", queries=queries), HTTPStatus.OK
+        )
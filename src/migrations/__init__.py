@@ -0,0 +1,11 @@
+"""
+Versioned schema migrations for SQLite and Postgres, recorded in `schema_migrations`.
+
+Add a Migration with the next version to `versions.MIGRATIONS` for every schema change, and
+make the same change to `src.models`; the tests check that a migrated database matches
+the one created from the models.
+"""
+
+from src.migrations.operations import Migration  # noqa: F401
+from src.migrations.runner import applied_migrations, dialect_of, migrate  # noqa: F401
+from src.migrations.versions import MIGRATIONS  # noqa: F401
@@ -0,0 +1,244 @@
+"""
+The steps migrations are made of.
+
+Each step opens its own short transactions, so a populated database is never locked for a
+whole migration, and each one checks for or tolerates what it creates, so an upgrade that
+stopped halfway is finished by running it again. On Postgres, indexes are built
+CONCURRENTLY and constraints are added NOT VALID then validated, neither of which blocks
+writes; statements that do take a table lock give up after LOCK_TIMEOUT instead of queueing
+every writer behind them. SQLite has a single writer, so there a step holds the write lock
+for as long as it runs: an index build is one step, a backfill one batch.
+"""
+
+from sqlalchemy import inspect, text
+
+LOCK_TIMEOUT = "5s"
+BACKFILL_BATCH_SIZE = 5000
+
+INDEX_IS_VALID = text(
+    """SELECT pg_index.indisvalid FROM pg_index
+    JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+    WHERE pg_class.relname = :name"""
+)
+
+
+class Migration:
+    """One version of the schema, the steps that take the previous version to it."""
+
+    def __init__(self, version: int, name: str, *steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+    def __repr__(self):
+        return f"{self.version} {self.name}"
+
+
+def for_dialect(value, dialect: str):
+    """`value` itself, or its entry for the dialect when it is a dict keyed by dialect."""
+    return value.get(dialect) if isinstance(value, dict) else value
+
+
+def set_lock_timeout(conn, dialect: str):
+    if dialect == "postgres":
+        conn.exec_driver_sql(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+
+
+def run_sql(statements):
+    """Run a list of statements, or a dict of them per dialect, in one transaction."""
+
+    def step(engine, dialect):
+        with engine.begin() as conn:
+            set_lock_timeout(conn, dialect)
+            for statement in for_dialect(statements, dialect) or ():
+                conn.exec_driver_sql(statement)
+
+    return step
+
+
+def add_column(table: str, column: str, definition):
+    """
+    Add a column unless it is there. Postgres adds a nullable column, or one with a constant
+    default, without rewriting the table.
+    """
+
+    def step(engine, dialect):
+        ddl = for_dialect(definition, dialect)
+        if ddl is None:
+            return
+        with engine.begin() as conn:
+            if column in {c["name"] for c in inspect(conn).get_columns(table)}:
+                return
+            set_lock_timeout(conn, dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+    return step
+
+
+def create_index(
+    name: str, table: str, columns, where=None, unique=False, using=None, dialect=None
+):
+    """
+    Create an index unless it exists, with an optional partial-index predicate (a string or
+    a dict per dialect). Postgres builds it CONCURRENTLY, first dropping a leftover that an
+    interrupted build marked invalid. `dialect` restricts the index to one backend.
+    """
+
+    def step(engine, current):
+        if dialect is not None and dialect != current:
+            return
+        predicate = for_dialect(where, current)
+        ddl = (
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {{}}IF NOT EXISTS {name} ON {table}"
+            f"{f' USING {using}' if using else ''} ({', '.join(columns)})"
+            f"{f' WHERE {predicate}' if predicate else ''}"
+        )
+        if current == "sqlite":
+            with engine.begin() as conn:
+                conn.exec_driver_sql(ddl.format(""))
+            return
+        # CONCURRENTLY cannot run inside a transaction block
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if conn.execute(INDEX_IS_VALID, {"name": name}).scalar() is False:
+                conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            conn.exec_driver_sql(ddl.format("CONCURRENTLY "))
+
+    return step
+
+
+def drop_index(name: str):
+    def step(engine, dialect):
+        if dialect == "sqlite":
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+            return
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    return step
+
+
+def add_unique(name: str, table: str, columns):
+    """
+    Make `columns` unique unless a unique constraint or index already covers exactly them.
+    Postgres builds the index concurrently and then turns it into the constraint; SQLite
+    cannot add constraints to a table, so there the unique index does the job.
+    """
+    build = create_index(name, table, columns, unique=True)
+
+    def step(engine, dialect):
+        with engine.connect() as conn:
+            inspector = inspect(conn)
+            existing = [c["column_names"] for c in inspector.get_unique_constraints(table)]
+            existing += [i["column_names"] for i in inspector.get_indexes(table) if i["unique"]]
+        if list(columns) in existing:
+            return
+        build(engine, dialect)
+        if dialect == "postgres":
+            with engine.begin() as conn:
+                set_lock_timeout(conn, dialect)
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}"
+                )
+
+    return step
+
+
+def add_check(name: str, table: str, condition: str):
+    """
+    Add a CHECK constraint on Postgres: NOT VALID first, which only locks the table briefly,
+    then validated without blocking writes. SQLite cannot add constraints to a table.
+    """
+
+    def step(engine, dialect):
+        if dialect != "postgres":
+            return
+        with engine.begin() as conn:
+            if name not in {c["name"] for c in inspect(conn).get_check_constraints(table)}:
+                set_lock_timeout(conn, dialect)
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {name} CHECK ({condition}) NOT VALID"
+                )
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+    return step
+
+
+def set_not_null(table: str, column: str):
+    """
+    Make a column NOT NULL on Postgres through a validated check, so SET NOT NULL does not
+    scan the table under its lock. SQLite can only change nullability by rebuilding the
+    table, which is left to the tables created from scratch.
+    """
+    check = f"{table}_{column}_not_null"
+
+    def step(engine, dialect):
+        if dialect != "postgres":
+            return
+        with engine.connect() as conn:
+            columns = {c["name"]: c for c in inspect(conn).get_columns(table)}
+        if not columns[column]["nullable"]:
+            return
+        add_check(check, table, f"{column} IS NOT NULL")(engine, dialect)
+        with engine.begin() as conn:
+            set_lock_timeout(conn, dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")
+            conn.exec_driver_sql(f"ALTER TABLE {table} DROP CONSTRAINT {check}")
+
+    return step
+
+
+def backfill(table: str, statements, reset=None, batch_size: int = None):
+    """
+    Run statements taking :first_id and :last_id over the ids of `table` in batches,
+    committing each, so writers wait for one batch at most. `reset` statements run first,
+    in their own transaction, for backfills that would otherwise count a row twice when an
+    interrupted one is run again.
+    """
+
+    def step(engine, dialect):
+        batch = for_dialect(statements, dialect)
+        if not batch:
+            return
+        size = batch_size or BACKFILL_BATCH_SIZE
+        with engine.begin() as conn:
+            for statement in for_dialect(reset, dialect) or ():
+                conn.exec_driver_sql(statement)
+            first, last = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).one()
+        if first is None:
+            return
+        for first_id in range(first, last + 1, size):
+            with engine.begin() as conn:
+                set_lock_timeout(conn, dialect)
+                for statement in batch:
+                    conn.execute(
+                        text(statement), {"first_id": first_id, "last_id": first_id + size - 1}
+                    )
+
+    return step
+
+
+def update_rows(table: str, select: str, update: str, change, batch_size: int = None):
+    """
+    A backfill for changes simpler to write in Python. `select` picks the rows to change
+    from ids :first_id to :last_id, and `update` runs once per row with the parameters
+    `change(row)` returns. Each batch commits before the next is read.
+    """
+
+    def step(engine, dialect):
+        size = batch_size or BACKFILL_BATCH_SIZE
+        with engine.begin() as conn:
+            first, last = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).one()
+        if first is None:
+            return
+        for first_id in range(first, last + 1, size):
+            with engine.begin() as conn:
+                set_lock_timeout(conn, dialect)
+                rows = conn.execute(
+                    text(select), {"first_id": first_id, "last_id": first_id + size - 1}
+                ).all()
+                for row in rows:
+                    conn.execute(text(update), change(row))
+
+    return step
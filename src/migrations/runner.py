@@ -0,0 +1,77 @@
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from src.migrations.versions import MIGRATIONS
+
+# Any constant, as long as every process migrating the database uses the same one
+MIGRATION_LOCK = 73_001
+
+CREATE_SCHEMA_MIGRATIONS = """CREATE TABLE IF NOT EXISTS schema_migrations (
+	version INTEGER PRIMARY KEY,
+	name VARCHAR(100) NOT NULL,
+	applied_at TIMESTAMP NOT NULL
+)"""
+
+RECORD_MIGRATION = text(
+    """INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)
+    ON CONFLICT (version) DO NOTHING"""
+)
+
+
+def dialect_of(engine) -> str:
+    """The engine's backend, spelled as config.DB spells it."""
+    return "postgres" if engine.dialect.name == "postgresql" else "sqlite"
+
+
+def applied_migrations(engine) -> dict:
+    """The versions applied to the database, mapped to when they were applied."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_SCHEMA_MIGRATIONS)
+        rows = conn.exec_driver_sql("SELECT version, applied_at FROM schema_migrations")
+        return dict(rows.all())
+
+
+def migrate(engine, target: int = None, migrations=MIGRATIONS, log=lambda message: None) -> list:
+    """
+    Apply the migrations the database has not had yet, in version order, up to and
+    including `target` when given. A database created before migrations existed gets them
+    all, and each one skips what is already there.
+
+    Returns:
+        list: The versions applied.
+    """
+    dialect = dialect_of(engine)
+    if dialect != "postgres":
+        return apply_migrations(engine, dialect, target, migrations, log)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        # Released when the connection closes too, so a crashed upgrade does not hold it
+        lock.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK})")
+        try:
+            return apply_migrations(engine, dialect, target, migrations, log)
+        finally:
+            lock.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK})")
+
+
+def apply_migrations(engine, dialect: str, target, migrations, log) -> list:
+    done = applied_migrations(engine)
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done or (target is not None and migration.version > target):
+            continue
+        started = time.perf_counter()
+        for step in migration.steps:
+            step(engine, dialect)
+        with engine.begin() as conn:
+            conn.execute(
+                RECORD_MIGRATION,
+                {
+                    "version": migration.version,
+                    "name": migration.name,
+                    "applied_at": datetime.now(),
+                },
+            )
+        log(f"Applied {migration} in {time.perf_counter() - started:.1f}s")
+        applied.append(migration.version)
+    return applied
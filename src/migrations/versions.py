@@ -0,0 +1,418 @@
+"""
+The schema's history, one Migration per change, oldest first. Never edit a migration that
+has shipped: databases that already have it will not run it again.
+"""
+
+from sql import SEARCH_POSTGRES_BACKFILL, SEARCH_POSTGRES_TRIGGER, SEARCH_SQLITE
+from src.migrations.operations import (
+    Migration,
+    add_check,
+    add_column,
+    add_unique,
+    backfill,
+    create_index,
+    drop_index,
+    run_sql,
+    set_not_null,
+    update_rows,
+)
+
+INITIAL_TABLES = {
+    "sqlite": [
+        """CREATE TABLE IF NOT EXISTS "user_account" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	email TEXT NOT NULL CHECK (LENGTH(email) <= 50),
+	first_name TEXT NOT NULL CHECK (LENGTH(first_name) <= 20),
+	last_name TEXT NOT NULL CHECK (LENGTH(last_name) <= 20),
+	password TEXT NOT NULL,
+	is_active BOOLEAN DEFAULT 1 NOT NULL,
+	role TEXT DEFAULT 'student' NOT NULL CHECK (role IN ('student', 'admin', 'external') AND LENGTH(role) <= 20),
+	UNIQUE (email)
+)""",
+        """CREATE TABLE IF NOT EXISTS "category" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	name TEXT NOT NULL CHECK (LENGTH(name) <= 20),
+	added_by_id INTEGER NOT NULL,
+	UNIQUE (name),
+	FOREIGN KEY(added_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "book" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	title TEXT NOT NULL CHECK (LENGTH(title) <= 100),
+	author TEXT NOT NULL CHECK (LENGTH(author) <= 50),
+	isbn TEXT NOT NULL CHECK (LENGTH(isbn) <= 25),
+	category_id INTEGER NOT NULL,
+	original_quantity INTEGER DEFAULT '1' NOT NULL,
+	current_quantity INTEGER DEFAULT '1' NOT NULL,
+	date_added DATETIME NOT NULL,
+	added_by_id INTEGER NOT NULL,
+	is_available BOOLEAN DEFAULT 1 NOT NULL,
+	location TEXT DEFAULT 'shelf' NOT NULL CHECK (LENGTH(location) <= 20),
+	UNIQUE (isbn),
+	FOREIGN KEY(category_id) REFERENCES category (id),
+	FOREIGN KEY(added_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "borrow" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	book_id INTEGER NOT NULL,
+	borrowed_by_id INTEGER NOT NULL,
+	given_by_id INTEGER NOT NULL,
+	received_by_id INTEGER,
+	borrow_date DATETIME NOT NULL,
+	due_date DATETIME NOT NULL,
+	return_date DATETIME,
+	comments TEXT,
+	is_returned BOOLEAN DEFAULT 0 NOT NULL,
+	FOREIGN KEY(book_id) REFERENCES book (id),
+	FOREIGN KEY(borrowed_by_id) REFERENCES user_account (id),
+	FOREIGN KEY(given_by_id) REFERENCES user_account (id),
+	FOREIGN KEY(received_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "fine" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	borrow_id INTEGER NOT NULL,
+	amount REAL NOT NULL,
+	paid BOOLEAN DEFAULT 0 NOT NULL,
+	date_created DATETIME NOT NULL,
+	date_paid DATETIME,
+	payment_method TEXT CHECK (LENGTH(payment_method) <= 15),
+	transaction_id TEXT CHECK (LENGTH(transaction_id) <= 100),
+	collected_by_id INTEGER,
+	UNIQUE (borrow_id),
+	UNIQUE (transaction_id),
+	FOREIGN KEY(borrow_id) REFERENCES borrow (id),
+	FOREIGN KEY(collected_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "notification" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	user_id INTEGER NOT NULL,
+	message TEXT NOT NULL,
+	sent_date DATETIME NOT NULL,
+	is_read BOOLEAN DEFAULT 0 NOT NULL,
+	FOREIGN KEY(user_id) REFERENCES user_account (id)
+)""",
+    ],
+    "postgres": [
+        """CREATE TABLE IF NOT EXISTS "user_account" (
+	id SERIAL PRIMARY KEY,
+	email VARCHAR(50) NOT NULL,
+	first_name VARCHAR(20) NOT NULL,
+	last_name VARCHAR(20) NOT NULL,
+	password VARCHAR NOT NULL,
+	is_active BOOLEAN DEFAULT '1' NOT NULL,
+	role VARCHAR(20) DEFAULT 'student' NOT NULL,
+	CONSTRAINT user_account_role_check CHECK (role IN ('student', 'admin', 'external')),
+	UNIQUE (email)
+)""",
+        """CREATE TABLE IF NOT EXISTS "category" (
+	id SERIAL PRIMARY KEY,
+	name VARCHAR(20) NOT NULL,
+	added_by_id INTEGER NOT NULL,
+	UNIQUE (name),
+	FOREIGN KEY(added_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "book" (
+	id SERIAL PRIMARY KEY,
+	title VARCHAR(100) NOT NULL,
+	author VARCHAR(50) NOT NULL,
+	isbn VARCHAR(25) NOT NULL,
+	category_id INTEGER NOT NULL,
+	original_quantity INTEGER DEFAULT '1' NOT NULL,
+	current_quantity INTEGER DEFAULT '1' NOT NULL,
+	date_added TIMESTAMP NOT NULL,
+	added_by_id INTEGER NOT NULL,
+	is_available BOOLEAN DEFAULT '1' NOT NULL,
+	location VARCHAR(20) DEFAULT 'shelf' NOT NULL,
+	UNIQUE (isbn),
+	FOREIGN KEY(category_id) REFERENCES category (id),
+	FOREIGN KEY(added_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "borrow" (
+	id SERIAL PRIMARY KEY,
+	book_id INTEGER NOT NULL,
+	borrowed_by_id INTEGER NOT NULL,
+	given_by_id INTEGER NOT NULL,
+	received_by_id INTEGER,
+	borrow_date TIMESTAMP NOT NULL,
+	due_date TIMESTAMP NOT NULL,
+	return_date TIMESTAMP,
+	comments VARCHAR,
+	is_returned BOOLEAN DEFAULT '0' NOT NULL,
+	FOREIGN KEY(book_id) REFERENCES book (id),
+	FOREIGN KEY(borrowed_by_id) REFERENCES user_account (id),
+	FOREIGN KEY(given_by_id) REFERENCES user_account (id),
+	FOREIGN KEY(received_by_id) REFERENCES user_account (id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "fine" (
+	id SERIAL PRIMARY KEY,
+	borrow_id INTEGER NOT NULL,
+	amount FLOAT NOT NULL,
+	paid BOOLEAN DEFAULT '0' NOT NULL,
+	date_created TIMESTAMP NOT NULL,
+	date_paid TIMESTAMP,
+	payment_method VARCHAR(15),
+	transaction_id VARCHAR(100),
+	collected_by_id INTEGER,
+	FOREIGN KEY(borrow_id) REFERENCES borrow (id),
+	FOREIGN KEY(collected_by_id) REFERENCES user_account (id),
+	UNIQUE (transaction_id),
+	UNIQUE (borrow_id)
+)""",
+        """CREATE TABLE IF NOT EXISTS "notification" (
+	id SERIAL PRIMARY KEY,
+	user_id INTEGER NOT NULL,
+	message VARCHAR NOT NULL,
+	sent_date TIMESTAMP NOT NULL,
+	is_read BOOLEAN DEFAULT '0' NOT NULL,
+	FOREIGN KEY(user_id) REFERENCES user_account (id)
+)""",
+    ],
+}
+
+BORROW_ROLLUP_TABLE = {
+    "sqlite": [
+        """CREATE TABLE IF NOT EXISTS "borrow_rollup" (
+	period TEXT NOT NULL CHECK (period IN ('day', 'week', 'month')),
+	period_start DATE NOT NULL,
+	category_id INTEGER NOT NULL,
+	role TEXT NOT NULL CHECK (LENGTH(role) <= 20),
+	is_returned BOOLEAN NOT NULL,
+	borrow_count INTEGER DEFAULT 0 NOT NULL,
+	PRIMARY KEY (period, period_start, category_id, role, is_returned),
+	FOREIGN KEY(category_id) REFERENCES category (id)
+)"""
+    ],
+    "postgres": [
+        """CREATE TABLE IF NOT EXISTS "borrow_rollup" (
+	period VARCHAR(5) NOT NULL,
+	period_start DATE NOT NULL,
+	category_id INTEGER NOT NULL,
+	role VARCHAR(20) NOT NULL,
+	is_returned BOOLEAN NOT NULL,
+	borrow_count INTEGER DEFAULT '0' NOT NULL,
+	PRIMARY KEY (period, period_start, category_id, role, is_returned),
+	CONSTRAINT borrow_rollup_period_check CHECK (period IN ('day', 'week', 'month')),
+	FOREIGN KEY(category_id) REFERENCES category (id)
+)"""
+    ],
+}
+
+# Written out rather than taken from src.utils.rollup, so changing the app's rollups later
+# does not change what this migration did
+ROLLUP_PERIOD_START = {
+    "sqlite": {
+        "day": "date(borrow.borrow_date)",
+        "week": "date(borrow.borrow_date, 'weekday 0', '-6 days')",
+        "month": "date(borrow.borrow_date, 'start of month')",
+    },
+    "postgres": {
+        period: f"date_trunc('{period}', borrow.borrow_date)::date"
+        for period in ("day", "week", "month")
+    },
+}
+
+COUNT_ROLLUPS = {
+    dialect: [
+        f"""INSERT INTO borrow_rollup (period, period_start, category_id, role, is_returned, borrow_count)
+        SELECT '{period}', {start}, book.category_id, user_account.role, borrow.is_returned, COUNT(*)
+        FROM borrow
+        JOIN book ON book.id = borrow.book_id
+        JOIN user_account ON user_account.id = borrow.borrowed_by_id
+        WHERE borrow.id BETWEEN :first_id AND :last_id
+        GROUP BY {start}, book.category_id, user_account.role, borrow.is_returned
+        ON CONFLICT (period, period_start, category_id, role, is_returned)
+        DO UPDATE SET borrow_count = borrow_rollup.borrow_count + excluded.borrow_count"""
+        for period, start in starts.items()
+    ]
+    for dialect, starts in ROLLUP_PERIOD_START.items()
+}
+
+HOLD_TABLE = {
+    "sqlite": [
+        """CREATE TABLE IF NOT EXISTS "hold" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	book_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
+	seq INTEGER NOT NULL,
+	status TEXT DEFAULT 'waiting' NOT NULL CHECK (status IN ('waiting', 'ready', 'fulfilled', 'cancelled', 'expired')),
+	placed_at DATETIME NOT NULL,
+	ready_at DATETIME,
+	expires_at DATETIME,
+	FOREIGN KEY(book_id) REFERENCES book (id),
+	FOREIGN KEY(user_id) REFERENCES user_account (id)
+)"""
+    ],
+    "postgres": [
+        """CREATE TABLE IF NOT EXISTS "hold" (
+	id SERIAL PRIMARY KEY,
+	book_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
+	seq INTEGER NOT NULL,
+	status VARCHAR(10) DEFAULT 'waiting' NOT NULL,
+	placed_at TIMESTAMP NOT NULL,
+	ready_at TIMESTAMP,
+	expires_at TIMESTAMP,
+	CONSTRAINT hold_status_check CHECK (status IN ('waiting', 'ready', 'fulfilled', 'cancelled', 'expired')),
+	FOREIGN KEY(book_id) REFERENCES book (id),
+	FOREIGN KEY(user_id) REFERENCES user_account (id)
+)"""
+    ],
+}
+
+# Absolute counts, so a batch run twice writes the same values
+COUNT_USER_COUNTERS = [
+    """UPDATE user_account SET
+    active_loans = (SELECT COUNT(*) FROM borrow
+        WHERE borrow.borrowed_by_id = user_account.id AND borrow.is_returned = FALSE),
+    outstanding_balance = (SELECT COALESCE(SUM(fine.amount), 0) FROM fine JOIN borrow ON borrow.id = fine.borrow_id
+        WHERE borrow.borrowed_by_id = user_account.id AND fine.paid = FALSE)
+    WHERE user_account.id BETWEEN :first_id AND :last_id"""
+]
+
+# ISBNs spelled with hyphens, spaces or a lowercase check digit X
+SPELLED_ISBNS = """SELECT id, isbn FROM book WHERE id BETWEEN :first_id AND :last_id
+    AND (isbn LIKE '%-%' OR isbn LIKE '% %' OR isbn LIKE '%x')"""
+
+# A book whose digits another book already has keeps its spelling, to be merged by hand
+NORMALIZE_ISBN = """UPDATE book SET isbn = :isbn
+    WHERE id = :id AND NOT EXISTS (SELECT 1 FROM book AS other WHERE other.isbn = :isbn)"""
+
+UNSHELVED_BOOKS = "UPDATE book SET location = 'shelf' WHERE location IS NULL AND id BETWEEN :first_id AND :last_id"
+
+MIGRATIONS = [
+    Migration(1, "initial tables", run_sql(INITIAL_TABLES)),
+    Migration(
+        2,
+        "book search",
+        # SQLite fills the search index from the catalog in one statement
+        run_sql({"sqlite": SEARCH_SQLITE}),
+        add_column("book", "search_vector", {"postgres": "tsvector"}),
+        run_sql(
+            {
+                "postgres": [
+                    # Databases created before migrations have it as a generated column,
+                    # which adding it would have rewritten the table for
+                    "ALTER TABLE book ALTER COLUMN search_vector DROP EXPRESSION IF EXISTS",
+                    *SEARCH_POSTGRES_TRIGGER,
+                ]
+            }
+        ),
+        backfill(
+            "book",
+            {"postgres": [f"{SEARCH_POSTGRES_BACKFILL} AND id BETWEEN :first_id AND :last_id"]},
+        ),
+        create_index(
+            "idx_book_search_vector", "book", ["search_vector"], using="GIN", dialect="postgres"
+        ),
+    ),
+    Migration(
+        3,
+        "borrow rollups",
+        run_sql(BORROW_ROLLUP_TABLE),
+        backfill("borrow", COUNT_ROLLUPS, reset=["DELETE FROM borrow_rollup"]),
+    ),
+    Migration(
+        4,
+        "holds",
+        run_sql(HOLD_TABLE),
+        create_index("idx_hold_queue", "hold", ["book_id", "status", "seq"]),
+        create_index("idx_hold_user_id", "hold", ["user_id", "status"]),
+    ),
+    Migration(
+        5,
+        "user loan counters",
+        add_column("user_account", "active_loans", "INTEGER DEFAULT 0 NOT NULL"),
+        add_column(
+            "user_account",
+            "outstanding_balance",
+            {"sqlite": "REAL DEFAULT 0 NOT NULL", "postgres": "FLOAT DEFAULT 0 NOT NULL"},
+        ),
+        backfill("user_account", {"sqlite": COUNT_USER_COUNTERS, "postgres": COUNT_USER_COUNTERS}),
+    ),
+    Migration(
+        6,
+        "route indexes",
+        create_index("idx_user_account_first_name", "user_account", ["first_name", "id"]),
+        create_index("idx_category_added_by_id", "category", ["added_by_id"]),
+        create_index("idx_book_category_id", "book", ["category_id"]),
+        create_index("idx_book_added_by_id", "book", ["added_by_id"]),
+        create_index("idx_book_title", "book", ["title", "id"]),
+        create_index("idx_borrow_book_id", "borrow", ["book_id"]),
+        create_index("idx_borrow_borrower", "borrow", ["borrowed_by_id", "is_returned"]),
+        create_index("idx_borrow_given_by_id", "borrow", ["given_by_id"]),
+        create_index("idx_borrow_received_by_id", "borrow", ["received_by_id"]),
+        create_index("idx_borrow_due_date", "borrow", ["due_date", "id"]),
+        create_index("idx_borrow_borrow_date", "borrow", ["borrow_date", "id"]),
+        create_index(
+            "idx_borrow_overdue",
+            "borrow",
+            ["due_date"],
+            where={"sqlite": "is_returned IS 0", "postgres": "is_returned IS false"},
+        ),
+        create_index("idx_fine_collected_by_id", "fine", ["collected_by_id"]),
+        create_index("idx_fine_date_created", "fine", ["date_created", "id"]),
+        create_index("idx_fine_paid", "fine", ["paid", "date_created", "id"]),
+        create_index("idx_notification_user_id", "notification", ["user_id", "is_read"]),
+        # Superseded by idx_borrow_borrower, and duplicates of the unique constraints
+        drop_index("idx_borrow_borrowed_by_id"),
+        drop_index("idx_book_isbn"),
+        drop_index("idx_fine_borrow_id"),
+        drop_index("idx_user_account_email"),
+    ),
+    # Databases created from the models before they matched the tables above
+    Migration(
+        7,
+        "model constraints",
+        add_unique("category_name_key", "category", ["name"]),
+        add_check(
+            "user_account_role_check", "user_account", "role IN ('student', 'admin', 'external')"
+        ),
+        add_check(
+            "hold_status_check",
+            "hold",
+            "status IN ('waiting', 'ready', 'fulfilled', 'cancelled', 'expired')",
+        ),
+        add_check(
+            "borrow_rollup_period_check", "borrow_rollup", "period IN ('day', 'week', 'month')"
+        ),
+        *(
+            set_not_null(table, column)
+            for table, column in [
+                ("category", "added_by_id"),
+                ("book", "category_id"),
+                ("book", "added_by_id"),
+                ("borrow", "book_id"),
+                ("borrow", "borrowed_by_id"),
+                ("borrow", "given_by_id"),
+                ("fine", "borrow_id"),
+                ("notification", "user_id"),
+                ("hold", "book_id"),
+                ("hold", "user_id"),
+            ]
+        ),
+        run_sql({"postgres": ["ALTER TABLE book ALTER COLUMN location SET DEFAULT 'shelf'"]}),
+        backfill("book", [UNSHELVED_BOOKS]),
+        set_not_null("book", "location"),
+    ),
+    Migration(
+        8,
+        "hold queue seq",
+        create_index(
+            "idx_hold_queue_seq",
+            "hold",
+            ["book_id", "seq"],
+            where="status = 'waiting'",
+            unique=True,
+        ),
+    ),
+    Migration(
+        9,
+        "normalized isbns",
+        update_rows(
+            "book",
+            SPELLED_ISBNS,
+            NORMALIZE_ISBN,
+            lambda row: {"id": row.id, "isbn": row.isbn.replace("-", "").replace(" ", "").upper()},
+        ),
+    ),
+]
@@ -1,9 +1,24 @@
-from datetime import datetime
+from datetime import date, datetime
 from typing import List
 
-from sqlalchemy import Boolean, DateTime, Float, ForeignKey, Integer, String
+from sqlalchemy import (
+    DDL,
+    Boolean,
+    CheckConstraint,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    event,
+    text,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+from sql import DROP_SEARCH_SQLITE, SEARCH_POSTGRES, SEARCH_SQLITE
+
 
 class Base(DeclarativeBase):
     pass
@@ -14,6 +29,11 @@ class Base(DeclarativeBase):
 
 class UserAccount(Base):
     __tablename__ = "user_account"
+    # The unique email constraint already indexes email
+    __table_args__ = (
+        Index("idx_user_account_first_name", "first_name", "id"),
+        CheckConstraint("role IN ('student', 'admin', 'external')", name="user_account_role_check"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     email: Mapped[str] = mapped_column(String(50), unique=True)
@@ -26,6 +46,13 @@ class UserAccount(Base):
     role: Mapped[str] = mapped_column(
         String(20), default="student", nullable=False, server_default="student"
     )
+    # Unreturned borrows and unpaid fines, kept in step by the borrow and fine handlers
+    active_loans: Mapped[int] = mapped_column(
+        Integer, default=0, nullable=False, server_default="0"
+    )
+    outstanding_balance: Mapped[float] = mapped_column(
+        Float, default=0, nullable=False, server_default="0"
+    )
     categories_added: Mapped[List["Category"]] = relationship(
         "Category", back_populates="category_added_by"
     )
@@ -51,10 +78,11 @@ class UserAccount(Base):
 
 class Category(Base):
     __tablename__ = "category"
+    __table_args__ = (Index("idx_category_added_by_id", "added_by_id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    name: Mapped[str] = mapped_column(String(20), nullable=False)
-    added_by_id = mapped_column(ForeignKey("user_account.id"))
+    name: Mapped[str] = mapped_column(String(20), unique=True, nullable=False)
+    added_by_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
 
     category_added_by: Mapped[UserAccount] = relationship(back_populates="categories_added")
     books: Mapped[List["Book"]] = relationship("Book", back_populates="book_category")
@@ -65,12 +93,17 @@ class Category(Base):
 
 class Book(Base):
     __tablename__ = "book"
+    __table_args__ = (
+        Index("idx_book_category_id", "category_id"),
+        Index("idx_book_added_by_id", "added_by_id"),
+        Index("idx_book_title", "title", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str] = mapped_column(String(100), nullable=False)
     author: Mapped[str] = mapped_column(String(50), nullable=False)
     isbn: Mapped[str] = mapped_column(String(25), unique=True, nullable=False)
-    category_id = mapped_column(ForeignKey("category.id"))
+    category_id = mapped_column(ForeignKey("category.id"), nullable=False)
     original_quantity: Mapped[int] = mapped_column(
         Integer, default=1, nullable=False, server_default="1"
     )
@@ -78,11 +111,13 @@ class Book(Base):
         Integer, default=1, nullable=False, server_default="1"
     )
     date_added: Mapped[datetime] = mapped_column(DateTime, nullable=False)
-    added_by_id = mapped_column(ForeignKey("user_account.id"))
+    added_by_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
     is_available: Mapped[bool] = mapped_column(
         Boolean, default=True, nullable=False, server_default="1"
     )
-    location: Mapped[str] = mapped_column(String(20))
+    location: Mapped[str] = mapped_column(
+        String(20), default="shelf", nullable=False, server_default="shelf"
+    )
 
     book_category: Mapped[Category] = relationship(back_populates="books")
     book_added_by: Mapped[UserAccount] = relationship(back_populates="books_added")
@@ -95,11 +130,29 @@ class Book(Base):
 
 class Borrow(Base):
     __tablename__ = "borrow"
+    __table_args__ = (
+        Index("idx_borrow_book_id", "book_id"),
+        # A borrower's borrows, and their unreturned ones for the loan counters
+        Index("idx_borrow_borrower", "borrowed_by_id", "is_returned"),
+        Index("idx_borrow_given_by_id", "given_by_id"),
+        Index("idx_borrow_received_by_id", "received_by_id"),
+        Index("idx_borrow_due_date", "due_date", "id"),
+        Index("idx_borrow_borrow_date", "borrow_date", "id"),
+        # Nearly every borrow is due before today, so the overdue sweep and report look the
+        # due dates up among the unreturned borrows only. The predicate is spelled the way
+        # `Borrow.is_returned.is_(False)` renders, which a query must match to use the index.
+        Index(
+            "idx_borrow_overdue",
+            "due_date",
+            sqlite_where=text("is_returned IS 0"),
+            postgresql_where=text("is_returned IS false"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    book_id = mapped_column(ForeignKey("book.id"))
-    borrowed_by_id = mapped_column(ForeignKey("user_account.id"))
-    given_by_id = mapped_column(ForeignKey("user_account.id"))
+    book_id = mapped_column(ForeignKey("book.id"), nullable=False)
+    borrowed_by_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
+    given_by_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
     received_by_id = mapped_column(ForeignKey("user_account.id"))
     borrow_date: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     due_date: Mapped[datetime] = mapped_column(DateTime, nullable=False)
@@ -129,9 +182,16 @@ class Borrow(Base):
 
 class Fine(Base):
     __tablename__ = "fine"
+    # The unique borrow_id constraint already indexes borrow_id
+    __table_args__ = (
+        Index("idx_fine_collected_by_id", "collected_by_id"),
+        Index("idx_fine_date_created", "date_created", "id"),
+        # The fines report filtered by status, newest or oldest first
+        Index("idx_fine_paid", "paid", "date_created", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    borrow_id = mapped_column(ForeignKey("borrow.id"))
+    borrow_id = mapped_column(ForeignKey("borrow.id"), unique=True, nullable=False)
     amount: Mapped[float] = mapped_column(Float, nullable=False)
     paid: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False, server_default="0")
     date_created: Mapped[datetime] = mapped_column(DateTime, nullable=False)
@@ -146,9 +206,12 @@ class Fine(Base):
 
 class Notification(Base):
     __tablename__ = "notification"
+    # Unread notifications by user, in id order. Not a partial index on the unread ones,
+    # because catching up a notification stream reads a user's notifications of both kinds.
+    __table_args__ = (Index("idx_notification_user_id", "user_id", "is_read"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id = mapped_column(ForeignKey("user_account.id"))
+    user_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
     message: Mapped[str] = mapped_column(String, nullable=False)
     sent_date: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     is_read: Mapped[bool] = mapped_column(
@@ -159,3 +222,68 @@ class Notification(Base):
 
     def __repr__(self):
         return self.message
+
+
+class Hold(Base):
+    """A patron's place in the queue for a book with no copies on the shelf, see src.utils.holds."""
+
+    __tablename__ = "hold"
+    __table_args__ = (
+        Index("idx_hold_queue", "book_id", "status", "seq"),
+        # One waiting hold per place in a book's queue
+        Index(
+            "idx_hold_queue_seq",
+            "book_id",
+            "seq",
+            unique=True,
+            sqlite_where=text("status = 'waiting'"),
+            postgresql_where=text("status = 'waiting'"),
+        ),
+        Index("idx_hold_user_id", "user_id", "status"),
+        CheckConstraint(
+            "status IN ('waiting', 'ready', 'fulfilled', 'cancelled', 'expired')",
+            name="hold_status_check",
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    book_id = mapped_column(ForeignKey("book.id"), nullable=False)
+    user_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
+    seq: Mapped[int] = mapped_column(Integer, nullable=False)
+    status: Mapped[str] = mapped_column(
+        String(10), default="waiting", nullable=False, server_default="waiting"
+    )
+    placed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    ready_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    book: Mapped[Book] = relationship("Book")
+    user: Mapped[UserAccount] = relationship("UserAccount")
+
+
+class BorrowRollup(Base):
+    """Borrow counts per period, kept up to date on borrow and return by src.utils.rollup."""
+
+    __tablename__ = "borrow_rollup"
+    __table_args__ = (
+        CheckConstraint("period IN ('day', 'week', 'month')", name="borrow_rollup_period_check"),
+    )
+
+    period: Mapped[str] = mapped_column(String(5), primary_key=True)
+    period_start: Mapped[date] = mapped_column(Date, primary_key=True)
+    category_id = mapped_column(ForeignKey("category.id"), primary_key=True)
+    role: Mapped[str] = mapped_column(String(20), primary_key=True)
+    is_returned: Mapped[bool] = mapped_column(Boolean, primary_key=True)
+    borrow_count: Mapped[int] = mapped_column(
+        Integer, default=0, nullable=False, server_default="0"
+    )
+
+
+# Keep the full-text search index alongside the tables created from the models. Changes to
+# the models need a matching migration in src.migrations.versions.
+for stmt in SEARCH_SQLITE:
+    event.listen(Base.metadata, "after_create", DDL(stmt).execute_if(dialect="sqlite"))
+for stmt in SEARCH_POSTGRES:
+    event.listen(Base.metadata, "after_create", DDL(stmt).execute_if(dialect="postgresql"))
+for stmt in DROP_SEARCH_SQLITE:
+    event.listen(Base.metadata, "before_drop", DDL(stmt).execute_if(dialect="sqlite"))
@@ -1,50 +1,113 @@
-from flask import jsonify, make_response
+from flask import Response, current_app, jsonify, make_response, request
 from flask_jwt_extended import current_user, jwt_required
 from flask_restx import Namespace, Resource
-from sqlalchemy import and_, select, text
+from sqlalchemy import and_, select
 
 import src.models as md
 import src.p_models as pmd
-from src.utils import atomic_transaction, session, sql_compile
+import src.queries as qs
+from src.utils import (
+    LocalBroker,
+    atomic_transaction,
+    json_response,
+    keyset_select,
+    page_args,
+    paginate,
+    serialize_rows,
+    session,
+    sql_compile,
+)
 
 notifications_namespace = Namespace("Notifications", description="Notification operations", path="/")
 
 
 @notifications_namespace.route("/notifications")
 class Notifications(Resource):
-    @jwt_required
+    @jwt_required()
     def get(self):
         user_id = current_user.id
+        limit, cursor = page_args()
         stmt = select(md.Notification).where(
             and_(md.Notification.user_id == user_id, md.Notification.is_read.is_(False))
         )
+        stmt = keyset_select(stmt, [(md.Notification.id, False)], cursor, limit)
         query = sql_compile(stmt)
         notifications = session.execute(stmt).scalars().all()
-        notifications = [
-            pmd.NotificationListSchema.model_validate(notification)
-            for notification in notifications
-        ]
-        return make_response(
-            jsonify(
-                {
-                    "notifications": [notification.model_dump() for notification in notifications],
-                    "queries": [query],
-                }
-            )
+        notifications, next_cursor = paginate(
+            notifications, limit, lambda notification: [notification.id]
+        )
+        return json_response(
+            {
+                "notifications": serialize_rows(pmd.NotificationListSchema, notifications),
+                "next_cursor": next_cursor,
+                "queries": [query],
+            }
         )
 
 
 @notifications_namespace.route("/notifications/<int:notification_id>")
 class NotificationDetail(Resource):
-    @jwt_required
+    @jwt_required()
     @atomic_transaction
     def post(self, notification_id):
         user_id = current_user.id
-        stmt = f"UPDATE notification SET is_read = TRUE WHERE id = {notification_id} AND user_id = {user_id}"
-        result = session.execute(text(stmt))
+        stmt = qs.MARK_NOTIFICATION_READ
+        result = session.execute(stmt, {"notification_id": notification_id, "user_id": user_id})
+        query = sql_compile(stmt)
         if result.rowcount == 0:
             return make_response(
-                jsonify(error="Notification not found or is already read", queries=stmt), 404
+                jsonify(error="Notification not found or is already read", queries=query), 404
             )
 
-        return make_response(jsonify(message="Notification marked as read", queries=stmt))
+        return make_response(jsonify(message="Notification marked as read", queries=query))
+
+
+@notifications_namespace.route("/notifications/stream")
+class NotificationStream(Resource):
+    @jwt_required()
+    @notifications_namespace.doc(
+        description="Server-sent events, one `notification` event per new notification. "
+        "Reconnect with the `Last-Event-ID` header to get what was missed in between."
+    )
+    def get(self):
+        user_id = current_user.id
+        broker: LocalBroker = current_app.extensions["notification_broker"]
+        keepalive = current_app.config["NOTIFICATION_KEEPALIVE"]
+        page_size = current_app.config["NOTIFICATION_BACKLOG"]
+        last_id = request.headers.get("Last-Event-ID", "")
+        more = False
+        if last_id.isdigit():
+            # Only a resume reads the database, the stream itself is fed by the broker
+            rows = session.execute(
+                qs.NOTIFICATIONS_SINCE,
+                {"user_id": user_id, "last_id": int(last_id), "limit": page_size},
+            ).all()
+            more = len(rows) == page_size
+            missed = [
+                (row.id, pmd.NotificationListSchema.model_validate(row).model_dump_json())
+                for row in rows
+            ]
+            last_id = missed[-1][0] if missed else int(last_id)
+        else:
+            missed, last_id = [], broker.last_id
+        # Give the connection back, the stream may stay open for hours
+        session.close()
+
+        def stream(events, last_id):
+            yield "retry: 3000\n\n"  # ms before the client reconnects
+            while True:
+                for event_id, data in events:
+                    yield f"id: {event_id}\nevent: notification\ndata: {data}\n\n"
+                    last_id = event_id
+                if more:
+                    # The client reconnects from the last id sent for the next page
+                    return
+                events = broker.listen(user_id, last_id, keepalive)
+                if not events:
+                    yield ": keepalive\n\n"
+
+        return Response(
+            stream(missed, last_id),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
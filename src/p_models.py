@@ -1,8 +1,25 @@
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import Annotated, Optional
 
 from pydantic import BaseModel as PydanticBaseModel
-from pydantic import ConfigDict, field_validator
+from pydantic import ConfigDict, Field, PlainSerializer, field_validator
+
+_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def http_date(value: datetime) -> str:
+    """`werkzeug.http.http_date` without the round trip through `email.utils`."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return (
+        f"{_DAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} {value.year:04d} "
+        f"{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT"
+    )
+
+
+# Serialize datetimes to JSON the way Flask's jsonify does, so both paths return the same payload
+HttpDatetime = Annotated[datetime, PlainSerializer(http_date, return_type=str, when_used="json")]
 
 
 class BaseModel(PydanticBaseModel):
@@ -26,10 +43,6 @@ class MoreUserDetailSchema(UserDetailSchema):
     books_borrowed: list["MinimalBorrowSchema"]
     fines_collected: Optional[list["FineListSchema"]]
 
-    @field_validator("books_borrowed", mode="before")
-    def list_borrows(cls, value):
-        return [MinimalBorrowSchema.model_validate(borrow) for borrow in value]
-
 
 class AdminUserDetailSchema(MoreUserDetailSchema):
     categories_added: list["ListCategorySchema"]
@@ -46,10 +59,6 @@ class CategoryDetailSchema(BaseModel):
     name: str
     books: list["MinimalBookDetailSchema"]
 
-    @field_validator("books", mode="before")
-    def list_books(cls, value):
-        return [MinimalBookDetailSchema.model_validate(book) for book in value]
-
 
 class AdminCategoryDetailSchema(CategoryDetailSchema):
     category_added_by: str
@@ -71,7 +80,7 @@ class ListBookSchema(MinimalBookDetailSchema):
     isbn: str
     book_category: str
     current_quantity: int
-    date_added: datetime
+    date_added: HttpDatetime
 
     @field_validator("book_category", mode="before")
     def convert_book_category_to_string(cls, value):
@@ -90,15 +99,11 @@ class BookDetailSchema(ListBookSchema):
 class MoreBookDetailSchema(BookDetailSchema):
     borrows: list["ListBorrowSchema"]
 
-    @field_validator("borrows", mode="before")
-    def list_borrows(cls, value):
-        return [ListBorrowSchema.model_validate(borrow) for borrow in value]
-
 
 class MinimalBorrowSchema(BaseModel):
     id: int
     borrowed_book: str
-    borrow_date: datetime
+    borrow_date: HttpDatetime
     is_returned: bool = False
     fines: list["FineListSchema"]
 
@@ -106,15 +111,11 @@ class MinimalBorrowSchema(BaseModel):
     def convert_borrowed_book_to_string(cls, value):
         return str(value)
 
-    @field_validator("fines", mode="before")
-    def list_fines(cls, value):
-        return [FineListSchema.model_validate(fine) for fine in value]
-
 
 class ListBorrowSchema(MinimalBorrowSchema):
     borrowed_by: str
     given_by: str
-    due_date: datetime
+    due_date: HttpDatetime
     received_by: Optional[str]
 
     @field_validator("borrowed_by", mode="before")
@@ -136,14 +137,10 @@ class DetailBorrowSchema(ListBorrowSchema):
 
 class AdminListBorrowSchema(MinimalBorrowSchema):
     given_by: str
-    due_date: datetime
+    due_date: HttpDatetime
     received_by: Optional[str]
     borrowed_by: ListUsersSchema
 
-    @field_validator("borrowed_by", mode="before")
-    def borrowed_by(cls, value):
-        return ListUsersSchema.model_validate(value)
-
     @field_validator("given_by", mode="before")
     def convert_given_by_to_string(cls, value):
         return str(value)
@@ -158,8 +155,8 @@ class FineListSchema(BaseModel):
     borrow: str
     amount: float
     paid: bool = False
-    date_created: datetime
-    date_paid: Optional[datetime]
+    date_created: HttpDatetime
+    date_paid: Optional[HttpDatetime]
 
     @field_validator("borrow", mode="before")
     def convert_borrow_to_string(cls, value):
@@ -181,8 +178,8 @@ class AdminFineListSchema(BaseModel):
     borrow: AdminListBorrowSchema
     amount: float
     paid: bool = False
-    date_created: datetime
-    date_paid: Optional[datetime]
+    date_created: HttpDatetime
+    date_paid: Optional[HttpDatetime]
     payment_method: Optional[str]
     transaction_id: Optional[str]
     collected_by: Optional[str]
@@ -191,14 +188,56 @@ class AdminFineListSchema(BaseModel):
     def convert_collected_by_to_string(cls, value):
         return str(value)
 
-    @field_validator("borrow", mode="before")
-    def display_borrow(cls, value):
-        return AdminListBorrowSchema.model_validate(value)
-
 
 class NotificationListSchema(BaseModel):
     id: int
     user_id: int
     message: str
-    date_sent: datetime
+    date_sent: HttpDatetime = Field(validation_alias="sent_date")
     is_read: bool = False
+
+
+def normalize_isbn(isbn: str) -> str:
+    """An ISBN as the catalog stores it, without hyphens or spaces and with an uppercase X."""
+    return isbn.replace("-", "").replace(" ", "").upper()
+
+
+def is_valid_isbn(isbn: str) -> bool:
+    """Check the length and check digit of an ISBN-10 or ISBN-13, ignoring hyphens and spaces."""
+    digits = normalize_isbn(isbn)
+    if len(digits) == 13 and digits.isdigit():
+        return sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10 == 0
+    if len(digits) == 10 and digits[:9].isdigit() and (digits[9].isdigit() or digits[9] == "X"):
+        values = [int(d) for d in digits[:9]] + [10 if digits[9] == "X" else int(digits[9])]
+        return sum(value * (10 - i) for i, value in enumerate(values)) % 11 == 0
+    return False
+
+
+class BookImportSchema(BaseModel):
+    """One title of a catalog feed, see POST /books/import."""
+
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    title: str = Field(min_length=1, max_length=100)
+    author: str = Field(min_length=1, max_length=50)
+    isbn: str = Field(max_length=25)
+    category_id: int
+    quantity: int = Field(default=1, ge=0)
+    location: str = Field(min_length=1, max_length=20)
+
+    @field_validator("isbn")
+    def check_isbn(cls, value):
+        if not is_valid_isbn(value):
+            raise ValueError("not a valid ISBN-10 or ISBN-13")
+        # The upsert key, so one ISBN spelled two ways is still one book
+        return normalize_isbn(value)
+
+
+class HoldListSchema(BaseModel):
+    id: int
+    book_id: int
+    book_title: str
+    status: str
+    position: Optional[int]
+    placed_at: HttpDatetime
+    expires_at: Optional[HttpDatetime]
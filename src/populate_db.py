@@ -1,144 +1,415 @@
+"""
+Fill the database with seeded synthetic data, from a demo handful up to capacity-test sizes.
+
+Rows are generated in chunks and written with one executemany per chunk, so memory stays
+flat however many rows are asked for. Each chunk is seeded from `--seed` and its position,
+so the same arguments always produce the same data, with or without `--workers`.
+
+Borrowing is skewed the way a real library's is: book popularity follows a Zipf
+distribution, a few heavy readers borrow far more than everyone else, and one borrower in
+ten returns books late most of the time.
+
+Usage:
+    FLASK_ENV=dev python -m src.populate_db --users 200000 --books 1000000 --borrows 10000000
+"""
+
+import argparse
+import math
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from random import choice, choices, randint
+from random import Random
 
 from faker import Faker
-from sqlalchemy import select
-from werkzeug.security import generate_password_hash
+from sqlalchemy import create_engine, func, select, text
 
+from src.migrations import migrate
 from src.models import Book, Borrow, Category, Fine, UserAccount
-from src.utils import session
-
-fake = Faker()
-
-students = []
-externals = []
-admins = []
-categories = []
-books = []
-
-for i in range(10):
-    students.append(
-        UserAccount(
-            first_name=fake.first_name(),
-            last_name=fake.last_name(),
-            role="student",
-            password=generate_password_hash("password"),
-            email=fake.email(),
-            is_active=True,
-        )
-    )
+from src.utils import (
+    FINE_PER_DAY,
+    PAYMENT_METHODS,
+    config,
+    configure_sqlite,
+    hash_password,
+    rebuild_rollups,
+    repair_counters,
+)
 
-    if i % 2 == 0:
-        externals.append(
-            UserAccount(
-                first_name=fake.first_name(),
-                last_name=fake.last_name(),
-                role="external",
-                password=generate_password_hash("password"),
-                email=fake.email(),
-                is_active=True,
-            )
-        )
+LOAN_DAYS = 14
+# Every 100th generated user, starting with the first, is an admin and 14 in 100 are
+# externals, so admin ids are known upfront
+ADMIN_EVERY = 100
+EXTERNALS_PER_100 = 14
+# Share of borrows going to the most popular books grows with this exponent
+BOOK_POPULARITY_SKEW = 1.1
+HEAVY_READER_SKEW = 0.8
+LATE_RETURNERS = 0.1
+LATE_RATE = {True: 0.6, False: 0.05}
+# Late returners also hold on to some books indefinitely
+NEVER_RETURNED_RATE = {True: 0.15, False: 0.01}
+# A large prime, coprime with any table size we generate, to spread popular books over ids
+SCATTER = 2_654_435_761
 
-    if i % 4 == 0:
-        admins.append(
-            UserAccount(
-                first_name=fake.first_name(),
-                last_name=fake.last_name(),
-                role="admin",
-                password=generate_password_hash("password"),
-                email=fake.email(),
-                is_active=True,
-            )
+LETTERS = ("A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N")
+
+# Bulk loads can be redone from the seed, so losing the last commits to a crash is fine
+LOAD_PRAGMAS = {"synchronous": "OFF", "temp_store": "MEMORY", "cache_size": -256000}
+
+# Books lent out and not back yet are not on the shelf
+SYNC_QUANTITIES = {
+    "sqlite": """UPDATE book SET current_quantity = MAX(original_quantity - (
+        SELECT COUNT(*) FROM borrow WHERE borrow.book_id = book.id AND NOT borrow.is_returned
+    ), 0)""",
+    "postgres": """UPDATE book SET current_quantity = GREATEST(original_quantity - (
+        SELECT COUNT(*) FROM borrow WHERE borrow.book_id = book.id AND NOT borrow.is_returned
+    ), 0)""",
+}
+SYNC_AVAILABILITY = text("UPDATE book SET is_available = current_quantity > 0")
+
+_fake = None
+
+
+def chunk_faker(seed) -> tuple[Random, Faker]:
+    """A random generator and a Faker, both seeded for one chunk."""
+    global _fake
+    if _fake is None:
+        _fake = Faker()
+    _fake.seed_instance(seed)
+    return Random(seed), _fake
+
+
+def role_of(index: int) -> str:
+    """The role of the `index`th generated user."""
+    if index % ADMIN_EVERY == 0:
+        return "admin"
+    if index % 100 <= EXTERNALS_PER_100:
+        return "external"
+    return "student"
+
+
+def is_late_returner(user_id: int, seed) -> bool:
+    return Random(f"{seed}-late-{user_id}").random() < LATE_RETURNERS
+
+
+def zipf_rank(rng: Random, n: int, skew: float) -> int:
+    """A rank in [0, n), rank 0 the most likely, drawn by inverting the continuous Zipf CDF."""
+    u = rng.random()
+    if skew == 1:
+        rank = n**u
+    else:
+        rank = ((n ** (1 - skew) - 1) * u + 1) ** (1 / (1 - skew))
+    return min(int(rank) - 1, n - 1)
+
+
+def scatter(rank: int, n: int) -> int:
+    """Map a popularity rank to an offset in [0, n), so popular rows are not all the oldest."""
+    return rank * SCATTER % n if math.gcd(SCATTER, n) == 1 else rank
+
+
+def isbn13(number: int) -> str:
+    """A valid, unique ISBN-13 for each number below a billion."""
+    digits = f"978{number:09d}"
+    check = -sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10
+    return digits + str(check)
+
+
+def user_rows(seed, first_user: int, first_id: int, count: int, password: str) -> list[dict]:
+    rng, fake = chunk_faker(f"{seed}-users-{first_id}")
+    rows = []
+    for user_id in range(first_id, first_id + count):
+        first_name, last_name = fake.first_name()[:20], fake.last_name()[:20]
+        rows.append(
+            {
+                "id": user_id,
+                "email": f"{first_name}.{last_name}.{user_id}@example.com".lower(),
+                "first_name": first_name,
+                "last_name": last_name,
+                "password": password,
+                "is_active": rng.random() > 0.02,
+                "role": role_of(user_id - first_user),
+            }
         )
+    return rows
+
 
-session.add_all(students)
-session.add_all(externals)
-session.add_all(admins)
-session.commit()
-
-students = session.scalars(select(UserAccount).where(UserAccount.role == "student")).all()
-admins = session.scalars(select(UserAccount).where(UserAccount.role == "admin")).all()
-externals = session.scalars(select(UserAccount).where(UserAccount.role == "external")).all()
-
-for i in range(5):
-    categories.append(Category(name=fake.word(), added_by_id=choice(admins).id))
-
-
-session.add_all(categories)
-session.commit()
-categories = session.scalars(select(Category)).all()
-
-cat_dict = {}
-num = 50
-for cat in categories:
-    cat_dict[cat.id] = str(num)
-    num += 50
-
-letters = ("A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N")
-
-for i in range(20):
-    category = choice(categories).id
-    l_name = fake.last_name()
-    location = f"{choice(letters)}-{cat_dict[category]}-{l_name[:3].upper()}"
-    f_name = fake.first_name()
-    books.append(
-        Book(
-            title=fake.sentence(randint(2, 6)),
-            author=f"{f_name} {l_name}",
-            isbn=fake.isbn13(),
-            category_id=category,
-            date_added=datetime.now(),
-            added_by_id=choice(admins).id,
-            location=location,
+def book_rows(seed, first_id: int, count: int, categories: list[int], admins: list[int], now):
+    rng, fake = chunk_faker(f"{seed}-books-{first_id}")
+    rows = []
+    for book_id in range(first_id, first_id + count):
+        category = rng.choice(categories)
+        last_name = fake.last_name()
+        quantity = rng.choice((1, 1, 1, 2, 2, 3, 5))
+        rows.append(
+            {
+                "id": book_id,
+                "title": fake.sentence(rng.randint(2, 6))[:100],
+                "author": f"{fake.first_name()} {last_name}"[:50],
+                "isbn": isbn13(book_id),
+                "category_id": category,
+                "original_quantity": quantity,
+                "current_quantity": quantity,
+                "date_added": now - timedelta(days=rng.randint(0, 3650)),
+                "added_by_id": rng.choice(admins),
+                "is_available": True,
+                "location": f"{rng.choice(LETTERS)}-{category * 50}-{last_name[:3].upper()}",
+            }
         )
-    )
+    return rows
+
+
+def borrow_rows(seed, first_id: int, count: int, books, users, admins, days: int, now):
+    """
+    Borrows and the fines they ran up.
 
-session.add_all(books)
-session.commit()
-
-books = session.scalars(select(Book)).all()
-
-b_choices = choices(books, k=10)
-borrows = []
-for i in b_choices:
-    borrow_date = datetime.now() - timedelta(days=randint(1, 60))
-    due_date = borrow_date + timedelta(days=randint(3, 30))
-    borrows.append(
-        Borrow(
-            book_id=i.id,
-            borrowed_by_id=choice(students).id,
-            given_by_id=choice(admins).id,
-            received_by_id=choice(admins).id if choice((True, False)) else None,
-            borrow_date=borrow_date,
-            due_date=due_date,
-            comments=fake.sentence(10),
+    `books` and `users` are (first id, count) ranges, ids are picked with popularity skew.
+    """
+    rng, fake = chunk_faker(f"{seed}-borrows-{first_id}")
+    borrows, fines = [], []
+    for borrow_id in range(first_id, first_id + count):
+        book_id = books[0] + scatter(zipf_rank(rng, books[1], BOOK_POPULARITY_SKEW), books[1])
+        user_id = users[0] + scatter(zipf_rank(rng, users[1], HEAVY_READER_SKEW), users[1])
+        late = is_late_returner(user_id, seed)
+        borrow_date = now - timedelta(seconds=rng.randint(0, days * 86400))
+        due_date = borrow_date + timedelta(days=LOAN_DAYS)
+
+        if rng.random() < LATE_RATE[late]:
+            return_date = due_date + timedelta(days=rng.expovariate(1 / 10))
+        else:
+            return_date = borrow_date + timedelta(days=rng.uniform(1, LOAN_DAYS))
+        if return_date > now or rng.random() < NEVER_RETURNED_RATE[late]:
+            return_date = None
+
+        borrows.append(
+            {
+                "id": borrow_id,
+                "book_id": book_id,
+                "borrowed_by_id": user_id,
+                "given_by_id": rng.choice(admins),
+                "received_by_id": rng.choice(admins) if return_date else None,
+                "borrow_date": borrow_date,
+                "due_date": due_date,
+                "return_date": return_date,
+                "comments": fake.sentence(6) if rng.random() < 0.05 else None,
+                "is_returned": return_date is not None,
+            }
         )
-    )
 
-session.add_all(borrows)
-session.commit()
-
-borrows = session.scalars(select(Borrow)).all()
-fines = []
-for i in borrows:
-    if i.due_date < datetime.now():
-        days = datetime.now() - i.due_date
-        amount = days.days * 5
-        paid = choice((True, False))
-        method = choice(("cash", "card", "mpesa"))
+        days_late = ((return_date or now) - due_date).days
+        if days_late <= 0:
+            continue
+        # Fines for books still out stay open, most fines for returned books are settled
+        paid = return_date is not None and rng.random() < 0.8
+        method = rng.choice(PAYMENT_METHODS) if paid else None
         fines.append(
-            Fine(
-                borrow_id=i.id,
-                amount=amount,
-                paid=paid,
-                payment_method=method if paid else None,
-                collected_by_id=choice(admins).id if paid and method == "cash" else None,
-                date_created=datetime.now(),
-                date_paid=datetime.now() if paid else None,
-                transaction_id=fake.uuid4() if paid and method != "cash" else None,
-            )
+            {
+                "borrow_id": borrow_id,
+                "amount": days_late * FINE_PER_DAY,
+                "paid": paid,
+                "date_created": due_date + timedelta(days=1),
+                "date_paid": return_date if paid else None,
+                "payment_method": method,
+                "transaction_id": f"txn-{seed}-{borrow_id}" if paid and method != "cash" else None,
+                "collected_by_id": rng.choice(admins) if method == "cash" else None,
+            }
         )
+    return borrows, fines
+
+
+def chunks(first_id: int, count: int, size: int):
+    for start in range(first_id, first_id + count, size):
+        yield start, min(size, first_id + count - start)
+
+
+def next_id(conn, model) -> int:
+    return (conn.scalar(select(func.max(model.id))) or 0) + 1
+
+
+def generated_chunks(pool, generate, jobs: list[tuple], window: int):
+    """
+    The results of `generate` for every job, in job order. With a pool, at most `window`
+    chunks are generated or waiting to be written at once, so the parent holds a few
+    chunks rather than the whole table.
+    """
+    if pool is None:
+        yield from (generate(*job) for job in jobs)
+        return
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(generate, *job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def load(conn, pool, tables: tuple, generate, jobs: list[tuple], window: int) -> int:
+    """
+    Generate every chunk, in worker processes when there is a pool, and insert each one in
+    order as soon as it is ready.
+
+    `generate` returns the rows of one chunk, or a tuple of rows per table when it fills
+    several `tables`. Returns the number of rows written to the first table.
+    """
+    rows = 0
+    for result in generated_chunks(pool, generate, jobs, window):
+        result = result if isinstance(result, tuple) else (result,)
+        for table, chunk in zip(tables, result):
+            if chunk:
+                conn.execute(table.insert(), chunk)
+        conn.commit()
+        rows += len(result[0])
+    return rows
+
+
+def generate(
+    engine,
+    users: int,
+    books: int,
+    borrows: int,
+    categories: int = 20,
+    seed=0,
+    chunk_size: int = 10000,
+    workers: int = 0,
+    days: int = 365,
+    now: datetime = None,
+    log=lambda message: None,
+) -> dict:
+    """
+    Add synthetic users, categories, books, borrows and fines to the database behind
+    `engine`, after whatever rows are already there, then rebuild the borrowing rollups.
+    The schema is brought up to date with the migrations first.
+
+    Returns:
+        dict: The number of rows written per table.
+    """
+    if users < 1:
+        raise ValueError("At least one user is needed, the first one is an admin")
+    now = now or datetime.now()
+    migrate(engine)
+    # Hashing is deliberately slow, every generated user gets the same "password"
+    password = hash_password("password")
+    written = {}
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    window = 2 * workers  # chunks in flight, enough to keep every worker busy
+    try:
+        with engine.connect() as conn:
+            first_user = next_id(conn, UserAccount)
+            admins = list(range(first_user, first_user + users, ADMIN_EVERY))
+            started = time.perf_counter()
+            written["user_account"] = load(
+                conn,
+                pool,
+                (UserAccount.__table__,),
+                user_rows,
+                [
+                    (seed, first_user, start, n, password)
+                    for start, n in chunks(first_user, users, chunk_size)
+                ],
+                window,
+            )
+            log(f"user_account: {users} rows in {time.perf_counter() - started:.1f}s")
+
+            rng, fake = chunk_faker(f"{seed}-categories")
+            first_category = next_id(conn, Category)
+            conn.execute(
+                Category.__table__.insert(),
+                [
+                    {
+                        "id": first_category + i,
+                        # Names are unique, the id keeps them so across runs and sizes
+                        "name": f"{fake.word()[:12]}-{first_category + i}",
+                        "added_by_id": rng.choice(admins),
+                    }
+                    for i in range(categories)
+                ],
+            )
+            conn.commit()
+            written["category"] = categories
+            category_ids = list(range(first_category, first_category + categories))
+
+            started = time.perf_counter()
+            first_book = next_id(conn, Book)
+            written["book"] = load(
+                conn,
+                pool,
+                (Book.__table__,),
+                book_rows,
+                [
+                    (seed, start, n, category_ids, admins, now)
+                    for start, n in chunks(first_book, books, chunk_size)
+                ],
+                window,
+            )
+            log(f"book: {books} rows in {time.perf_counter() - started:.1f}s")
+
+            started = time.perf_counter()
+            first_borrow = next_id(conn, Borrow)
+            fines_before = conn.scalar(select(func.count(Fine.id)))
+            written["borrow"] = load(
+                conn,
+                pool,
+                (Borrow.__table__, Fine.__table__),
+                borrow_rows,
+                [
+                    (seed, start, n, (first_book, books), (first_user, users), admins, days, now)
+                    for start, n in chunks(first_borrow, borrows, chunk_size)
+                ],
+                window,
+            )
+            written["fine"] = conn.scalar(select(func.count(Fine.id))) - fines_before
+            log(
+                f"borrow: {borrows} rows, fine: {written['fine']} rows in {time.perf_counter() - started:.1f}s"
+            )
+
+            dialect = "postgres" if engine.dialect.name == "postgresql" else "sqlite"
+            conn.execute(text(SYNC_QUANTITIES[dialect]))
+            conn.execute(SYNC_AVAILABILITY)
+            written["borrow_rollup"] = rebuild_rollups(conn, dialect)
+            repair_counters(conn)
+            conn.commit()
+            # Planner statistics for the new rows, so the partial and composite indexes are
+            # picked from the first query on
+            conn.exec_driver_sql("ANALYZE")
+            conn.commit()
+    finally:
+        if pool:
+            pool.shutdown()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--books", type=int, default=200)
+    parser.add_argument("--borrows", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--days", type=int, default=365, help="how far back borrows go")
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=0, help="processes generating rows")
+    parser.add_argument("--database-url", default=config.SQLALCHEMY_DATABASE_URI)
+    args = parser.parse_args()
+    if args.users < 1:
+        parser.error("--users must be at least 1, the first user is an admin")
+
+    engine = create_engine(args.database_url)
+    if engine.dialect.name == "sqlite":
+        configure_sqlite(engine, LOAD_PRAGMAS)
+    written = generate(
+        engine,
+        args.users,
+        args.books,
+        args.borrows,
+        categories=args.categories,
+        seed=args.seed,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        days=args.days,
+        log=print,
+    )
+    print(", ".join(f"{table}: {rows}" for table, rows in written.items()))
+
 
-session.add_all(fines)
-session.commit()
+if __name__ == "__main__":
+    main()
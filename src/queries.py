@@ -0,0 +1,380 @@
+"""
+Named SQL statements used by the route handlers.
+
+Every value is a bound parameter, so each statement has a single SQL string no matter
+the request. SQLAlchemy compiles it once and the SQLite driver keeps reusing the same
+prepared statement, and the `queries` debug payload shows the statement, not the values.
+"""
+
+from functools import lru_cache
+
+from sqlalchemy import DateTime, bindparam, text
+
+# Categories
+CATEGORIES = text("SELECT category.id, category.name \nFROM category")
+
+CATEGORY = text(
+    """SELECT category.id, category.name, category.added_by_id, book.id AS book_id, book.author, book.is_available, book.location, book.title
+    FROM category
+    LEFT OUTER JOIN book ON category.id = book.category_id
+    WHERE category.id = :category_id"""
+)
+
+CATEGORY_DETAIL = text(
+    """SELECT category.id, category.name, category.added_by_id, book.id AS book_id, book.author, book.is_available, book.location, book.title, user_account.id AS added_by_user_id, user_account.first_name || ' ' || user_account.last_name AS category_added_by
+    FROM category
+    LEFT OUTER JOIN user_account ON user_account.id = category.added_by_id
+    LEFT OUTER JOIN book ON category.id = book.category_id
+    WHERE category.id = :category_id"""
+)
+
+# Books
+INSERT_BOOK = text(
+    """INSERT INTO book (title, author, isbn, category_id, original_quantity, current_quantity, date_added, added_by_id, is_available, location)
+    VALUES (:title, :author, :isbn, :category_id, :quantity, :quantity, :date_added, :added_by_id, TRUE, :location)
+    RETURNING id"""
+).bindparams(bindparam("date_added", type_=DateTime))
+
+BOOK = text(
+    """SELECT book.id, book.title, book.author, book.isbn, book.category_id, book.current_quantity, book.is_available, book.location, book.date_added, category.name AS category_name
+    FROM book
+    JOIN category ON category.id = book.category_id
+    WHERE book.id = :book_id"""
+)
+
+BOOK_DETAIL = text(
+    """SELECT book.id, book.title, book.author, book.isbn, book.category_id, book.current_quantity, book.is_available, book.location, book.date_added, category.name AS category_name, book.original_quantity, book.added_by_id, added_by.first_name AS added_by_first_name, added_by.last_name AS added_by_last_name, borrow.borrow_date, borrow.due_date, borrow.is_returned, borrowed_by.first_name AS borrowed_by_first_name, borrowed_by.last_name AS borrowed_by_last_name
+    FROM book
+    JOIN category ON category.id = book.category_id
+    JOIN user_account AS added_by ON added_by.id = book.added_by_id
+    LEFT OUTER JOIN borrow ON book.id = borrow.book_id
+    LEFT OUTER JOIN user_account AS borrowed_by ON borrowed_by.id = borrow.borrowed_by_id
+    WHERE book.id = :book_id"""
+)
+
+BOOK_EXISTS = text("SELECT id FROM book WHERE id = :book_id")
+
+BOOK_HAS_BORROWS = text(
+    "SELECT EXISTS (SELECT 1 FROM borrow WHERE borrow.book_id = :book_id) AS borrow_exists"
+)
+
+DELETE_BOOK = text("DELETE FROM book WHERE book.id = :book_id")
+
+# A returned copy goes back on the shelf only when nobody is waiting for it, see PROMOTE_HOLD
+RESTOCK_BOOK = text(
+    """UPDATE book SET current_quantity = current_quantity + 1
+    WHERE id = :book_id
+    AND NOT EXISTS (SELECT 1 FROM hold WHERE hold.book_id = :book_id AND hold.status = 'waiting')"""
+)
+
+# Borrows
+BORROW = text("SELECT * FROM borrow WHERE id = :borrow_id")
+
+MARK_RETURNED = text(
+    """UPDATE borrow SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP, received_by_id = :received_by_id
+    WHERE id = :borrow_id AND is_returned = FALSE"""
+)
+
+USER_BORROW = text(
+    """SELECT borrow.id AS borrow_id, borrow.borrowed_by_id, borrow.received_by_id, borrow.given_by_id, borrow.is_returned, borrow.due_date, borrow.borrow_date, user_account.first_name as borrowed_by_first_name, user_account.last_name as borrowed_by_last_name, given_by.first_name as given_by_first_name, given_by.last_name as given_by_last_name, received_by.first_name as received_by_first_name, received_by.last_name as received_by_last_name, book.title as book_title
+    FROM borrow
+    JOIN user_account ON borrow.borrowed_by_id = user_account.id
+    JOIN user_account AS given_by ON borrow.given_by_id = given_by.id
+    JOIN user_account AS received_by ON borrow.received_by_id = received_by.id
+    JOIN book ON borrow.book_id = book.id
+    WHERE borrowed_by_id = :user_id AND borrow.id = :borrow_id"""
+)
+
+USER_FINES = text(
+    """SELECT id, amount, paid, date_created, date_paid FROM fine
+    WHERE borrow_id IN (SELECT id FROM borrow WHERE borrowed_by_id = :user_id)"""
+)
+
+# Notifications. A stream resumes a page at a time, however long the client was away
+NOTIFICATIONS_SINCE = text(
+    """SELECT id, user_id, message, sent_date, is_read FROM notification
+    WHERE user_id = :user_id AND id > :last_id ORDER BY id LIMIT :limit"""
+)
+
+MARK_NOTIFICATION_READ = text(
+    "UPDATE notification SET is_read = TRUE WHERE id = :notification_id AND user_id = :user_id"
+)
+
+# Loans. A user's unreturned borrows and unpaid fines are kept on their row, so checking
+# whether they may borrow is a primary key lookup, see REPAIR_USER_COUNTERS
+TAKE_COPY = text(
+    """UPDATE book SET current_quantity = current_quantity - 1
+    WHERE id = :book_id AND current_quantity > 0"""
+)
+
+START_LOAN = text(
+    """UPDATE user_account SET active_loans = active_loans + 1
+    WHERE id = :borrower_id AND active_loans < :max_borrows AND outstanding_balance <= :max_balance"""
+)
+
+END_LOAN = text(
+    """UPDATE user_account SET active_loans = CASE WHEN active_loans > 0 THEN active_loans - 1 ELSE 0 END
+    WHERE id = :user_id"""
+)
+
+BORROWER_STANDING = text(
+    """SELECT (SELECT active_loans FROM user_account WHERE id = :borrower_id) AS active_loans,
+    (SELECT outstanding_balance FROM user_account WHERE id = :borrower_id) AS outstanding_balance,
+    (SELECT current_quantity FROM book WHERE id = :book_id) AS current_quantity"""
+)
+
+SETTLE_BALANCE = text(
+    """UPDATE user_account SET outstanding_balance = CASE
+        WHEN outstanding_balance > :amount THEN outstanding_balance - :amount ELSE 0
+    END
+    WHERE id = :user_id"""
+)
+
+REPAIR_USER_COUNTERS = text(
+    """UPDATE user_account SET active_loans = loans.active_loans, outstanding_balance = loans.outstanding_balance
+    FROM (
+        SELECT user_account.id AS user_id,
+        (SELECT COUNT(*) FROM borrow WHERE borrow.borrowed_by_id = user_account.id AND borrow.is_returned = FALSE) AS active_loans,
+        (SELECT COALESCE(SUM(fine.amount), 0) FROM fine JOIN borrow ON borrow.id = fine.borrow_id
+            WHERE borrow.borrowed_by_id = user_account.id AND fine.paid = FALSE) AS outstanding_balance
+        FROM user_account
+    ) AS loans
+    WHERE user_account.id = loans.user_id
+    AND (user_account.active_loans != loans.active_loans OR user_account.outstanding_balance != loans.outstanding_balance)"""
+)
+
+# Circulation desk batches, one statement per step for the whole stack of books
+BORROWER_LOANS = text(
+    "SELECT active_loans, outstanding_balance FROM user_account WHERE id = :borrower_id"
+)
+
+START_LOANS = text(
+    """UPDATE user_account SET active_loans = active_loans + :loans
+    WHERE id = :borrower_id AND active_loans + :loans <= :max_borrows AND outstanding_balance <= :max_balance"""
+)
+
+GIVE_BACK_LOANS = text(
+    """UPDATE user_account SET active_loans = CASE WHEN active_loans > :loans THEN active_loans - :loans ELSE 0 END
+    WHERE id = :borrower_id"""
+)
+
+TAKE_COPIES = text(
+    """UPDATE book SET current_quantity = current_quantity - 1
+    WHERE id IN :book_ids AND current_quantity > 0
+    RETURNING id"""
+).bindparams(bindparam("book_ids", expanding=True))
+
+FULFILL_HOLDS = text(
+    """UPDATE hold SET status = 'fulfilled'
+    WHERE user_id = :borrower_id AND status = 'ready' AND book_id IN :book_ids
+    RETURNING book_id"""
+).bindparams(bindparam("book_ids", expanding=True))
+
+BOOKS_EXIST = text("SELECT id FROM book WHERE id IN :book_ids").bindparams(
+    bindparam("book_ids", expanding=True)
+)
+
+INSERT_BORROWS = text(
+    """INSERT INTO borrow (book_id, borrowed_by_id, given_by_id, borrow_date, due_date)
+    SELECT id, :borrower_id, :given_by_id, :borrow_date, :due_date FROM book WHERE id IN :book_ids
+    RETURNING id, book_id"""
+).bindparams(
+    bindparam("book_ids", expanding=True),
+    bindparam("borrow_date", type_=DateTime),
+    bindparam("due_date", type_=DateTime),
+)
+
+BORROWS_TO_RETURN = text(
+    "SELECT id, book_id, borrowed_by_id, is_returned, borrow_date FROM borrow WHERE id IN :borrow_ids"
+).bindparams(bindparam("borrow_ids", expanding=True))
+
+MARK_MANY_RETURNED = text(
+    """UPDATE borrow SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP, received_by_id = :received_by_id
+    WHERE id IN :borrow_ids AND is_returned = FALSE
+    RETURNING id"""
+).bindparams(bindparam("borrow_ids", expanding=True))
+
+END_LOANS = text(
+    """UPDATE user_account SET active_loans = CASE
+        WHEN active_loans > returned.loans THEN active_loans - returned.loans ELSE 0
+    END
+    FROM (
+        SELECT borrowed_by_id AS user_id, COUNT(*) AS loans FROM borrow
+        WHERE id IN :borrow_ids GROUP BY borrowed_by_id
+    ) AS returned
+    WHERE user_account.id = returned.user_id"""
+).bindparams(bindparam("borrow_ids", expanding=True))
+
+RESTOCK_BOOKS = text(
+    """UPDATE book SET current_quantity = current_quantity + 1
+    WHERE id IN :book_ids
+    AND NOT EXISTS (SELECT 1 FROM hold WHERE hold.book_id = book.id AND hold.status = 'waiting')
+    RETURNING id"""
+).bindparams(bindparam("book_ids", expanding=True))
+
+# Holds. A new waiting hold takes the seq after the book's last waiting one, and the unique
+# (book_id, seq) index on waiting holds turns away a patron who queued at the same moment as
+# another, to try again with the next seq. A cancelled hold leaves a gap rather than moving
+# everyone behind it, so cancelling is a single write, and positions are numbered on read
+# instead, in one ordered pass over the queues of the books asked about. That pass reads each
+# of those queues in full, which is the price of not rewriting them on every cancel.
+BOOK_SHELF = text("SELECT current_quantity FROM book WHERE id = :book_id")
+
+ACTIVE_HOLD_EXISTS = text(
+    """SELECT EXISTS (SELECT 1 FROM hold WHERE book_id = :book_id AND user_id = :user_id
+    AND status IN ('waiting', 'ready')) AS hold_exists"""
+)
+
+PLACE_HOLD = text(
+    """INSERT INTO hold (book_id, user_id, seq, status, placed_at)
+    SELECT :book_id, :user_id, COALESCE(MAX(seq), 0) + 1, 'waiting', :now
+    FROM hold WHERE book_id = :book_id AND status = 'waiting'
+    ON CONFLICT (book_id, seq) WHERE status = 'waiting' DO NOTHING
+    RETURNING id"""
+).bindparams(bindparam("now", type_=DateTime))
+
+
+def hold_queue(book_ids: str) -> str:
+    """A `queue` CTE of (hold id, position) for the waiting holds of the books `book_ids` selects."""
+    return f"""queue AS (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY book_id ORDER BY seq) AS position
+        FROM hold WHERE status = 'waiting' AND book_id IN ({book_ids})
+    )"""
+
+
+USER_HOLD = text(
+    f"""WITH {hold_queue("SELECT book_id FROM hold WHERE id = :hold_id")}
+    SELECT hold.id, hold.book_id, hold.status, hold.seq, queue.position
+    FROM hold LEFT JOIN queue ON queue.id = hold.id
+    WHERE hold.id = :hold_id AND hold.user_id = :user_id"""
+)
+
+USER_HOLDS = text(
+    f"""WITH {hold_queue("SELECT book_id FROM hold WHERE user_id = :user_id AND status = 'waiting'")}
+    SELECT hold.id, hold.book_id, book.title AS book_title, hold.status, hold.placed_at, hold.expires_at,
+    queue.position
+    FROM hold JOIN book ON book.id = hold.book_id LEFT JOIN queue ON queue.id = hold.id
+    WHERE hold.user_id = :user_id AND hold.status IN ('waiting', 'ready')
+    ORDER BY hold.id"""
+).columns(placed_at=DateTime, expires_at=DateTime)
+
+# Set the returned copy aside for the head of the queue
+PROMOTE_HOLD = text(
+    """UPDATE hold SET status = 'ready', ready_at = :now, expires_at = :expires_at
+    WHERE id = (
+        SELECT id FROM hold WHERE book_id = :book_id AND status = 'waiting' ORDER BY seq, id LIMIT 1
+    ) AND status = 'waiting'
+    RETURNING id, user_id"""
+).bindparams(bindparam("now", type_=DateTime), bindparam("expires_at", type_=DateTime))
+
+NOTIFY_HOLD_READY = text(
+    """INSERT INTO notification (user_id, message, sent_date, is_read)
+    SELECT :user_id, 'Your hold on "' || book.title || '" is ready to collect', :now, FALSE
+    FROM book WHERE book.id = :book_id
+    RETURNING id, user_id, message, sent_date, is_read"""
+).bindparams(bindparam("now", type_=DateTime))
+
+FULFILL_HOLD = text(
+    """UPDATE hold SET status = 'fulfilled'
+    WHERE book_id = :book_id AND user_id = :borrower_id AND status = 'ready'"""
+)
+
+# Books of `book_ids` with copies on the shelf while patrons are still queueing for them
+QUEUED_SHELF_BOOKS = text(
+    """SELECT id FROM book WHERE id IN :book_ids AND current_quantity > 0
+    AND EXISTS (SELECT 1 FROM hold WHERE hold.book_id = book.id AND hold.status = 'waiting')"""
+).bindparams(bindparam("book_ids", expanding=True))
+
+# Take a copy off the shelf to set aside for the head of the queue
+TAKE_SHELF_COPY = text(
+    """UPDATE book SET current_quantity = current_quantity - 1
+    WHERE id = :book_id AND current_quantity > 0
+    AND EXISTS (SELECT 1 FROM hold WHERE hold.book_id = :book_id AND hold.status = 'waiting')"""
+)
+
+CANCEL_HOLD = text("UPDATE hold SET status = 'cancelled' WHERE id = :hold_id AND status = :status")
+
+EXPIRE_HOLDS = text(
+    """UPDATE hold SET status = 'expired'
+    WHERE status = 'ready' AND expires_at < :now
+    RETURNING book_id"""
+).bindparams(bindparam("now", type_=DateTime))
+
+# Users
+EMAIL_EXISTS = text(
+    "SELECT EXISTS (SELECT 1 FROM user_account WHERE email = :email) AS user_exists"
+)
+
+INSERT_USER = text(
+    """INSERT INTO user_account (email, first_name, last_name, password, role)
+    VALUES (:email, :first_name, :last_name, :password, :role)"""
+)
+
+LOGIN_USER = text(
+    "SELECT id, email, password, role, is_active FROM user_account WHERE email = :email"
+)
+
+# Only replaces the hash the login checked, so a password changed meanwhile is kept
+REHASH_PASSWORD = text(
+    "UPDATE user_account SET password = :password WHERE id = :user_id AND password = :old_password"
+)
+
+NON_ADMIN_USER = text(
+    "SELECT id, email, role FROM user_account WHERE email = :email AND role != 'admin'"
+)
+
+MAKE_ADMIN = text("UPDATE user_account SET role = 'admin' WHERE email = :email")
+
+USER = text(
+    "SELECT id, email, first_name, last_name, is_active, role FROM user_account WHERE id = :user_id"
+)
+
+USER_BOOKS_BORROWED = text(
+    """SELECT borrow.id AS borrow_id, borrow.borrow_date, borrow.received_by_id, borrow.is_returned, borrow.book_id, book.title AS borrowed_book, fine.id AS fine_id, fine.amount AS fine_amount, fine.paid AS fine_paid, fine.date_created AS fine_date_created, fine.collected_by_id AS fine_collected_by_id, fine.date_paid AS fine_date_paid
+    FROM borrow
+    JOIN book ON book.id = borrow.book_id
+    LEFT JOIN fine ON fine.borrow_id = borrow.id
+    WHERE borrow.borrowed_by_id = :user_id"""
+)
+
+USER_BOOKS_RECEIVED = text(
+    """SELECT borrow.id AS borrow_id, borrow.borrow_date, borrow.borrowed_by_id, borrow.is_returned, borrow.book_id, borrow.return_date, book.title AS borrowed_book
+    FROM borrow
+    JOIN book ON book.id = borrow.book_id
+    WHERE borrow.received_by_id = :user_id"""
+)
+
+USER_FINES_COLLECTED = text(
+    """SELECT fine.id AS fine_id, fine.borrow_id, fine.amount AS fine_amount, fine.paid AS fine_paid, fine.date_created AS fine_date_created, fine.collected_by_id, fine.date_paid AS fine_date_paid, borrow.borrow_date, borrow.borrowed_by_id, borrow.received_by_id, borrow.is_returned, borrow.book_id, book.title AS borrowed_book
+    FROM fine
+    JOIN borrow ON borrow.id = fine.borrow_id
+    JOIN book ON book.id = borrow.book_id
+    WHERE fine.collected_by_id = :user_id"""
+)
+
+USER_BOOKS_GIVEN = text(
+    """SELECT borrow.id AS borrow_id, borrow.borrow_date, borrow.borrowed_by_id, borrow.is_returned, borrow.book_id, book.title AS borrowed_book
+    FROM borrow
+    JOIN book ON book.id = borrow.book_id
+    WHERE borrow.given_by_id = :user_id"""
+)
+
+DEACTIVATE_USER = text(
+    "UPDATE user_account SET is_active = FALSE WHERE email = :email AND is_active = TRUE RETURNING id"
+)
+
+ACTIVATE_USER = text(
+    "UPDATE user_account SET is_active = TRUE WHERE email = :email AND is_active = FALSE RETURNING id"
+)
+
+
+@lru_cache(maxsize=None)
+def update_statement(table: str, columns: tuple[str, ...]):
+    """
+    `UPDATE table SET column = :column, ... WHERE id = :id` for partial updates.
+
+    The columns must come from a fixed set of field names, never from the request, so the
+    number of distinct statements stays bounded and each one is only built once.
+    """
+    assignments = ", ".join(f"{column} = :{column}" for column in columns)
+    return text(f"UPDATE {table} SET {assignments} WHERE id = :id")
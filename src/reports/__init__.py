@@ -1,16 +1,107 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from http import HTTPStatus
 
 from flask import jsonify, make_response, request
 from flask_restx import Namespace, Resource
-from sqlalchemy import func, select
+from sqlalchemy import Date, bindparam, func, select, text
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
 
 import src.models as md
 import src.p_models as pmd
 from src.auth.oauth import admin_required
-from src.utils import VALID_USER_TYPES, session, sql_compile
+from src.utils import (
+    EXPORT_BATCH_SIZE,
+    EXPORT_FORMATS,
+    ROLLUP_PERIODS,
+    VALID_USER_TYPES,
+    fine_month,
+    fine_totals,
+    json_response,
+    keyset_select,
+    next_period_start,
+    order_clauses,
+    page_args,
+    paginate,
+    period_range,
+    period_start,
+    periods_between,
+    serialize_rows,
+    session,
+    sql_compile,
+    stream_export,
+    sum_totals,
+)
 
 reports_namespace = Namespace("Reports", description="Reports operations", path="/")
 
+OVERDUE_EXPORT_FIELDS = [
+    "id",
+    "book_id",
+    "book",
+    "borrowed_by_id",
+    "borrowed_by",
+    "borrower_role",
+    "given_by",
+    "received_by",
+    "borrow_date",
+    "due_date",
+    "return_date",
+    "is_returned",
+    "fines",
+]
+
+FINE_EXPORT_FIELDS = [
+    "id",
+    "borrow_id",
+    "book",
+    "borrowed_by_id",
+    "borrowed_by",
+    "borrower_role",
+    "amount",
+    "paid",
+    "date_created",
+    "date_paid",
+    "payment_method",
+    "transaction_id",
+    "collected_by",
+]
+
+
+def overdue_export_row(borrow: md.Borrow) -> dict:
+    return {
+        "id": borrow.id,
+        "book_id": borrow.book_id,
+        "book": borrow.borrowed_book.title,
+        "borrowed_by_id": borrow.borrowed_by_id,
+        "borrowed_by": str(borrow.borrowed_by),
+        "borrower_role": borrow.borrowed_by.role,
+        "given_by": str(borrow.given_by),
+        "received_by": str(borrow.received_by) if borrow.received_by else None,
+        "borrow_date": borrow.borrow_date,
+        "due_date": borrow.due_date,
+        "return_date": borrow.return_date,
+        "is_returned": borrow.is_returned,
+        "fines": sum(fine.amount for fine in borrow.fines),
+    }
+
+
+def fine_export_row(fine: md.Fine) -> dict:
+    return {
+        "id": fine.id,
+        "borrow_id": fine.borrow_id,
+        "book": fine.borrow.borrowed_book.title,
+        "borrowed_by_id": fine.borrow.borrowed_by_id,
+        "borrowed_by": str(fine.borrow.borrowed_by),
+        "borrower_role": fine.borrow.borrowed_by.role,
+        "amount": fine.amount,
+        "paid": fine.paid,
+        "date_created": fine.date_created,
+        "date_paid": fine.date_paid,
+        "payment_method": fine.payment_method,
+        "transaction_id": fine.transaction_id,
+        "collected_by": str(fine.collected_by) if fine.collected_by else None,
+    }
+
 
 @reports_namespace.route("/overdue-report")
 class OverdueReports(Resource):
@@ -21,11 +112,19 @@ class OverdueReports(Resource):
         returned = request.args.get("returned", "false")
         # Base query to select borrow records and user roles where the book is overdue and not returned
         stmt = (
-            select(md.Borrow, md.UserAccount.role).where(
+            select(md.Borrow).where(
                 md.Borrow.due_date < today,  # Filter by due date
             )
             # Explicitly specify the join condition between Borrow and UserAccount
             .join(md.UserAccount, md.Borrow.borrowed_by)  # Use the borrowed_by relationship
+            # Load everything AdminListBorrowSchema reads, so the report costs a fixed number of queries
+            .options(
+                contains_eager(md.Borrow.borrowed_by),
+                joinedload(md.Borrow.borrowed_book),
+                joinedload(md.Borrow.given_by),
+                joinedload(md.Borrow.received_by),
+                selectinload(md.Borrow.fines),
+            )
         )
 
         if returned == "true":
@@ -37,24 +136,42 @@ class OverdueReports(Resource):
         elif returned == "both":
             pass
 
-        if request.args.get("sort") == "asc":
-            stmt = stmt.order_by(md.Borrow.due_date.asc())
-
-        elif request.args.get("sort") == "desc":
-            stmt = stmt.order_by(md.Borrow.due_date.desc())
+        # The borrow id breaks ties so every page boundary is unambiguous
+        sort = request.args.get("sort")
+        sort_by_due_date = sort in ("asc", "desc")
+        if sort_by_due_date:
+            order_keys = [(md.Borrow.due_date, sort == "desc"), (md.Borrow.id, sort == "desc")]
+        else:
+            order_keys = [(md.Borrow.id, False)]
 
         if user_type in VALID_USER_TYPES:
-            stmt = stmt.where(md.Borrow.borrowed_by.has(md.UserAccount.role == user_type))
+            stmt = stmt.where(md.UserAccount.role == user_type)
 
-        borrows = session.execute(stmt).scalars().all()
-        borrows = [pmd.AdminListBorrowSchema.model_validate(borrow) for borrow in borrows]
-        return make_response(
-            jsonify(
-                {
-                    "borrows": [borrow.model_dump() for borrow in borrows],
-                    "queries": [sql_compile(stmt)],
-                }
+        export_format = request.args.get("format")
+        if export_format in EXPORT_FORMATS:
+            stmt = stmt.order_by(*order_clauses(order_keys))
+            borrows = session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+            return stream_export(
+                (overdue_export_row(borrow) for borrow in borrows.scalars()),
+                export_format,
+                "overdue-report",
+                OVERDUE_EXPORT_FIELDS,
             )
+
+        limit, cursor = page_args()
+        stmt = keyset_select(stmt, order_keys, cursor, limit)
+        borrows = session.execute(stmt).scalars().all()
+        borrows, next_cursor = paginate(
+            borrows,
+            limit,
+            lambda borrow: [borrow.due_date, borrow.id] if sort_by_due_date else [borrow.id],
+        )
+        return json_response(
+            {
+                "borrows": serialize_rows(pmd.AdminListBorrowSchema, borrows),
+                "next_cursor": next_cursor,
+                "queries": [sql_compile(stmt)],
+            }
         )
 
 
@@ -63,71 +180,90 @@ class Fines(Resource):
     @admin_required
     def get(self):
         stmt = (
-            select(md.Fine, md.UserAccount.id, md.UserAccount.role)  # Select Fine and UserAccount
+            select(md.Fine)
             .join(md.Borrow, md.Fine.borrow_id == md.Borrow.id)  # Join Fine with Borrow
             .join(
                 md.UserAccount, md.Borrow.borrowed_by_id == md.UserAccount.id
             )  # Join Borrow with UserAccount
+            # Reuse the joins above to load the borrow and borrower, join the rest
+            .options(
+                contains_eager(md.Fine.borrow).options(
+                    contains_eager(md.Borrow.borrowed_by),
+                    joinedload(md.Borrow.borrowed_book),
+                    joinedload(md.Borrow.given_by),
+                    joinedload(md.Borrow.received_by),
+                    selectinload(md.Borrow.fines),
+                ),
+                joinedload(md.Fine.collected_by),
+            )
         )
+        criteria = []
         user_type = request.args.get("user_type")
         if user_type in VALID_USER_TYPES:
-            stmt = stmt.where(md.UserAccount.role == user_type)
-        else:
-            user_type = None
-
-        if request.args.get("sort_date_paid") == "asc":
-            stmt = stmt.order_by(md.Fine.date_paid.asc())
+            criteria.append(md.UserAccount.role == user_type)
 
-        elif request.args.get("sort_date_paid") == "desc":
-            stmt = stmt.order_by(md.Fine.date_paid.desc())
-
-        if request.args.get("sort_date_created") == "asc":
-            stmt = stmt.order_by(md.Fine.date_created.asc())
+        # Unpaid fines sort as the earliest possible payment date, so the key is never NULL
+        order_keys = []
+        row_keys = []
+        sort_date_paid = request.args.get("sort_date_paid")
+        if sort_date_paid in ("asc", "desc"):
+            order_keys.append(
+                (func.coalesce(md.Fine.date_paid, datetime.min), sort_date_paid == "desc")
+            )
+            row_keys.append(lambda fine: fine.date_paid or datetime.min)
 
-        elif request.args.get("sort_date_created") == "desc":
-            stmt = stmt.order_by(md.Fine.date_created.desc())
+        sort_date_created = request.args.get("sort_date_created")
+        if sort_date_created in ("asc", "desc"):
+            order_keys.append((md.Fine.date_created, sort_date_created == "desc"))
+            row_keys.append(lambda fine: fine.date_created)
 
-        # Calculate total fines using the same filters
-        total_query = (
-            select(func.sum(md.Fine.amount).label("total_fines"))
-            .join(md.Borrow, md.Fine.borrow_id == md.Borrow.id)
-            .join(md.UserAccount, md.Borrow.borrowed_by_id == md.UserAccount.id)
-        )
-        if user_type:
-            total_query = total_query.where(md.UserAccount.role == user_type)
+        order_keys.append((md.Fine.id, False))
+        row_keys.append(lambda fine: fine.id)
 
         status = request.args.get("status")
-        paid_query = total_query.where(md.Fine.paid.is_(True))
-        unpaid_query = total_query.where(md.Fine.paid.is_(False))
-        paid = None
-        unpaid = None
-
         if status == "paid":
-            stmt = stmt.where(md.Fine.paid.is_(True))
-            queries = [sql_compile(paid_query)]
-            paid = session.execute(paid_query).scalar()
+            criteria.append(md.Fine.paid.is_(True))
 
         elif status == "unpaid":
-            stmt = stmt.where(md.Fine.paid.is_(False))
-            queries = [sql_compile(unpaid_query)]
-            unpaid = session.execute(unpaid_query).scalar()
+            criteria.append(md.Fine.paid.is_(False))
 
-        else:
-            paid = session.execute(paid_query).scalar()
-            unpaid = session.execute(unpaid_query).scalar()
-            queries = [sql_compile(paid_query), sql_compile(unpaid_query)]
+        stmt = stmt.where(*criteria)
+
+        export_format = request.args.get("format")
+        if export_format in EXPORT_FORMATS:
+            stmt = stmt.order_by(*order_clauses(order_keys))
+            fines = session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+            return stream_export(
+                (fine_export_row(fine) for fine in fines.scalars()),
+                export_format,
+                "fines-report",
+                FINE_EXPORT_FIELDS,
+            )
 
+        # The totals broken down by borrower role, payment method and month, in one pass
+        # with the same filters. The grand totals add up the breakdown.
+        month = fine_month(md.Fine.date_created).label("month")
+        total_query = fine_totals(
+            *criteria, group_by=(md.UserAccount.role, md.Fine.payment_method, month)
+        )
+        queries = [sql_compile(total_query)]
+        breakdown = [row._asdict() for row in session.execute(total_query)]
+        paid = sum_totals(breakdown, "paid")
+        unpaid = sum_totals(breakdown, "unpaid")
+
+        limit, cursor = page_args()
+        stmt = keyset_select(stmt, order_keys, cursor, limit)
         queries.insert(0, sql_compile(stmt))
         fines = session.execute(stmt).scalars().all()
-        fines = [pmd.AdminFineListSchema.model_validate(fine) for fine in fines]
-        return make_response(
-            jsonify(
-                {
-                    "fines": [fine.model_dump() for fine in fines],
-                    "total": {"paid": paid, "unpaid": unpaid},
-                    "queries": queries,
-                }
-            )
+        fines, next_cursor = paginate(fines, limit, lambda fine: [key(fine) for key in row_keys])
+        return json_response(
+            {
+                "fines": serialize_rows(pmd.AdminFineListSchema, fines),
+                "next_cursor": next_cursor,
+                "total": {"paid": paid, "unpaid": unpaid},
+                "breakdown": breakdown,
+                "queries": queries,
+            }
         )
 
 
@@ -141,31 +277,117 @@ class Trends(Resource):
         category = request.args.get("category")
         returned = request.args.get("returned")
 
-        stmt = select(md.Borrow)
+        stmt = select(md.Borrow).options(
+            joinedload(md.Borrow.borrowed_by),
+            joinedload(md.Borrow.given_by),
+            joinedload(md.Borrow.received_by),
+            selectinload(md.Borrow.fines),
+        )
         if user_type in VALID_USER_TYPES:
             stmt = stmt.where(md.Borrow.borrowed_by.has(role=user_type))
 
         if time_filter in valid_time_filter:
-            stmt = stmt.where(
-                func.extract(time_filter, md.Borrow.borrow_date)
-                == func.extract(time_filter, datetime.now())
-            )
+            # A range on the column itself, so the borrow_date index can serve it
+            start, end = period_range(time_filter, datetime.now())
+            stmt = stmt.where(md.Borrow.borrow_date >= start, md.Borrow.borrow_date < end)
 
         if category:
-            stmt = stmt.join(md.Book).where(md.Book.category_id == category)
+            stmt = (
+                stmt.join(md.Book)
+                .where(md.Book.category_id == category)
+                .options(contains_eager(md.Borrow.borrowed_book))
+            )
+        else:
+            stmt = stmt.options(joinedload(md.Borrow.borrowed_book))
 
         if returned == "true":
             stmt = stmt.where(md.Borrow.is_returned.is_(True))
         elif returned == "false":
             stmt = stmt.where(md.Borrow.is_returned.is_(False))
 
+        limit, cursor = page_args()
+        stmt = keyset_select(stmt, [(md.Borrow.id, False)], cursor, limit)
         borrows = session.execute(stmt).scalars().all()
-        borrows = [pmd.AdminListBorrowSchema.model_validate(borrow) for borrow in borrows]
-        return make_response(
-            jsonify(
+        borrows, next_cursor = paginate(borrows, limit, lambda borrow: [borrow.id])
+        return json_response(
+            {
+                "borrows": serialize_rows(pmd.AdminListBorrowSchema, borrows),
+                "next_cursor": next_cursor,
+                "queries": [sql_compile(stmt)],
+            }
+        )
+
+
+@reports_namespace.route("/borrowing-trends/series")
+class TrendSeries(Resource):
+    # How far back the series goes when no start date is given
+    default_periods = {"day": 90, "week": 26, "month": 12}
+
+    @admin_required
+    def get(self):
+        period = request.args.get("period", "day")
+        if period not in ROLLUP_PERIODS:
+            return make_response(
+                jsonify(error=f"Invalid period. Must be one of {ROLLUP_PERIODS}"),
+                HTTPStatus.BAD_REQUEST,
+            )
+        window = max(1, request.args.get("window", 7, type=int))
+        try:
+            end = period_start(period, date.fromisoformat(request.args.get("end")))
+        except (TypeError, ValueError):
+            end = period_start(period, datetime.now())
+        try:
+            start = period_start(period, date.fromisoformat(request.args.get("start")))
+        except (TypeError, ValueError):
+            start = end
+            for _ in range(self.default_periods[period] - 1):
+                start = period_start(period, start - timedelta(days=1))
+        # One entry is built per period, so the span is bounded like a page size
+        most = 3 * self.default_periods[period]
+        if not 1 <= periods_between(period, start, end) <= most:
+            return make_response(
+                jsonify(error=f"start must not be after end, and at most {most} {period}s apart"),
+                HTTPStatus.BAD_REQUEST,
+            )
+
+        # The rollups hold one row per period, category, role and returned state, so this
+        # reads a few hundred rows at most instead of scanning borrow
+        stmt = """SELECT period_start, SUM(borrow_count) AS borrows FROM borrow_rollup
+        WHERE period = :period AND period_start >= :start AND period_start <= :end"""
+        params = {"period": period, "start": start, "end": end}
+        user_type = request.args.get("user_type")
+        if user_type in VALID_USER_TYPES:
+            stmt += " AND role = :role"
+            params["role"] = user_type
+        category = request.args.get("category", type=int)
+        if category:
+            stmt += " AND category_id = :category_id"
+            params["category_id"] = category
+        returned = request.args.get("returned")
+        if returned in ("true", "false"):
+            stmt += " AND is_returned = :is_returned"
+            params["is_returned"] = returned == "true"
+        stmt += " GROUP BY period_start"
+        stmt = text(stmt).bindparams(bindparam("start", type_=Date), bindparam("end", type_=Date))
+        rows = session.execute(stmt.columns(period_start=Date), params).mappings().all()
+        counts = {row.period_start: row.borrows for row in rows}
+
+        # Periods without borrows are not stored, fill them in so the average is over time
+        series = []
+        recent = []
+        current = start
+        while current <= end:
+            borrows = counts.get(current, 0)
+            recent = (recent + [borrows])[-window:]
+            series.append(
                 {
-                    "borrows": [borrow.model_dump() for borrow in borrows],
-                    "queries": [sql_compile(stmt)],
+                    "period_start": current.isoformat(),
+                    "borrows": borrows,
+                    "moving_average": round(sum(recent) / len(recent), 2),
                 }
             )
+            current = next_period_start(period, current)
+
+        return make_response(
+            jsonify({"series": series, "window": window, "queries": [sql_compile(stmt)]})
         )
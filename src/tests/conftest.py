@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+
+import pytest
+
+from src.utils import track_queries
+
+
+@pytest.fixture
+def query_budget():
+    """
+    Fail when a block runs more statements than its budget.
+
+    Usage:
+        with query_budget(3):
+            client.get("/books")
+    """
+
+    @contextmanager
+    def budget(max_queries: int):
+        with track_queries() as stats:
+            yield stats
+        assert (
+            stats.count <= max_queries
+        ), f"{stats.count} queries, budget is {max_queries}:\n" + "\n".join(stats.statements)
+
+    return budget
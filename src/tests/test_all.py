@@ -1,29 +1,67 @@
+import csv
+import io
+import itertools
+import json
 import logging
+import multiprocessing
+import os
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from http import HTTPStatus
 from random import choice, choices, randint
+from unittest import mock
 
+import pytest
 from faker import Faker
+from flask import jsonify
 from flask_jwt_extended import create_access_token
-from sqlalchemy import and_, func
+from sqlalchemy import and_, create_engine, event, func, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 from werkzeug.security import generate_password_hash
 
 import src.models as md
+import src.p_models as pmd
+import src.queries as qs
+from config import ProdConfig
 from src import create_app
+from src.migrations import MIGRATIONS, migrate, operations
+from src.populate_db import generate
 from src.models import Base
 from src.utils import (
+    MAX_BORROWS,
     VALID_USER_TYPES,
+    LocalBroker,
+    PasswordHasher,
+    TTLCache,
     calculate_due_date,
     check_overdue_and_create_fine,
+    checkout_book,
+    configure_sqlite,
     engine,
+    fingerprint,
+    full_scans,
+    import_books,
+    invalidate_user,
+    serialize_rows,
     session,
+    sweep_overdue_fines,
+    track_queries,
 )
 
 fake = Faker()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
+def drop_schema(engine):
+    """Drop the tables of a generated library, and the record of the migrations that built it."""
+    Base.metadata.drop_all(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS schema_migrations")
+
+
 def populate_test_db():
     users = [
         md.UserAccount(
@@ -47,7 +85,7 @@ def populate_test_db():
             title=fake.sentence(3),
             author=fake.name(),
             category_id=choice(categories).id,
-            isbn=fake.isbn13(),
+            isbn=fake.isbn13(separator=""),
             original_quantity=10,
             current_quantity=10,
             location=fake.word(),
@@ -62,7 +100,21 @@ def populate_test_db():
     return users
 
 
+def checkout_in_new_engine(database_url, book_id, borrower_id, given_by_id):
+    """Checkout from a separate engine, so it can run in a child process."""
+    engine = create_engine(database_url, connect_args={"timeout": 30})
+    with Session(engine) as db:
+        error, _ = checkout_book(book_id, borrower_id, given_by_id, db=db)
+        db.commit()
+    engine.dispose()
+    return error
+
+
 class AllTestCase(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def use_fixtures(self, query_budget):
+        self.query_budget = query_budget
+
     def setUp(self):
         # Create the application instance
         self.app = create_app()
@@ -128,6 +180,7 @@ class AllTestCase(unittest.TestCase):
         self.assertEqual(session.query(md.Book).count(), books_count + 1)
         self.assertTrue(book)
         self.assertTrue(book.added_by_id == self.admin.id)
+        self.assertEqual(book.isbn, data["isbn"].replace("-", ""))
 
     def test_update_book(self):
         book = session.query(md.Book).first()
@@ -143,6 +196,113 @@ class AllTestCase(unittest.TestCase):
         self.assertTrue(book.current_quantity == 2)
         self.assertTrue(book.location == data["location"])
 
+    def test_bulk_book_import(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        book = session.query(md.Book).first()
+        book.current_quantity = 9  # one copy lent out
+        session.commit()
+        category_id = book.category_id
+        new_isbn, repeated_isbn = fake.unique.isbn13(), fake.unique.isbn13()
+        feed = "\n".join(
+            [
+                "title,author,isbn,category_id,quantity,location",
+                f"New title,An Author,{new_isbn},{category_id},3,A-1",
+                f"Renamed,{book.author},{book.isbn},{category_id},12,{book.location}",
+                f"Bad isbn,An Author,978-0-306-40615-6,{category_id},1,A-1",
+                f"No category,An Author,{fake.unique.isbn13()},999,1,A-1",
+                f"First,An Author,{repeated_isbn},{category_id},1,A-1",
+                f"Second,An Author,{repeated_isbn},{category_id},2,A-1",
+                f",An Author,{fake.unique.isbn13()},{category_id},1,A-1",
+            ]
+        )
+        response = self.client.post(
+            "/books/import", data=feed, content_type="text/csv", headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.json["created"]), 2)
+        self.assertEqual(len(response.json["updated"]), 2)
+        errors = response.json["errors"]
+        self.assertEqual([error["line"] for error in errors], [4, 5, 8])
+        self.assertEqual(errors[0]["isbn"], "978-0-306-40615-6")
+        self.assertIn("ISBN", errors[0]["error"])
+        self.assertEqual(errors[1]["error"], "Category not found")
+        self.assertIn("title", errors[2]["error"])
+
+        session.expire_all()
+        session.refresh(book)
+        self.assertEqual(book.title, "Renamed")
+        self.assertEqual((book.original_quantity, book.current_quantity), (12, 11))
+        repeated = session.query(md.Book).filter_by(isbn=repeated_isbn.replace("-", "")).one()
+        self.assertEqual((repeated.title, repeated.original_quantity), ("Second", 2))
+        self.assertEqual(
+            session.query(md.Book).filter_by(isbn=new_isbn.replace("-", "")).one().added_by_id,
+            self.admin.id,
+        )
+
+        # ISBNs are stored without hyphens or spaces, so one spelled two ways is one book
+        feed = "\n".join(
+            [
+                "title,author,isbn,category_id,quantity,location",
+                f"Hyphens,An Author,978-0-306-40615-7,{category_id},1,A-1",
+                f"Digits,An Author,9780306406157,{category_id},2,A-1",
+                f"Spaces,An Author,978 0 306 40615 7,{category_id},3,A-1",
+            ]
+        )
+        response = self.client.post(
+            "/books/import", data=feed, content_type="text/csv", headers=headers
+        )
+        self.assertEqual(len(response.json["created"]), 1)
+        self.assertEqual(len(response.json["updated"]), 2)
+        spelled = session.query(md.Book).filter_by(isbn="9780306406157").one()
+        self.assertEqual((spelled.title, spelled.original_quantity), ("Spaces", 3))
+
+        # A feed that is not UTF-8 is read up to the bad line, which is reported
+        feed = (
+            "title,author,isbn,category_id,quantity,location\n"
+            f"Latin,An Author,{fake.unique.isbn13()},{category_id},1,A-1\n"
+            f"Caf\xe9,An Author,{fake.unique.isbn13()},{category_id},1,A-1\n"
+        ).encode("latin-1")
+        response = self.client.post(
+            "/books/import", data=feed, content_type="text/csv", headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.json["created"]), 1)
+        self.assertEqual(response.json["errors"][0]["line"], 3)
+        self.assertIn("UTF-8", response.json["errors"][0]["error"])
+
+        feed = f'{{"title": "Json", "author": "A", "isbn": "{fake.unique.isbn13()}", "category_id": {category_id}, "location": "B-2"}}\n{{"title": '
+        response = self.client.post(
+            "/books/import", data=feed, content_type="application/x-ndjson", headers=headers
+        )
+        self.assertEqual(len(response.json["created"]), 1)
+        self.assertEqual(response.json["errors"][0]["line"], 2)
+
+        response = self.client.post(
+            "/books/import", data=feed, content_type="text/plain", headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+        # One statement for the categories, then an ISBN lookup and an upsert per batch
+        rows = [
+            (
+                i,
+                {
+                    "title": "T",
+                    "author": "A",
+                    "isbn": fake.unique.isbn13(),
+                    "category_id": category_id,
+                    "location": "C",
+                },
+                None,
+            )
+            for i in range(5)
+        ]
+        admin_id = self.admin.id
+        with track_queries() as stats:
+            result = import_books(session, rows, admin_id, "sqlite", batch_size=2)
+        self.assertEqual(len(result["created"]), 5)
+        self.assertEqual(stats.count, 1 + 2 * 3)
+
     def test_search_books(self):
         book = session.query(md.Book.author, md.Book.title, md.Category.name).first()
         response = self.client.get(f"/books?author={book.author[:4]}")
@@ -217,6 +377,184 @@ class AllTestCase(unittest.TestCase):
         self.assertTrue(notification)
         self.assertFalse(notification.is_read)
 
+    def test_hold_queue(self):
+        book = session.query(md.Book).first()
+        book.current_quantity = 0
+        session.commit()
+        book_id, student_id, admin_id = book.id, self.student.id, self.admin.id
+        tokens = {
+            "student": self.student_token,
+            "external": self.external_token,
+            "admin": self.admin_token,
+        }
+        headers = {name: {"Authorization": f"Bearer {token}"} for name, token in tokens.items()}
+
+        for position, name in enumerate(("student", "external", "admin"), start=1):
+            response = self.client.post("/holds", json={"book_id": book_id}, headers=headers[name])
+            self.assertEqual(response.status_code, HTTPStatus.CREATED)
+            self.assertEqual(response.json["position"], position)
+        hold_ids = {
+            hold.user_id: hold.id for hold in session.query(md.Hold).filter_by(book_id=book_id)
+        }
+        response = self.client.post("/holds", json={"book_id": book_id}, headers=headers["student"])
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self.client.post(
+            "/holds", json={"book_id": book_id + 1}, headers=headers["student"]
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+        # The holds behind a cancelled one move up
+        response = self.client.delete(
+            f"/holds/{hold_ids[self.external.id]}", headers=headers["external"]
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(
+            self.client.get("/holds", headers=headers["admin"]).json["holds"][0]["position"], 2
+        )
+
+        def return_a_copy():
+            borrow = md.Borrow(
+                book_id=book_id,
+                borrowed_by_id=admin_id,
+                given_by_id=admin_id,
+                borrow_date=datetime.now(),
+                due_date=calculate_due_date(),
+            )
+            session.add(borrow)
+            session.commit()
+            response = self.client.post(
+                "/return-book", json={"borrow_id": borrow.id}, headers=headers["admin"]
+            )
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+
+        # A returned copy is set aside for the head of the queue, who is notified
+        return_a_copy()
+        holds = self.client.get("/holds", headers=headers["student"]).json["holds"]
+        self.assertEqual((holds[0]["status"], holds[0]["position"]), ("ready", None))
+        self.assertEqual(
+            self.client.get("/holds", headers=headers["admin"]).json["holds"][0]["position"], 1
+        )
+        session.expire_all()
+        self.assertEqual(session.get(md.Book, book_id).current_quantity, 0)
+        notification = session.query(md.Notification).filter_by(user_id=student_id).one()
+        self.assertIn("ready to collect", notification.message)
+
+        # Only the patron it was set aside for can borrow it
+        response = self.client.post(
+            "/borrow-book",
+            json={"book_id": book_id, "borrower_id": self.external.id},
+            headers=headers["admin"],
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self.client.post(
+            "/borrow-book",
+            json={"book_id": book_id, "borrower_id": student_id},
+            headers=headers["admin"],
+        )
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(session.get(md.Hold, hold_ids[student_id]).status, "fulfilled")
+
+        # Cancelling a ready hold passes the copy on, and with the queue empty it is shelved
+        return_a_copy()
+        self.assertEqual(
+            self.client.get("/holds", headers=headers["admin"]).json["holds"][0]["status"], "ready"
+        )
+        self.client.delete(f"/holds/{hold_ids[admin_id]}", headers=headers["admin"])
+        session.expire_all()
+        self.assertEqual(session.get(md.Book, book_id).current_quantity, 1)
+
+        with engine.connect() as conn:
+            plan = conn.execute(
+                text("EXPLAIN QUERY PLAN " + qs.PROMOTE_HOLD.text),
+                {"book_id": book_id, "now": datetime.now(), "expires_at": datetime.now()},
+            ).all()
+        self.assertIn("idx_hold_queue", " ".join(row.detail for row in plan))
+
+    def test_added_copies_go_to_the_queue(self):
+        book = session.query(md.Book).first()
+        book.current_quantity = 0
+        session.commit()
+        book_id, isbn, category_id = book.id, book.isbn, book.category_id
+        admin_headers = {"Authorization": f"Bearer {self.admin_token}"}
+        for token in (self.student_token, self.external_token):
+            response = self.client.post(
+                "/holds", json={"book_id": book_id}, headers={"Authorization": f"Bearer {token}"}
+            )
+            self.assertEqual(response.status_code, HTTPStatus.CREATED)
+
+        def statuses():
+            session.expire_all()
+            holds = session.query(md.Hold).filter_by(book_id=book_id).order_by(md.Hold.seq)
+            return [hold.status for hold in holds], session.get(md.Book, book_id).current_quantity
+
+        # One copy more on the shelf is set aside for the head of the queue, not shelved
+        response = self.client.put(f"/books/{book_id}", json={"quantity": 1}, headers=admin_headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(statuses(), (["ready", "waiting"], 0))
+        response = self.client.post(
+            "/borrow-book",
+            json={"book_id": book_id, "borrower_id": self.admin.id},
+            headers=admin_headers,
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+        # An import adding copies serves the rest of the queue, then shelves what is left
+        session.expire_all()
+        original = session.get(md.Book, book_id).original_quantity
+        feed = "\n".join(
+            [
+                "title,author,isbn,category_id,quantity,location",
+                f"Restocked,An Author,{isbn},{category_id},{original + 3},A-1",
+            ]
+        )
+        response = self.client.post(
+            "/books/import", data=feed, content_type="text/csv", headers=admin_headers
+        )
+        self.assertEqual(response.json["updated"], [book_id])
+        self.assertEqual(statuses(), (["ready", "ready"], 2))
+        self.assertEqual(
+            session.query(md.Notification)
+            .filter(md.Notification.message.contains("ready"))
+            .count(),
+            2,
+        )
+
+    def test_hold_queue_race(self):
+        book = session.query(md.Book).first()
+        book.current_quantity = 0
+        session.commit()
+        book_id, external_id = book.id, self.external.id
+        headers = {"Authorization": f"Bearer {self.student_token}"}
+
+        # Another patron queued in between the student's hold reading the tail of the queue
+        # and inserting, so its first try takes a seq that is no longer free
+        session.add(md.Hold(book_id=book_id, user_id=external_id, seq=1, placed_at=datetime.now()))
+        session.commit()
+        raced = []
+
+        def stale_tail(conn, cursor, statement, parameters, context, executemany):
+            if statement == qs.PLACE_HOLD.compile(engine).string and not raced:
+                raced.append(statement)
+                statement = statement.replace("COALESCE(MAX(seq), 0) + 1", "1")
+            return statement, parameters
+
+        event.listen(engine, "before_cursor_execute", stale_tail, retval=True)
+        try:
+            response = self.client.post("/holds", json={"book_id": book_id}, headers=headers)
+        finally:
+            event.remove(engine, "before_cursor_execute", stale_tail)
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.json["position"], 2)
+        self.assertEqual(response.json["queries"].count(qs.PLACE_HOLD.text), 2)
+
+        # Two waiting holds cannot share a place
+        with self.assertRaises(IntegrityError):
+            session.add(
+                md.Hold(book_id=book_id, user_id=self.admin.id, seq=2, placed_at=datetime.now())
+            )
+            session.flush()
+        session.rollback()
+
     def test_fines_report(self):
         student_2 = md.UserAccount(
             email=fake.email(),
@@ -268,3 +606,1359 @@ class AllTestCase(unittest.TestCase):
         total_fines = session.query(md.Fine).with_entities(func.sum(md.Fine.amount)).scalar()
         self.assertTrue(total_fines == response.json["total"]["unpaid"])
         assert "total" in response.json
+
+    def test_search_index_stays_in_sync(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        category = session.query(md.Category).first()
+        data = {
+            "title": "Quixotic Zeppelins",
+            "author": fake.name(),
+            "category_id": category.id,
+            "isbn": fake.isbn13(),
+            "quantity": 1,
+            "location": fake.word(),
+        }
+        response = self.client.post("/books", json=data, headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        book_id = response.json["book_id"]
+
+        response = self.client.get("/books?title=zeppel")
+        self.assertEqual([book["id"] for book in response.json["books"]], [book_id])
+
+        response = self.client.put(
+            f"/books/{book_id}", json={"title": "Quixotic Airships"}, headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertFalse(self.client.get("/books?title=zeppel").json["books"])
+        self.assertTrue(self.client.get("/books?title=airship").json["books"])
+
+        response = self.client.delete(f"/books/{book_id}", headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertFalse(self.client.get("/books?title=airship").json["books"])
+
+    def test_search_ranks_title_matches_first(self):
+        category = session.query(md.Category).first()
+        books = [
+            md.Book(
+                title="Collected Essays",
+                author="Xavier Quill",
+                category_id=category.id,
+                isbn=fake.isbn13(),
+                location=fake.word(),
+                date_added=datetime.now(),
+                added_by_id=self.admin.id,
+            ),
+            md.Book(
+                title="Quill and Ink",
+                author=fake.name(),
+                category_id=category.id,
+                isbn=fake.isbn13(),
+                location=fake.word(),
+                date_added=datetime.now(),
+                added_by_id=self.admin.id,
+            ),
+        ]
+        session.add_all(books)
+        session.commit()
+
+        response = self.client.get("/books?title=quill&author=quill")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        titles = [book["title"] for book in response.json["books"]]
+        self.assertEqual(titles[:2], ["Quill and Ink", "Collected Essays"])
+
+    def test_overdue_sweep(self):
+        books = session.query(md.Book).limit(4).all()
+        now = datetime.now()
+        due_dates = [now - timedelta(days=3), now - timedelta(days=10), now + timedelta(days=1)]
+        borrows = [
+            md.Borrow(
+                book_id=book.id,
+                borrowed_by_id=self.student.id,
+                given_by_id=self.admin.id,
+                borrow_date=due_date - timedelta(days=14),
+                due_date=due_date,
+            )
+            for book, due_date in zip(books, due_dates)
+        ]
+        # Overdue but already returned, should be left alone
+        borrows.append(
+            md.Borrow(
+                book_id=books[3].id,
+                borrowed_by_id=self.external.id,
+                given_by_id=self.admin.id,
+                borrow_date=now - timedelta(days=30),
+                due_date=now - timedelta(days=16),
+                is_returned=True,
+            )
+        )
+        session.add_all(borrows)
+        session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=["overdue-sweep"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("2 fines created or updated, 2 borrowers notified", result.output)
+        fines = {fine.borrow_id: fine.amount for fine in session.query(md.Fine).all()}
+        self.assertEqual(fines, {borrows[0].id: 300, borrows[1].id: 1000})
+
+        # A later sweep grows unpaid fines, keeps paid ones and only notifies new overdues
+        session.query(md.Fine).where(md.Fine.borrow_id == borrows[1].id).update({"paid": True})
+        session.commit()
+        fines, notifications, _ = sweep_overdue_fines(now + timedelta(days=2))
+        session.commit()
+        self.assertEqual((fines, notifications), (2, 1))
+        fines = {fine.borrow_id: fine.amount for fine in session.query(md.Fine).all()}
+        self.assertEqual(fines, {borrows[0].id: 500, borrows[1].id: 1000, borrows[2].id: 100})
+        self.assertEqual(session.query(md.Notification).count(), 3)
+
+    def test_borrower_counters(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        book_ids = [book.id for book in session.query(md.Book).limit(7)]
+        student_id, external_id = self.student.id, self.external.id
+
+        def borrow(book_id, borrower_id):
+            data = {"book_id": book_id, "borrower_id": borrower_id}
+            return self.client.post("/borrow-book", json=data, headers=headers)
+
+        def counters(user_id):
+            session.expire_all()
+            user = session.get(md.UserAccount, user_id)
+            return user.active_loans, user.outstanding_balance
+
+        for book_id in book_ids[:MAX_BORROWS]:
+            self.assertEqual(borrow(book_id, student_id).status_code, HTTPStatus.CREATED)
+        self.assertEqual(counters(student_id), (MAX_BORROWS, 0))
+        response = borrow(book_ids[5], student_id)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn("maximum limit", response.json["error"])
+        # The rejected checkout leaves both the shelf and the counter as they were
+        self.assertEqual(session.get(md.Book, book_ids[5]).current_quantity, 10)
+        self.assertEqual(counters(student_id), (MAX_BORROWS, 0))
+
+        # Returned books no longer count against the limit
+        borrow_id = (
+            session.query(md.Borrow.id).where(md.Borrow.borrowed_by_id == student_id).first()
+        )
+        response = self.client.post(
+            "/return-book", json={"borrow_id": borrow_id[0]}, headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(counters(student_id), (MAX_BORROWS - 1, 0))
+        self.assertEqual(borrow(book_ids[5], student_id).status_code, HTTPStatus.CREATED)
+
+        # Fines grow the balance, and owing more than the limit blocks borrowing
+        self.assertEqual(borrow(book_ids[6], external_id).status_code, HTTPStatus.CREATED)
+        now = datetime.now()
+        session.query(md.Borrow).where(md.Borrow.borrowed_by_id == external_id).update(
+            {"due_date": now - timedelta(days=8)}
+        )
+        session.commit()
+        sweep_overdue_fines(now)
+        sweep_overdue_fines(now + timedelta(days=3))
+        session.commit()
+        self.assertEqual(counters(external_id), (1, 1100))
+        response = borrow(book_ids[0], external_id)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn("unpaid fines", response.json["error"])
+
+        fine_id = session.query(md.Fine.id).scalar()
+        response = self.client.post(
+            f"/pay-fine/{fine_id}", json={"method": "cash"}, headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = self.client.post(
+            f"/pay-fine/{fine_id}", json={"method": "cash"}, headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        self.assertEqual(counters(external_id), (1, 0))
+        self.assertEqual(borrow(book_ids[0], external_id).status_code, HTTPStatus.CREATED)
+
+        # Repair recounts drifted counters from the borrows and fines
+        session.query(md.UserAccount).update({"active_loans": 3, "outstanding_balance": 50})
+        session.commit()
+        result = self.app.test_cli_runner().invoke(args=["repair-counters"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(f"{len(self.users)} users had drifted counters repaired", result.output)
+        self.assertEqual(counters(student_id), (MAX_BORROWS, 0))
+        self.assertEqual(counters(external_id), (2, 0))
+        self.assertEqual(counters(self.admin.id), (0, 0))
+        result = self.app.test_cli_runner().invoke(args=["repair-counters"])
+        self.assertIn("0 users had drifted counters repaired", result.output)
+
+    def test_batch_circulation(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        books = session.query(md.Book).all()
+        books[3].current_quantity = 0
+        session.commit()
+        b = [book.id for book in books]
+        student_id, external_id = self.student.id, self.external.id
+
+        data = {"borrower_id": student_id, "book_ids": [b[0], b[1], b[0], b[3], 9999, b[4], b[5]]}
+        response = self.client.post("/borrow-book/batch", json=data, headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json["message"], "3 of 7 books borrowed")
+        errors = [result.get("error") for result in response.json["results"]]
+        self.assertEqual(
+            errors,
+            [
+                None,
+                None,
+                "Book is listed more than once",
+                "Book is out of stock or is borrowed",
+                "Book not found",
+                None,
+                f"Borrower has reached the maximum limit of {MAX_BORROWS} borrowed books",
+            ],
+        )
+        borrow_ids = [r["borrow_id"] for r in response.json["results"] if "borrow_id" in r]
+        session.expire_all()
+        self.assertEqual(session.get(md.UserAccount, student_id).active_loans, 3)
+        self.assertEqual(
+            [session.get(md.Book, i).current_quantity for i in b[:5]], [9, 9, 10, 0, 9]
+        )
+
+        # The statements run do not grow with the size of the stack: loans, loan slots,
+        # copies, borrows and rollups, plus the user lookup
+        counts = []
+        for book_ids in ([b[6]], [b[7], b[8], b[9]]):
+            data = {"borrower_id": external_id, "book_ids": book_ids}
+            with self.query_budget(6) as stats:
+                response = self.client.post("/borrow-book/batch", json=data, headers=headers)
+            self.assertEqual(
+                response.json["message"], f"{len(book_ids)} of {len(book_ids)} books borrowed"
+            )
+            counts.append(stats.count)
+        self.assertEqual(counts[0], counts[1])
+
+        # One borrow is overdue, and a patron is queueing for the first book
+        session.query(md.Borrow).where(md.Borrow.id == borrow_ids[1]).update(
+            {"due_date": datetime.now() - timedelta(days=2)}
+        )
+        session.add(md.Hold(book_id=b[0], user_id=external_id, seq=1, placed_at=datetime.now()))
+        session.commit()
+        data = {"borrow_ids": borrow_ids + [9999, borrow_ids[0]]}
+        response = self.client.post("/return-book/batch", json=data, headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json["message"], "3 of 5 books returned")
+        errors = [result.get("error") for result in response.json["results"]]
+        self.assertEqual(
+            errors, [None, None, None, "Borrow record not found", "Borrow is listed more than once"]
+        )
+        session.expire_all()
+        self.assertEqual(session.get(md.UserAccount, student_id).active_loans, 0)
+        self.assertEqual(
+            [session.get(md.Book, i).current_quantity for i in b[:5]], [9, 10, 10, 0, 10]
+        )
+        self.assertEqual(session.query(md.Hold.status).scalar(), "ready")
+        fine = session.query(md.Fine).one()
+        self.assertEqual((fine.borrow_id, fine.amount), (borrow_ids[1], 200))
+
+        response = self.client.post(
+            "/return-book/batch", json={"borrow_ids": borrow_ids[:1]}, headers=headers
+        )
+        self.assertEqual(response.json["results"][0]["error"], "Book already returned")
+        for data in ({"borrow_ids": []}, {"borrow_ids": ["1"]}, {"borrow_ids": [1] * 51}):
+            response = self.client.post("/return-book/batch", json=data, headers=headers)
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def open_stream(self, token, last_event_id=None):
+        headers = {"Authorization": f"Bearer {token}"}
+        if last_event_id is not None:
+            headers["Last-Event-ID"] = str(last_event_id)
+        response = self.client.get("/notifications/stream", headers=headers, buffered=False)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        events = (chunk.decode() for chunk in response.response)
+        self.assertEqual(next(events), "retry: 3000\n\n")
+        return response, events
+
+    def test_notification_stream(self):
+        self.app.config["NOTIFICATION_KEEPALIVE"] = 0.05
+        book_ids = [book.id for book in session.query(md.Book).limit(2)]
+        student_id, external_id, admin_id = self.student.id, self.external.id, self.admin.id
+        response, events = self.open_stream(self.student_token)
+
+        # Waiting for events runs no queries
+        with track_queries() as stats:
+            self.assertEqual([next(events) for _ in range(3)], [": keepalive\n\n"] * 3)
+        self.assertEqual(stats.count, 0)
+
+        now = datetime.now()
+        borrow = md.Borrow(
+            book_id=book_ids[0],
+            borrowed_by_id=student_id,
+            given_by_id=admin_id,
+            borrow_date=now - timedelta(days=20),
+            due_date=now - timedelta(days=6),
+        )
+        session.add(borrow)
+        session.commit()
+        borrow_id = borrow.id
+        # Nothing is published until the notification commits
+        sweep_overdue_fines(now)
+        session.rollback()
+        self.assertEqual(next(events), ": keepalive\n\n")
+        sweep_overdue_fines(now)
+        session.commit()
+        notification_id = session.query(md.Notification.id).scalar()
+        event = next(events).split("\n")
+        self.assertEqual(event[:2], [f"id: {notification_id}", "event: notification"])
+        data = json.loads(event[2].removeprefix("data: "))
+        self.assertEqual((data["id"], data["message"]), (notification_id, "You have overdue fines"))
+        self.assertEqual(
+            data,
+            json.loads(
+                self.client.get(
+                    "/notifications", headers={"Authorization": f"Bearer {self.student_token}"}
+                ).get_data()
+            )["notifications"][0],
+        )
+        response.close()
+
+        # A returned copy for a hold notifies the patron holding it, on their stream only
+        session.add(md.Hold(book_id=book_ids[0], user_id=external_id, seq=1, placed_at=now))
+        session.query(md.Book).where(md.Book.id == book_ids[0]).update({"current_quantity": 0})
+        session.commit()
+        external_response, external_events = self.open_stream(self.external_token)
+        student_response, student_events = self.open_stream(self.student_token)
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        response = self.client.post("/return-book", json={"borrow_id": borrow_id}, headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn("is ready to collect", next(external_events))
+        self.assertEqual(next(student_events), ": keepalive\n\n")
+        external_response.close()
+        student_response.close()
+
+        # Reconnecting with Last-Event-ID replays what was missed from the database
+        response, events = self.open_stream(self.student_token, last_event_id=0)
+        self.assertTrue(next(events).startswith(f"id: {notification_id}\n"))
+        self.assertEqual(next(events), ": keepalive\n\n")
+        response.close()
+        response, events = self.open_stream(self.student_token, last_event_id=notification_id)
+        self.assertEqual(next(events), ": keepalive\n\n")
+        response.close()
+
+        # A long absence is caught up on a page at a time, over as many reconnects
+        self.app.config["NOTIFICATION_BACKLOG"] = 2
+        for i in range(4):
+            session.add(md.Notification(user_id=student_id, message=f"Notice {i}", sent_date=now))
+        session.commit()
+        pages, last_id = [], notification_id
+        while True:
+            response, events = self.open_stream(self.student_token, last_event_id=last_id)
+            page = list(itertools.takewhile(lambda event: event.startswith("id: "), events))
+            response.close()
+            if not page:
+                break
+            pages.append(len(page))
+            last_id = int(page[-1].split("\n")[0].removeprefix("id: "))
+        self.assertEqual(pages, [2, 2])
+
+    def test_notification_broker_order(self):
+        broker = LocalBroker(backlog=3)
+        # The transaction that got id 2 commits first
+        broker.publish([(2, self.student.id, "b")])
+        broker.publish([(1, self.student.id, "a"), (3, self.external.id, "c")])
+        self.assertEqual(broker.last_id, 3)
+        self.assertEqual(broker.listen(self.student.id, 0, 0), [(1, "a"), (2, "b")])
+        self.assertEqual(broker.listen(self.student.id, 1, 0), [(2, "b")])
+        self.assertEqual(broker.listen(self.external.id, 0, 0), [(3, "c")])
+        self.assertEqual(broker.listen(self.admin.id, 0, 0), [])
+
+        # The backlog drops what was published first
+        broker.publish([(4, self.student.id, "d")])
+        self.assertEqual(broker.listen(self.student.id, 0, 0), [(1, "a"), (4, "d")])
+        broker.publish([(5, self.external.id, "e"), (6, self.external.id, "f")])
+        self.assertEqual(broker.listen(self.student.id, 0, 0), [(4, "d")])
+        self.assertEqual(broker.listen(self.external.id, 0, 0), [(5, "e"), (6, "f")])
+
+    def test_user_lookup_cache(self):
+        headers = {"Authorization": f"Bearer {self.student_token}"}
+        with track_queries() as stats:
+            self.client.get("/notifications", headers=headers)
+        first = stats.count
+        with track_queries() as stats:
+            self.client.get("/notifications", headers=headers)
+        self.assertEqual(stats.count, first - 1)
+
+        cache = self.app.extensions["user_cache"]
+        self.assertEqual(cache.get(self.student.id).role, "student")
+        admin_headers = {"Authorization": f"Bearer {self.admin_token}"}
+        response = self.client.post(
+            "/make-admin", json={"email": self.student.email}, headers=admin_headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIsNone(cache.get(self.student.id))
+
+        self.client.get("/notifications", headers=headers)
+        self.assertEqual(cache.get(self.student.id).role, "admin")
+        for route in ("/deactivate-user", "/activate-user"):
+            response = self.client.post(
+                route, json={"email": self.student.email}, headers=admin_headers
+            )
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertIsNone(cache.get(self.student.id))
+            self.client.get("/notifications", headers=headers)
+
+        response = self.client.put(
+            f"/users/{self.student.id}", json={"first_name": "Renamed"}, headers=admin_headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIsNone(cache.get(self.student.id))
+
+    def test_user_cache_dropped_after_commit(self):
+        headers = {"Authorization": f"Bearer {self.student_token}"}
+        admin_headers = {"Authorization": f"Bearer {self.admin_token}"}
+        cache = self.app.extensions["user_cache"]
+        self.client.get("/notifications", headers=headers)
+        before = cache.get(self.student.id)
+        self.assertEqual(before.role, "student")
+
+        # A lookup from another request, made between the write and its commit, caches the old row
+        def lookup_before_commit(_db):
+            cache.set(self.student.id, before)
+
+        db = session()
+        event.listen(db, "before_commit", lookup_before_commit)
+        try:
+            response = self.client.post(
+                "/make-admin", json={"email": self.student.email}, headers=admin_headers
+            )
+        finally:
+            event.remove(db, "before_commit", lookup_before_commit)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIsNone(cache.get(self.student.id))
+        self.client.get("/notifications", headers=headers)
+        self.assertEqual(cache.get(self.student.id).role, "admin")
+
+        # Nothing is dropped for a write that rolls back, nor by the next commit
+        invalidate_user(session, self.student.id)
+        session.rollback()
+        session.commit()
+        self.assertEqual(cache.get(self.student.id).role, "admin")
+
+    def test_catalog_cache(self):
+        admin_headers = {"Authorization": f"Bearer {self.admin_token}"}
+        book = session.query(md.Book).first()
+        book_id, route = book.id, f"/categories/{book.category_id}"
+
+        for path in ("/categories", route):
+            response = self.client.get(path)
+            self.assertEqual(response.headers["X-Cache"], "MISS")
+            self.assertEqual(len(response.json["queries"]), 1)
+            with track_queries() as stats:
+                cached = self.client.get(path)
+            self.assertEqual(cached.headers["X-Cache"], "HIT")
+            self.assertEqual(stats.count, 0)
+            self.assertEqual(cached.json["queries"], [])
+            self.assertEqual({**cached.json, "queries": None}, {**response.json, "queries": None})
+        # The admin detail page is cached apart from the public one
+        response = self.client.get(f"{route}?detail=true", headers=admin_headers)
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        self.assertIn("category_added_by", response.json["category"])
+
+        # A failed write keeps the cache, a committed one drops it
+        response = self.client.put("/books/9999", json={"title": "Nope"}, headers=admin_headers)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        self.assertEqual(self.client.get(route).headers["X-Cache"], "HIT")
+        response = self.client.put(
+            f"/books/{book_id}", json={"title": "Renamed"}, headers=admin_headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = self.client.get(route)
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        titles = {book["id"]: book["title"] for book in response.json["category"]["books"]}
+        self.assertEqual(titles[book_id], "Renamed")
+
+        response = self.client.get("/catalog-cache", headers=admin_headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.json["version"], 1)
+        self.assertEqual((response.json["hits"], response.json["misses"]), (3, 4))
+        self.assertEqual(response.json["size"], 1)
+        response = self.client.get("/catalog-cache")
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_login_rehashes_old_passwords(self):
+        old_hash = generate_password_hash("password", "pbkdf2:sha256:1000")
+        session.query(md.UserAccount).where(md.UserAccount.id == self.student.id).update(
+            {"password": old_hash}
+        )
+        session.commit()
+        credentials = {"email": self.student.email, "password": "password"}
+
+        response = self.client.post("/login", json=credentials)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.json["queries"]), 2)
+        session.expire_all()
+        new_hash = session.get(md.UserAccount, self.student.id).password
+        self.assertTrue(new_hash.startswith(f"{self.app.config['PASSWORD_HASH_METHOD']}$"))
+
+        # Up to date hashes are left alone, and a wrong password is still refused
+        response = self.client.post("/login", json=credentials)
+        self.assertEqual(len(response.json["queries"]), 1)
+        self.assertEqual(session.get(md.UserAccount, self.student.id).password, new_hash)
+        response = self.client.post("/login", json={**credentials, "password": "wrong"})
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_password_hashing_backpressure(self):
+        self.app.extensions["password_hasher"] = PasswordHasher("scrypt", max_pending=0)
+        response = self.client.post(
+            "/login", json={"email": self.student.email, "password": "password"}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+        hasher = PasswordHasher("pbkdf2:sha256:1000", workers=2)
+        try:
+            password_hash = hasher.hash("password")
+            self.assertTrue(hasher.verify("password", password_hash))
+            self.assertFalse(hasher.verify("wrong", password_hash))
+            self.assertFalse(hasher.needs_rehash(password_hash))
+            self.assertTrue(hasher.needs_rehash(generate_password_hash("password")))
+        finally:
+            hasher.shutdown()
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+        # 2 was the least recently used
+        self.assertEqual((cache.get(1), cache.get(2), cache.get(3)), ("a", None, "c"))
+
+        cache = TTLCache(maxsize=2, ttl=0)
+        cache.set(1, "a")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_statements_are_parameterized(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        data = {
+            "title": "Tis' the season",
+            "author": "Flann O'Brien",
+            "category_id": session.query(md.Category).first().id,
+            "isbn": fake.isbn13(),
+            "quantity": 1,
+            "location": "A'1",
+        }
+        response = self.client.post("/books", json=data, headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        book_id = response.json["book_id"]
+        self.assertEqual(session.get(md.Book, book_id).author, "Flann O'Brien")
+
+        book_ids = [book.id for book in session.query(md.Book).limit(3)]
+        statements = set()
+        for book_id in book_ids:
+            with track_queries() as executed:
+                response = self.client.get(f"/books/{book_id}", headers=headers)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            statements.update(executed.statements)
+            self.assertNotIn(str(book_id), response.json["queries"][0])
+        # The user lookup is cached, so this is the one book query, whatever the id
+        self.assertEqual(len(statements), 1)
+
+    def test_batch_serialization_matches_jsonify(self):
+        self.add_overdue_borrows(4, [self.student.id, self.external.id], self.admin.id)
+        session.query(md.Fine).where(md.Fine.id % 2 == 0).update(
+            {"paid": True, "date_paid": datetime.now()}
+        )
+        session.commit()
+        cases = (
+            (pmd.AdminFineListSchema, session.query(md.Fine).all()),
+            (pmd.AdminListBorrowSchema, session.query(md.Borrow).all()),
+            (pmd.ListUsersSchema, session.query(md.UserAccount).all()),
+        )
+        for schema, rows in cases:
+            with self.subTest(schema=schema.__name__):
+                expected = jsonify([schema.model_validate(row).model_dump() for row in rows])
+                self.assertEqual(json.loads(serialize_rows(schema, rows)), expected.json)
+
+    def test_query_stats_headers(self):
+        response = self.client.get("/books")
+        self.assertEqual(response.headers["X-Query-Count"], "1")
+        self.assertRegex(response.headers["Server-Timing"], r'^db;dur=[\d.]+;desc="1 queries"$')
+
+    def test_query_budgets(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        student_headers = {"Authorization": f"Bearer {self.student_token}"}
+        student_id = self.student.id
+        self.add_overdue_borrows(6, [student_id], self.admin.id)
+        session.expunge_all()
+        # user lookup + list query, and the fines of the page for the borrow lists
+        budgets = (
+            ("/books", None, 1),
+            ("/categories", None, 1),
+            ("/users", headers, 2),
+            ("/borrows", student_headers, 3),
+            (f"/borrows-admin/{student_id}", headers, 3),
+            ("/notifications", student_headers, 2),
+            ("/overdue-report?returned=both", headers, 3),
+        )
+        for route, route_headers, budget in budgets:
+            with self.subTest(route=route), self.query_budget(budget):
+                response = self.client.get(route, headers=route_headers)
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_n_plus_one_is_flagged(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        student_id = self.student.id
+        self.add_overdue_borrows(6, [student_id], self.admin.id)
+        session.expunge_all()
+
+        @self.app.route("/lazy-borrows/<int:user_id>")
+        def lazy_borrows(user_id):
+            # The borrows are loaded without their relationships, so each one is lazy loaded
+            stmt = select(md.Borrow).where(md.Borrow.borrowed_by_id == user_id)
+            return serialize_rows(pmd.ListBorrowSchema, session.execute(stmt).scalars().all())
+
+        with self.assertLogs(self.app.logger, "WARNING") as logs:
+            self.client.get(f"/lazy-borrows/{student_id}", headers=headers)
+        self.assertIn("Possible N+1 in GET /lazy-borrows", logs.output[0])
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM book WHERE id = 12 AND title = 'It''s'"),
+            "SELECT * FROM book WHERE id = ? AND title = ?",
+        )
+        self.assertEqual(
+            fingerprint("SELECT * FROM fine WHERE borrow_id IN (?, ?,\n ?)"),
+            "SELECT * FROM fine WHERE borrow_id IN (?)",
+        )
+
+    def rollup_counts(self):
+        return {
+            (row.period, row.period_start, row.category_id, row.role, row.is_returned): (
+                row.borrow_count
+            )
+            for row in session.query(md.BorrowRollup)
+            if row.borrow_count
+        }
+
+    def test_borrowing_rollups(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        book = session.query(md.Book).first()
+        for borrower in (self.student, self.external, self.student):
+            data = {"book_id": book.id, "borrower_id": borrower.id}
+            response = self.client.post("/borrow-book", json=data, headers=headers)
+            self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        borrow = session.query(md.Borrow).first()
+        response = self.client.post("/return-book", json={"borrow_id": borrow.id}, headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+        session.expire_all()
+        today = datetime.now().date()
+        counts = self.rollup_counts()
+        self.assertEqual(counts[("day", today, book.category_id, "student", False)], 1)
+        self.assertEqual(counts[("day", today, book.category_id, "student", True)], 1)
+        self.assertEqual(counts[("day", today, book.category_id, "external", False)], 1)
+        self.assertEqual(len(counts), 9)
+
+        # Maintained incrementally, the rollups match a rebuild from history
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["rollup-backfill"])
+        self.assertIn("9 rollup rows written", result.output)
+        session.expire_all()
+        self.assertEqual(self.rollup_counts(), counts)
+
+        # History written around the API only shows up after a backfill
+        self.add_overdue_borrows(4, [self.student.id], self.admin.id)
+        runner.invoke(args=["rollup-backfill"])
+        response = self.client.get("/borrowing-trends/series?window=3", headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        series = response.json["series"]
+        self.assertEqual(len(series), 90)
+        self.assertEqual(
+            series[-1], {"period_start": today.isoformat(), "borrows": 3, "moving_average": 1.0}
+        )
+        self.assertEqual(series[-31]["borrows"], 4)
+
+        response = self.client.get(
+            "/borrowing-trends/series?period=month&user_type=external&returned=false",
+            headers=headers,
+        )
+        self.assertEqual(response.json["series"][-1]["borrows"], 1)
+        response = self.client.get("/borrowing-trends/series?period=year", headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        for span in ("start=0001-01-01&end=9999-12-31", "start=2026-02-01&end=2026-01-01"):
+            with self.subTest(span=span):
+                response = self.client.get(f"/borrowing-trends/series?{span}", headers=headers)
+                self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self.client.get(
+            "/borrowing-trends/series?period=month&start=2024-01-15&end=2026-12-01",
+            headers=headers,
+        )
+        self.assertEqual(len(response.json["series"]), 36)
+        response = self.client.get("/borrowing-trends?time=day", headers=headers)
+        self.assertEqual(len(response.json["borrows"]), 3)
+
+    def test_rollups_follow_recategorised_books_and_role_changes(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        put_book, imported_book = session.query(md.Book).limit(2).all()
+        categories = session.execute(select(md.Category.id)).scalars().all()
+        borrowers = (self.student, self.external)
+        for book in (put_book, imported_book):
+            for borrower in borrowers:
+                data = {"book_id": book.id, "borrower_id": borrower.id}
+                response = self.client.post("/borrow-book", json=data, headers=headers)
+                self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        borrow_ids = session.execute(select(md.Borrow.id)).scalars().all()
+
+        # Between borrow and return, the books change category and the borrowers change role
+        other = {category: next(c for c in categories if c != category) for category in categories}
+        response = self.client.put(
+            f"/books/{put_book.id}",
+            json={"category_id": other[put_book.category_id]},
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        feed = "\n".join(
+            [
+                "title,author,isbn,category_id,quantity,location",
+                f"{imported_book.title},{imported_book.author},{imported_book.isbn},"
+                f"{other[imported_book.category_id]},10,{imported_book.location}",
+            ]
+        )
+        response = self.client.post(
+            "/books/import", data=feed, content_type="text/csv", headers=headers
+        )
+        self.assertEqual(response.json["updated"], [imported_book.id])
+        response = self.client.put(
+            f"/users/{self.student.id}", json={"role": "external"}, headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = self.client.post(
+            "/make-admin", json={"email": self.external.email}, headers=headers
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        for borrow_id in borrow_ids:
+            response = self.client.post(
+                "/return-book", json={"borrow_id": borrow_id}, headers=headers
+            )
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+
+        # The returns were taken from the buckets the borrows had moved to
+        session.expire_all()
+        counts = self.rollup_counts()
+        self.assertTrue(all(count > 0 for count in counts.values()))
+        self.assertEqual(sum(counts.values()), 3 * len(borrow_ids))
+        self.app.test_cli_runner().invoke(args=["rollup-backfill"])
+        session.expire_all()
+        self.assertEqual(self.rollup_counts(), counts)
+
+    def test_fine_totals_in_one_pass(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        self.add_overdue_borrows(6, [self.student.id, self.external.id], self.admin.id)
+        session.query(md.Fine).where(md.Fine.id % 3 == 0).update(
+            {"paid": True, "date_paid": datetime.now(), "payment_method": "cash"}
+        )
+        session.commit()
+        month = datetime.now().strftime("%Y-%m")
+
+        with track_queries() as stats:
+            response = self.client.get("/fines-report", headers=headers)
+        self.assertEqual(stats.count, 4)  # user lookup, totals, fines page, fines of the page
+        self.assertEqual(response.json["total"], {"paid": 3200, "unpaid": 6400})
+        breakdown = {
+            (row["role"], row["payment_method"]): (row["paid"], row["unpaid"], row["fines"])
+            for row in response.json["breakdown"]
+        }
+        self.assertEqual(
+            breakdown,
+            {
+                ("student", None): (None, 3200, 2),
+                ("student", "cash"): (1600, None, 1),
+                ("external", None): (None, 3200, 2),
+                ("external", "cash"): (1600, None, 1),
+            },
+        )
+        self.assertEqual({row["month"] for row in response.json["breakdown"]}, {month})
+
+        response = self.client.get("/fines-report?status=paid&user_type=student", headers=headers)
+        self.assertEqual(response.json["total"], {"paid": 1600, "unpaid": None})
+
+        student_headers = {"Authorization": f"Bearer {self.student_token}"}
+        with track_queries() as stats:
+            response = self.client.get("/fines", headers=student_headers)
+        self.assertEqual(stats.count, 3)  # user lookup, totals, fines page
+        self.assertEqual((response.json["total_paid"], response.json["total_unpaid"]), (1600, 3200))
+
+    def add_overdue_borrows(self, count, borrower_ids, admin_id):
+        books = session.query(md.Book).all()
+        borrows = [
+            md.Borrow(
+                book_id=books[i % len(books)].id,
+                borrowed_by_id=borrower_ids[i % len(borrower_ids)],
+                given_by_id=admin_id,
+                received_by_id=admin_id if i % 3 == 0 else None,
+                is_returned=i % 3 == 0,
+                borrow_date=datetime.now() - timedelta(days=30),
+                due_date=datetime.now() - timedelta(days=16),
+            )
+            for i in range(count)
+        ]
+        session.add_all(borrows)
+        session.commit()
+        for borrow in borrows:
+            session.add(md.Fine(borrow_id=borrow.id, amount=1600, date_created=datetime.now()))
+        session.commit()
+
+    def test_reports_query_count_does_not_grow_with_rows(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        # The borrows below always include the first book
+        category_id = session.query(md.Book).first().category_id
+        routes = (
+            "/overdue-report?returned=both",
+            "/fines-report",
+            "/borrowing-trends",
+            f"/borrowing-trends?category={category_id}",
+        )
+        borrower_ids = [self.student.id, self.external.id]
+        admin_id = self.admin.id
+        counts = []
+        for batch in (3, 12):
+            self.add_overdue_borrows(batch, borrower_ids, admin_id)
+            batch_counts = []
+            for route in routes:
+                # Start from an empty identity map and user cache so nothing is served without a query
+                session.expunge_all()
+                self.app.extensions["user_cache"].clear()
+                with track_queries() as stats:
+                    response = self.client.get(route, headers=headers)
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                batch_counts.append(stats.count)
+            counts.append(batch_counts)
+
+        self.assertEqual(counts[0], counts[1])
+        # user lookup + report + fines, and the fine totals for the fines report
+        self.assertEqual(counts[0], [3, 4, 3, 3])
+
+    def walk_pages(self, route, key, headers=None):
+        separator = "&" if "?" in route else "?"
+        items = []
+        cursor = None
+        while True:
+            url = f"{route}{separator}limit=2" + (f"&cursor={cursor}" if cursor else "")
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertLessEqual(len(response.json[key]), 2)
+            items.extend(response.json[key])
+            cursor = response.json["next_cursor"]
+            if cursor is None:
+                return items
+
+    def test_keyset_pagination(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        student_headers = {"Authorization": f"Bearer {self.student_token}"}
+        self.add_overdue_borrows(7, [self.student.id, self.external.id], self.admin.id)
+        session.query(md.Fine).where(md.Fine.id % 2 == 0).update(
+            {"paid": True, "date_paid": datetime.now()}
+        )
+        session.add_all(
+            md.Notification(
+                user_id=self.student.id, message=fake.sentence(), sent_date=datetime.now()
+            )
+            for _ in range(5)
+        )
+        session.commit()
+        author = session.query(md.Book).first().author.split()[-1]
+
+        routes = (
+            ("/books", "books", None),
+            (
+                f"/books?author={author}&category={session.query(md.Category).first().name}",
+                "books",
+                None,
+            ),
+            ("/users", "users", headers),
+            ("/borrows", "borrows", student_headers),
+            ("/fines", "fines", student_headers),
+            ("/notifications", "notifications", student_headers),
+            (f"/borrows-admin/{self.student.id}", "borrows", headers),
+            ("/overdue-report?returned=both&sort=desc", "borrows", headers),
+            ("/fines-report?sort_date_paid=desc&sort_date_created=asc", "fines", headers),
+            ("/borrowing-trends", "borrows", headers),
+        )
+        for route, key, route_headers in routes:
+            with self.subTest(route=route):
+                response = self.client.get(route, headers=route_headers)
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                self.assertIsNone(response.json["next_cursor"])
+                self.assertTrue(response.json[key])
+                self.assertEqual(self.walk_pages(route, key, route_headers), response.json[key])
+
+        response = self.client.get("/books?cursor=not-a-cursor")
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_report_export(self):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        self.add_overdue_borrows(7, [self.student.id, self.external.id], self.admin.id)
+        session.query(md.Fine).where(md.Fine.id % 2 == 0).update(
+            {"paid": True, "date_paid": datetime.now()}
+        )
+        session.commit()
+
+        response = self.client.get("/fines-report?format=csv&status=unpaid", headers=headers)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        unpaid = session.query(md.Fine).where(md.Fine.paid.is_(False)).count()
+        self.assertEqual(len(rows), unpaid)
+        self.assertEqual({row["paid"] for row in rows}, {"False"})
+
+        response = self.client.get("/fines-report?format=ndjson", headers=headers)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["id"] for row in rows], sorted(row["id"] for row in rows))
+        self.assertEqual(len(rows), session.query(md.Fine).count())
+
+        response = self.client.get("/overdue-report?returned=both&format=ndjson", headers=headers)
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(rows), 7)
+        self.assertEqual({row["fines"] for row in rows}, {1600})
+
+
+class CheckoutConcurrencyTestCase(unittest.TestCase):
+    copies = 3
+    borrowers = 12
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_url = f"sqlite:///{os.path.join(self.tmp_dir.name, 'checkout.sqlite')}"
+        self.engine = create_engine(self.database_url, connect_args={"timeout": 30})
+        Base.metadata.create_all(self.engine)
+        with Session(self.engine) as db:
+            users = [
+                md.UserAccount(
+                    email=fake.unique.email(),
+                    first_name=fake.first_name(),
+                    last_name=fake.last_name(),
+                    password="password",
+                    role="admin" if i == 0 else "student",
+                )
+                for i in range(self.borrowers + 1)
+            ]
+            db.add_all(users)
+            db.flush()
+            category = md.Category(name=fake.word(), added_by_id=users[0].id)
+            db.add(category)
+            db.flush()
+            book = md.Book(
+                title=fake.sentence(3),
+                author=fake.name(),
+                category_id=category.id,
+                isbn=fake.isbn13(),
+                original_quantity=self.copies,
+                current_quantity=self.copies,
+                location=fake.word(),
+                date_added=datetime.now(),
+                added_by_id=users[0].id,
+            )
+            db.add(book)
+            db.commit()
+            self.admin_id = users[0].id
+            self.borrower_ids = [user.id for user in users[1:]]
+            self.book_id = book.id
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def assert_no_oversell(self, errors):
+        self.assertEqual(errors.count(None), self.copies)
+        for error in errors:
+            if error is not None:
+                self.assertEqual(error[1], HTTPStatus.BAD_REQUEST)
+        with Session(self.engine) as db:
+            book = db.get(md.Book, self.book_id)
+            self.assertEqual(book.current_quantity, 0)
+            borrows = db.query(md.Borrow).where(md.Borrow.book_id == self.book_id).count()
+            self.assertEqual(borrows, self.copies)
+
+    def test_concurrent_checkouts_across_threads(self):
+        args = [(self.database_url, self.book_id, i, self.admin_id) for i in self.borrower_ids]
+        with ThreadPoolExecutor(max_workers=len(args)) as pool:
+            errors = list(pool.map(lambda arg: checkout_in_new_engine(*arg), args))
+        self.assert_no_oversell(errors)
+
+    def test_concurrent_checkouts_by_one_borrower(self):
+        with Session(self.engine) as db:
+            db.get(md.Book, self.book_id).current_quantity = self.borrowers
+            db.commit()
+        args = [(self.database_url, self.book_id, self.borrower_ids[0], self.admin_id)] * 12
+        with ThreadPoolExecutor(max_workers=len(args)) as pool:
+            errors = list(pool.map(lambda arg: checkout_in_new_engine(*arg), args))
+        self.assertEqual(errors.count(None), MAX_BORROWS)
+        with Session(self.engine) as db:
+            self.assertEqual(db.get(md.UserAccount, self.borrower_ids[0]).active_loans, MAX_BORROWS)
+            book = db.get(md.Book, self.book_id)
+            self.assertEqual(book.current_quantity, self.borrowers - MAX_BORROWS)
+
+    def test_concurrent_checkouts_across_processes(self):
+        args = [(self.database_url, self.book_id, i, self.admin_id) for i in self.borrower_ids]
+        with multiprocessing.get_context("spawn").Pool(4) as pool:
+            errors = pool.starmap(checkout_in_new_engine, args)
+        self.assert_no_oversell(errors)
+
+
+class SqliteTuningTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        database_url = f"sqlite:///{os.path.join(self.tmp_dir.name, 'prod.sqlite')}"
+        self.engine = create_engine(database_url)
+        configure_sqlite(self.engine, ProdConfig.SQLITE_PRAGMAS, optimize_on_close=True)
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_prod_pragmas(self):
+        with self.engine.connect() as conn:
+            pragma = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()  # noqa: E731
+            self.assertEqual(pragma("journal_mode"), "wal")
+            self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+            self.assertEqual(pragma("cache_size"), -64000)
+            self.assertEqual(pragma("temp_store"), 2)  # MEMORY
+            self.assertEqual(pragma("busy_timeout"), 5000)
+
+    def test_readers_do_not_block_on_the_writer(self):
+        with self.engine.connect() as writer:
+            writer.exec_driver_sql("BEGIN EXCLUSIVE")
+            writer.execute(
+                md.UserAccount.__table__.insert(),
+                {"email": "a@b.c", "first_name": "a", "last_name": "b", "password": "x"},
+            )
+            # Under the default rollback journal this read would wait on the writer's exclusive lock
+            with self.engine.connect() as reader:
+                self.assertEqual(reader.execute(select(func.count(md.UserAccount.id))).scalar(), 0)
+            writer.commit()
+
+
+class GeneratorTestCase(unittest.TestCase):
+    now = datetime(2026, 1, 1)
+
+    def generate(self, **kwargs):
+        engine = create_engine("sqlite://")
+        self.addCleanup(engine.dispose)
+        written = generate(engine, 120, 300, 4000, seed=7, chunk_size=500, now=self.now, **kwargs)
+        return engine, written
+
+    def dump(self, engine, table):
+        with engine.connect() as conn:
+            return conn.exec_driver_sql(f"SELECT * FROM {table} ORDER BY id").all()
+
+    def test_generated_data(self):
+        engine, written = self.generate()
+        self.assertEqual(
+            {k: written[k] for k in ("user_account", "category", "book", "borrow")},
+            {"user_account": 120, "category": 20, "book": 300, "borrow": 4000},
+        )
+        # Built by the migrations, so an upgrade has nothing left to apply
+        self.assertEqual(migrate(engine), [])
+        with self.assertRaises(ValueError):
+            generate(engine, 0, 10, 10)
+        with engine.connect() as conn:
+            scalar = lambda sql: conn.exec_driver_sql(sql).scalar()  # noqa: E731
+            self.assertEqual(scalar("SELECT COUNT(*) FROM fine"), written["fine"])
+            self.assertEqual(scalar("SELECT COUNT(*) FROM user_account WHERE role = 'admin'"), 2)
+            self.assertEqual(scalar("SELECT MIN(current_quantity) FROM book"), 0)
+            self.assertEqual(
+                scalar("SELECT SUM(borrow_count) FROM borrow_rollup WHERE period = 'month'"), 4000
+            )
+            # Every late return or overdue book is fined, never one returned on time
+            self.assertEqual(
+                scalar(
+                    "SELECT COUNT(*) FROM fine JOIN borrow ON borrow.id = fine.borrow_id"
+                    " WHERE borrow.return_date < borrow.due_date"
+                ),
+                0,
+            )
+            # The 10% most borrowed books account for most borrows
+            top = scalar(
+                "SELECT SUM(n) FROM (SELECT COUNT(*) AS n FROM borrow GROUP BY book_id"
+                " ORDER BY n DESC LIMIT 30)"
+            )
+            self.assertGreater(top, 2000)
+
+    def test_generation_adds_to_existing_rows(self):
+        engine, _ = self.generate(categories=100, workers=2)
+        written = generate(engine, 10, 10, 10, categories=100, seed=7, chunk_size=500, now=self.now)
+        self.assertEqual(written["category"], 100)
+        with engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SELECT COUNT(*) FROM category").scalar(), 200)
+
+    def test_generation_is_seeded(self):
+        first, _ = self.generate()
+        second, _ = self.generate(workers=2)
+        for table in ("category", "book", "borrow", "fine"):
+            with self.subTest(table=table):
+                self.assertEqual(self.dump(first, table), self.dump(second, table))
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """The routes reach rows through indexes on a generated library, not full table scans."""
+
+    def setUp(self):
+        self.app = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        # Analyzed like production data, so the planner weighs the indexes as it would there
+        generate(engine, 120, 300, 4000, seed=7, chunk_size=500)
+        sweep_overdue_fines()
+        session.commit()
+
+    def tearDown(self):
+        drop_schema(engine)
+        session.close()
+        self.app_context.pop()
+
+    def token(self, user_id):
+        user = session.get(md.UserAccount, user_id)
+        return create_access_token(identity=user, additional_claims={"role": user.role})
+
+    def assert_no_full_scans(self, stats, allowed=()):
+        scans = {}
+        with engine.connect() as conn:
+            for statement, parameters in zip(stats.statements, stats.parameters):
+                if isinstance(parameters, list):  # executemany
+                    parameters = parameters[0]
+                tables = full_scans(conn, statement, parameters) - set(allowed)
+                if tables:
+                    scans[" ".join(statement.split())[:200]] = tables
+        self.assertEqual(scans, {})
+
+    def test_routes_use_indexes(self):
+        fine = session.scalars(
+            select(md.Fine).join(md.Fine.borrow).where(md.Borrow.is_returned.is_(False)).limit(1)
+        ).one()
+        borrow = fine.borrow
+        user_id, book_id, category_id = borrow.borrowed_by_id, borrow.book_id, 1
+        admin_id = session.scalar(select(md.UserAccount.id).where(md.UserAccount.role == "admin"))
+        shelved = session.scalar(select(md.Book.id).where(md.Book.current_quantity > 1))
+        user = {"Authorization": f"Bearer {self.token(user_id)}"}
+        admin = {"Authorization": f"Bearer {self.token(admin_id)}"}
+        requests = [
+            ("get", "/books", user, None, ()),
+            ("get", f"/books/{book_id}", user, None, ()),
+            # Every category is listed, the table holds a few dozen rows
+            ("get", "/categories", user, None, {"category"}),
+            ("get", f"/categories/{category_id}", user, None, ()),
+            ("get", "/borrows", user, None, ()),
+            ("get", f"/borrows/{borrow.id}", user, None, ()),
+            ("get", "/fines?status=unpaid", user, None, ()),
+            ("get", f"/fines/{fine.id}", user, None, ()),
+            ("get", "/notifications", user, None, ()),
+            ("get", "/holds", user, None, ()),
+            ("post", "/holds", user, {"book_id": book_id}, ()),
+            ("get", f"/borrows-admin/{user_id}", admin, None, ()),
+            ("get", f"/fines-admin/{user_id}", admin, None, ()),
+            ("get", f"/users/{user_id}", admin, None, ()),
+            ("get", "/overdue-report", admin, None, ()),
+            ("get", "/overdue-report?sort=desc", admin, None, ()),
+            ("get", "/fines-report?status=unpaid&sort_date_created=desc", admin, None, ()),
+            # The report's totals cover every fine
+            ("get", "/fines-report", admin, None, {"fine"}),
+            ("get", "/borrowing-trends?time=month", admin, None, ()),
+            ("get", "/borrowing-trends/series?period=week", admin, None, ()),
+            ("post", "/borrow-book", admin, {"book_id": shelved, "borrower_id": admin_id}, ()),
+            (
+                "post",
+                "/borrow-book/batch",
+                admin,
+                {"book_ids": [shelved], "borrower_id": user_id},
+                (),
+            ),
+            ("post", "/return-book", admin, {"borrow_id": borrow.id}, ()),
+            ("post", "/return-book/batch", admin, {"borrow_ids": [borrow.id + 1]}, ()),
+            ("post", f"/pay-fine/{fine.id}", admin, {"method": "cash"}, ()),
+        ]
+        for method, path, headers, body, allowed in requests:
+            with self.subTest(method=method, path=path):
+                with track_queries() as stats:
+                    response = getattr(self.client, method)(path, json=body, headers=headers)
+                self.assertLess(response.status_code, 500)
+                self.assertTrue(stats.count)
+                self.assert_no_full_scans(stats, allowed)
+
+        with self.subTest("notification stream catch-up"):
+            with track_queries() as stats:
+                response = self.client.get(
+                    "/notifications/stream", headers={**user, "Last-Event-ID": "0"}, buffered=False
+                )
+            response.close()
+            self.assert_no_full_scans(stats)
+
+        with self.subTest("overdue sweep"):
+            with track_queries() as stats:
+                sweep_overdue_fines()
+            session.rollback()
+            self.assert_no_full_scans(stats)
+            # Spelled like the partial index's predicate, so only unreturned borrows are read
+            with engine.connect() as conn:
+                plan = conn.exec_driver_sql(
+                    f"EXPLAIN QUERY PLAN {stats.statements[0]}", stats.parameters[0]
+                ).all()
+            self.assertIn("USING INDEX idx_borrow_overdue", " ".join(row.detail for row in plan))
+
+
+class MigrationTestCase(unittest.TestCase):
+    """Migrated databases match the models, whether created by the migrations or upgraded."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.engine = create_engine(f"sqlite:///{directory.name}/library.sqlite")
+        self.addCleanup(self.engine.dispose)
+
+    def schema(self, engine):
+        inspector = inspect(engine)
+        tables = {}
+        for table in inspector.get_table_names():
+            if table == "schema_migrations" or table.startswith("sqlite_"):
+                continue
+            tables[table] = {
+                "columns": {
+                    c["name"]: (
+                        c["nullable"],
+                        str(c["default"]).strip("'\"") if c["default"] else None,
+                    )
+                    for c in inspector.get_columns(table)
+                },
+                "primary key": inspector.get_pk_constraint(table)["constrained_columns"],
+                "foreign keys": sorted(
+                    (f["constrained_columns"], f["referred_table"])
+                    for f in inspector.get_foreign_keys(table)
+                ),
+                "unique": sorted(
+                    [u["column_names"] for u in inspector.get_unique_constraints(table)]
+                    + [i["column_names"] for i in inspector.get_indexes(table) if i["unique"]]
+                ),
+            }
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT type, name, tbl_name, sql FROM sqlite_master"
+                " WHERE type IN ('index', 'trigger') AND sql IS NOT NULL"
+            ).all()
+            for kind, name, table, sql in rows:
+                if kind == "index":
+                    columns = [
+                        row.name for row in conn.exec_driver_sql(f"PRAGMA index_info({name})")
+                    ]
+                    tables[table][name] = (columns, sql.partition(" WHERE ")[2])
+                else:
+                    tables[table][name] = " ".join(sql.split())
+        return tables
+
+    def models_schema(self):
+        models_engine = create_engine("sqlite://")
+        self.addCleanup(models_engine.dispose)
+        Base.metadata.create_all(models_engine)
+        return self.schema(models_engine)
+
+    def test_migrations_match_models(self):
+        self.assertEqual(migrate(self.engine), [m.version for m in MIGRATIONS])
+        self.assertEqual(self.schema(self.engine), self.models_schema())
+        self.assertEqual(migrate(self.engine), [])
+
+    def test_upgrade_populated_database(self):
+        # A library created from the models before the search, rollups, holds, counters and
+        # indexes were added to them
+        generate(self.engine, 60, 150, 1000, seed=3, chunk_size=500)
+        with self.engine.begin() as conn:
+            original = conn.exec_driver_sql(
+                "SELECT * FROM borrow_rollup ORDER BY 1, 2, 3, 4, 5"
+            ).all()
+            counters = conn.exec_driver_sql(
+                "SELECT id, active_loans, outstanding_balance FROM user_account ORDER BY id"
+            ).all()
+            for name in (
+                conn.exec_driver_sql(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+                )
+                .scalars()
+                .all()
+            ):
+                conn.exec_driver_sql(f"DROP INDEX {name}")
+            for trigger in ("book_fts_insert", "book_fts_delete", "book_fts_update"):
+                conn.exec_driver_sql(f"DROP TRIGGER {trigger}")
+            for table in ("borrow_rollup", "hold", "book_fts"):
+                conn.exec_driver_sql(f"DROP TABLE {table}")
+            for column in ("active_loans", "outstanding_balance"):
+                conn.exec_driver_sql(f"ALTER TABLE user_account DROP COLUMN {column}")
+            conn.exec_driver_sql("DROP TABLE schema_migrations")
+            # ISBNs as POST /books stored them, one spelling another book's digits
+            sql = "SELECT isbn FROM book WHERE id <= 3 ORDER BY id"
+            isbns = conn.exec_driver_sql(sql).scalars().all()
+            spelled = [f"{isbns[0][:3]}-{isbns[0][3:]}", f"{isbns[2][:3]} {isbns[2][3:]}"]
+            conn.exec_driver_sql("UPDATE book SET isbn = ? WHERE id = 1", (spelled[0],))
+            conn.exec_driver_sql("UPDATE book SET isbn = ? WHERE id = 2", (spelled[1],))
+
+        commits = []
+        event.listen(self.engine, "commit", commits.append)
+        with mock.patch.object(operations, "BACKFILL_BATCH_SIZE", 50):
+            self.assertEqual(migrate(self.engine), [m.version for m in MIGRATIONS])
+        # The backfills commit batch by batch rather than holding the write lock throughout
+        self.assertGreater(len(commits), 1000 // 50)
+
+        self.assertEqual(self.schema(self.engine), self.models_schema())
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql("SELECT * FROM borrow_rollup ORDER BY 1, 2, 3, 4, 5").all(),
+                original,
+            )
+            self.assertEqual(
+                conn.exec_driver_sql(
+                    "SELECT id, active_loans, outstanding_balance FROM user_account ORDER BY id"
+                ).all(),
+                counters,
+            )
+            self.assertEqual(
+                conn.exec_driver_sql("SELECT isbn FROM book WHERE id <= 3 ORDER BY id").all(),
+                [(isbns[0],), (spelled[1],), (isbns[2],)],
+            )
+            title = conn.exec_driver_sql("SELECT title FROM book WHERE id = 1").scalar()
+            self.assertIn(
+                1,
+                conn.exec_driver_sql(
+                    "SELECT rowid FROM book_fts WHERE book_fts MATCH ?", (f'"{title}"',)
+                )
+                .scalars()
+                .all(),
+            )
+
+        # A migration that stopped partway is run again from the start without double counting
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("DELETE FROM schema_migrations WHERE version >= 3")
+        self.assertEqual(migrate(self.engine), [m.version for m in MIGRATIONS][2:])
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql("SELECT * FROM borrow_rollup ORDER BY 1, 2, 3, 4, 5").all(),
+                original,
+            )
+
+
+class SessionScopeTestCase(unittest.TestCase):
+    """Requests outside a test's app context, as a server runs them, each get a new session."""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client()
+        generate(engine, 40, 60, 400, seed=5, chunk_size=500)
+        with self.app.app_context():
+            fine = session.scalars(select(md.Fine).order_by(md.Fine.id).limit(1)).one()
+            user = fine.borrow.borrowed_by
+            token = create_access_token(identity=user, additional_claims={"role": user.role})
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        drop_schema(engine)
+        session.remove()
+
+    def test_requests_leave_no_session_behind(self):
+        for path in ("/fines", "/borrows", "/books"):
+            with self.subTest(path=path):
+                response = self.client.get(path, headers=self.headers)
+                self.assertEqual(response.status_code, 200)
+                # Neither loaded objects nor an open transaction outlive the request
+                self.assertFalse(session.registry.has())
@@ -1,22 +1,106 @@
 import os
+from collections import Counter
 from datetime import datetime, timedelta
 from functools import wraps
+from http import HTTPStatus
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import DateTime, bindparam, case, create_engine, func, select, text
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.sql.elements import DQLDMLClauseElement
+from sqlalchemy.sql.elements import DQLDMLClauseElement, TextClause
 from werkzeug.security import check_password_hash, generate_password_hash
 
+import src.queries as qs
 from config import Config, config_dict
-from src.models import Borrow
+from src.models import Borrow, Fine, UserAccount
+from src.utils.cache import (  # noqa: F401
+    CatalogCache,
+    TTLCache,
+    invalidate_catalog,
+    invalidate_user,
+    track_catalog_writes,
+    track_user_writes,
+)
+from src.utils.events import LocalBroker, notify_after_commit, track_notifications  # noqa: F401
+from src.utils.export import EXPORT_BATCH_SIZE, EXPORT_FORMATS, stream_export  # noqa: F401
+from src.utils.holds import (  # noqa: F401
+    HOLD_PICKUP_DAYS,
+    HOLD_STATUSES,
+    cancel_hold,
+    expire_holds,
+    place_hold,
+    release_copy,
+    serve_waiting_holds,
+)
+from src.utils.importer import (  # noqa: F401
+    IMPORT_BATCH_SIZE,
+    IMPORT_FORMATS,
+    import_books,
+    read_feed,
+)
+from src.utils.instrumentation import (  # noqa: F401
+    QueryStats,
+    fingerprint,
+    init_query_stats,
+    instrument_engine,
+    track_queries,
+)
+from src.utils.pagination import (  # noqa: F401
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+    keyset_select,
+    keyset_sql,
+    order_clauses,
+    order_sql,
+    page_args,
+    paginate,
+)
+from src.utils.passwords import HasherBusy, PasswordHasher  # noqa: F401
+from src.utils.rollup import (  # noqa: F401
+    ROLLUP_PERIODS,
+    next_period_start,
+    period_range,
+    period_start,
+    periods_between,
+    rebuild_rollups,
+    record_borrow,
+    record_borrows,
+    record_return,
+    record_returns,
+    shift_rollups,
+)
+from src.utils.serialization import json_response, serialize_rows  # noqa: F401
+from src.utils.sqlite import configure_sqlite, full_scans  # noqa: F401
 
 PAYMENT_METHODS = ("cash", "debit", "credit", "paypal", "stripe")
 VALID_USER_TYPES = ("student", "external", "admin")
+MAX_BORROWS = 5
+FINE_PER_DAY = 100
+# Borrowers owing more than this in unpaid fines cannot borrow
+MAX_OUTSTANDING_BALANCE = 1000
+# Most books or borrows one circulation desk batch may list
+MAX_BATCH_ITEMS = 50
+
+# Whole days between `:now` and a borrow's due date, per database
+OVERDUE_DAYS = {
+    "sqlite": "CAST(julianday(:now) - julianday(borrow.due_date) AS INTEGER)",
+    "postgres": "EXTRACT(DAY FROM :now - borrow.due_date)::INTEGER",
+}
+# Unreturned borrows, spelled like the predicate of the partial idx_borrow_overdue index so
+# the database can use it
+UNRETURNED = {
+    "sqlite": "borrow.is_returned IS 0",
+    "postgres": "borrow.is_returned IS false",
+}
 
 
 def hash_password(password):
-    return generate_password_hash(password)
+    """Hash on the calling thread, for scripts. Requests go through the app's PasswordHasher."""
+    return generate_password_hash(password, config.PASSWORD_HASH_METHOD)
 
 
 def check_password(password, password_hash):
@@ -26,18 +110,62 @@ def check_password(password, password_hash):
 config: Config = config_dict[os.getenv("FLASK_ENV", "testing")]
 
 engine = create_engine(config.SQLALCHEMY_DATABASE_URI, echo=config.SQLALCHEMY_ECHO)
+instrument_engine(engine)
+if config.DB == "sqlite":
+    configure_sqlite(engine, config.SQLITE_PRAGMAS, config.SQLITE_OPTIMIZE_ON_CLOSE)
 dialect = config.DIALECT
 
-session = scoped_session(sessionmaker(bind=engine))
+session = scoped_session(
+    sessionmaker(bind=engine, expire_on_commit=config.SESSION_EXPIRE_ON_COMMIT)
+)
+track_catalog_writes(session.session_factory)
+track_user_writes(session.session_factory)
+track_notifications(session.session_factory)
 
 
 def sql_compile(clause: DQLDMLClauseElement, dialect=dialect) -> str:
+    if isinstance(clause, TextClause):
+        clause = clause.text
     if isinstance(clause, str):
         clauses = clause.split("\n")
         return "\n".join([line.strip() for line in clauses if line.strip()])
     return str(clause.compile(dialect=dialect(), compile_kwargs={"literal_binds": True}))
 
 
+def fts_match_expression(**columns):
+    """
+    Build an SQLite FTS5 MATCH expression from user supplied search terms.
+
+    Every word is quoted so FTS5 syntax in the input is treated as plain text, and is
+    prefix matched. Words for the same column are AND-ed, columns are OR-ed.
+
+    Example:
+    fts_match_expression(title="lord ring") -> 'title : ("lord"* AND "ring"*)'
+    """
+    groups = []
+    for column, value in columns.items():
+        words = ['"' + word.replace('"', '""') + '"*' for word in (value or "").split()]
+        if words:
+            groups.append(f"{column} : ({' AND '.join(words)})")
+    return " OR ".join(groups)
+
+
+def tsquery_expression(**columns):
+    """
+    Postgres equivalent of `fts_match_expression` for `to_tsquery('simple', ...)`.
+    Title words are restricted to weight A and author words to weight B, matching
+    the weights given in `book.search_vector`.
+    """
+    weights = {"title": "A", "author": "B"}
+    groups = []
+    for column, value in columns.items():
+        words = ["".join(ch for ch in word if ch.isalnum()) for word in (value or "").split()]
+        words = [f"{word}:*{weights.get(column, '')}" for word in words if word]
+        if words:
+            groups.append(f"({' & '.join(words)})")
+    return " | ".join(groups)
+
+
 def calculate_due_date(**kwargs):
     return kwargs.get("date", datetime.now()) + timedelta(days=14)
 
@@ -58,7 +186,7 @@ def calculate_fine(**kwargs):
     if not isinstance(date, datetime):
         date = datetime.fromisoformat(date)
     days = (datetime.now() - date).days
-    return days * 100 if days > 0 else 0
+    return days * FINE_PER_DAY if days > 0 else 0
 
 
 def atomic_transaction(func):
@@ -83,6 +211,122 @@ def atomic_transaction(func):
     return wrapper
 
 
+def sweep_overdue_fines(now: datetime = None, borrow_ids=None, db=None):
+    """
+    Fine every overdue, unreturned borrow and notify its borrower, in three set-based statements.
+
+    Borrows without a fine get a notification, the borrowers' outstanding balances grow by
+    the change in what they owe, then fines are upserted against the unique `fine.borrow_id`
+    key so unpaid fines grow with each run while paid ones are left alone.
+    Running the sweep again therefore neither duplicates fines nor notifications. The caller
+    is responsible for committing.
+
+    Args:
+        now (datetime, optional): The current date and time. Defaults to None, in which case the current date and time will be used.
+        borrow_ids (list[int], optional): Restrict the sweep to these borrows. Defaults to every borrow.
+        db (Session, optional): The session to use. Defaults to the global `session`.
+    Returns:
+        tuple: (number of fines created or updated, number of notifications created, queries)
+    """
+    db = session if db is None else db
+    if now is None:
+        now = datetime.now()
+    params = {"now": now, "today": datetime.combine(now.date(), datetime.min.time())}
+    binds = [bindparam("now", type_=DateTime), bindparam("today", type_=DateTime)]
+    overdue = f"{UNRETURNED[config.DB]} AND borrow.due_date < :today"
+    if borrow_ids is not None:
+        overdue += " AND borrow.id IN :borrow_ids"
+        params["borrow_ids"] = list(borrow_ids)
+        binds.append(bindparam("borrow_ids", expanding=True))
+
+    # Notify first, the NOT EXISTS needs to see the fines as they were before this sweep
+    notification_stmt = text(
+        f"""INSERT INTO notification (user_id, message, sent_date, is_read)
+        SELECT borrow.borrowed_by_id, 'You have overdue fines', :now, FALSE FROM borrow
+        WHERE {overdue} AND NOT EXISTS (SELECT 1 FROM fine WHERE fine.borrow_id = borrow.id)
+        RETURNING id, user_id, message, sent_date, is_read"""
+    ).bindparams(*binds)
+    # Add what the unpaid fines are about to grow by to the borrowers' balances, before the
+    # upsert below overwrites the amounts the difference is taken from
+    balance_stmt = text(
+        f"""UPDATE user_account SET outstanding_balance = outstanding_balance + owed.amount
+        FROM (
+            SELECT borrow.borrowed_by_id AS user_id,
+            SUM({OVERDUE_DAYS[config.DB]} * {FINE_PER_DAY} - COALESCE(fine.amount, 0)) AS amount
+            FROM borrow LEFT JOIN fine ON fine.borrow_id = borrow.id
+            WHERE {overdue} AND (fine.id IS NULL OR fine.paid = FALSE)
+            GROUP BY borrow.borrowed_by_id
+        ) AS owed
+        WHERE user_account.id = owed.user_id AND owed.amount != 0"""
+    ).bindparams(*binds)
+    fine_stmt = text(
+        f"""INSERT INTO fine (borrow_id, amount, date_created)
+        SELECT borrow.id, {OVERDUE_DAYS[config.DB]} * {FINE_PER_DAY}, :now FROM borrow
+        WHERE {overdue}
+        ON CONFLICT (borrow_id) DO UPDATE SET amount = excluded.amount WHERE fine.paid = FALSE"""
+    ).bindparams(*binds)
+
+    notifications = db.execute(notification_stmt, params).all()
+    notify_after_commit(db, notifications)
+    db.execute(balance_stmt, params)
+    fines = db.execute(fine_stmt, params).rowcount
+    queries = [notification_stmt.text, balance_stmt.text, fine_stmt.text]
+    return fines, len(notifications), [sql_compile(query) for query in queries]
+
+
+def repair_counters(db=None) -> int:
+    """
+    Recount every user's active loans and outstanding balance from the borrows and fines, e.g.
+    after importing data or editing it by hand. The caller is responsible for committing.
+
+    Returns:
+        int: The number of users whose counters had drifted.
+    """
+    db = session if db is None else db
+    return db.execute(qs.REPAIR_USER_COUNTERS).rowcount
+
+
+def fine_month(column):
+    """`YYYY-MM` of a datetime column, per database."""
+    if config.DB == "postgres":
+        return func.to_char(column, "YYYY-MM")
+    return func.strftime("%Y-%m", column)
+
+
+def fine_totals(*criteria, group_by=()):
+    """
+    Select the paid and unpaid fine totals in a single pass over the fines.
+
+    Args:
+        criteria: Filters on Fine, Borrow and the borrower's UserAccount, which are joined.
+        group_by: Columns to break the totals down by. Defaults to a single grand total.
+    Returns:
+        Select: Rows of the group_by columns, then `paid`, `unpaid` and `fines` (the count).
+        A total is NULL when no fine of that kind matched.
+    """
+    stmt = (
+        select(
+            *group_by,
+            func.sum(case((Fine.paid.is_(True), Fine.amount))).label("paid"),
+            func.sum(case((Fine.paid.is_(False), Fine.amount))).label("unpaid"),
+            func.count(Fine.id).label("fines"),
+        )
+        .select_from(Fine)
+        .join(Borrow, Fine.borrow_id == Borrow.id)
+        .join(UserAccount, Borrow.borrowed_by_id == UserAccount.id)
+        .where(*criteria)
+    )
+    if group_by:
+        stmt = stmt.group_by(*group_by).order_by(*group_by)
+    return stmt
+
+
+def sum_totals(rows, key):
+    """Add up a nullable total over grouped rows, None when every group was NULL."""
+    values = [row[key] for row in rows if row[key] is not None]
+    return sum(values) if values else None
+
+
 def check_overdue_and_create_fine(borrow: Borrow, now: datetime = None, commit=True):
     """
     Checks if a borrowed item is overdue and creates a fine if it is.
@@ -91,24 +335,258 @@ def check_overdue_and_create_fine(borrow: Borrow, now: datetime = None, commit=T
         now (datetime, optional): The current date and time. Defaults to None, in which case the current date and time will be used.
         commit (bool, optional): Whether to commit the transaction to the database. Defaults to True.
     Returns:
-        str: The SQL query string that was executed.
+        tuple: The SQL query strings that were executed, or None if the borrow is not overdue.
     """
-    if now is None:
-        now = datetime.now()
-    due_date = borrow.due_date
-    if not isinstance(due_date, datetime):
-        due_date = datetime.fromisoformat(due_date)
+    fines, _, queries = sweep_overdue_fines(now, borrow_ids=[borrow.id])
+    if commit:
+        session.commit()
 
-    if due_date.date() < now.date():
-        fine = calculate_fine(date=borrow.due_date)
-        fine_stmt = f"INSERT INTO fine (borrow_id, amount, date_created) VALUES ({borrow.id}, {fine}, '{now}')"
-        session.execute(text(fine_stmt))
+    if fines:
+        return tuple(queries)
 
-        overdue_stmt = f"INSERT INTO notification (user_id, message, sent_date, is_read) VALUES ({borrow.borrowed_by_id}, 'You have overdue fines', '{datetime.now()}', 0)"
-        session.execute(text(overdue_stmt))
-        session.commit()
 
-        if commit:
-            session.commit()
+def checkout_book(book_id, borrower_id, given_by_id, db=None):
+    """
+    Lend a copy of a book in as few round trips as possible.
+
+    The borrower's loan slot and the copy are each taken with a conditional update: the
+    first only succeeds while the borrower is under the borrow limit and owes at most
+    MAX_OUTSTANDING_BALANCE, the second while a copy is left. Concurrent checkouts of the
+    last copy, or by a borrower at the limit, therefore cannot both succeed. The borrow row
+    is then inserted in the same transaction. The caller is responsible for committing.
+
+    Args:
+        book_id (int): The book to lend.
+        borrower_id (int): The user borrowing the book.
+        given_by_id (int): The admin lending the book.
+        db (Session, optional): The session to use. Defaults to the global `session`.
+    Returns:
+        tuple: (error, queries). `error` is None on success, otherwise a (message, HTTPStatus) tuple.
+    """
+    db = session if db is None else db
+    params = {"book_id": book_id, "borrower_id": borrower_id}
+    queries = [sql_compile(qs.START_LOAN)]
+    lent = db.execute(
+        qs.START_LOAN,
+        {**params, "max_borrows": MAX_BORROWS, "max_balance": MAX_OUTSTANDING_BALANCE},
+    ).rowcount
+    if lent:
+        queries.append(sql_compile(qs.TAKE_COPY))
+        lent = db.execute(qs.TAKE_COPY, params).rowcount
+        if not lent:
+            # With the shelf empty, the borrower may be collecting a copy set aside for their hold
+            queries.append(sql_compile(qs.FULFILL_HOLD))
+            lent = db.execute(qs.FULFILL_HOLD, params).rowcount
+        if not lent:
+            queries.append(sql_compile(qs.END_LOAN))
+            db.execute(qs.END_LOAN, {"user_id": borrower_id})
+    if not lent:
+        # Only the failure path pays for finding out why
+        queries.append(sql_compile(qs.BORROWER_STANDING))
+        row = db.execute(qs.BORROWER_STANDING, params).mappings().first()
+        if row.active_loans is None:
+            error = ("Borrower not found", HTTPStatus.NOT_FOUND)
+        elif row.active_loans >= MAX_BORROWS:
+            error = (
+                f"Borrower has reached the maximum limit of {MAX_BORROWS} borrowed books",
+                HTTPStatus.BAD_REQUEST,
+            )
+        elif row.outstanding_balance > MAX_OUTSTANDING_BALANCE:
+            error = (
+                f"Borrower owes {row.outstanding_balance:g} in unpaid fines, "
+                f"more than the {MAX_OUTSTANDING_BALANCE} allowed to borrow",
+                HTTPStatus.BAD_REQUEST,
+            )
+        elif row.current_quantity is None:
+            error = ("Book not found", HTTPStatus.NOT_FOUND)
+        else:
+            error = ("Book is out of stock or is borrowed", HTTPStatus.BAD_REQUEST)
+        return error, queries
+
+    now = datetime.now()
+    stmt = text(
+        """INSERT INTO borrow (book_id, borrowed_by_id, given_by_id, borrow_date, due_date)
+        VALUES (:book_id, :borrower_id, :given_by_id, :borrow_date, :due_date)
+        RETURNING id"""
+    ).bindparams(bindparam("borrow_date", type_=DateTime), bindparam("due_date", type_=DateTime))
+    queries.append(sql_compile(stmt))
+    borrow_id = db.execute(
+        stmt,
+        {
+            "book_id": book_id,
+            "borrower_id": borrower_id,
+            "given_by_id": given_by_id,
+            "borrow_date": now,
+            "due_date": calculate_due_date(date=now),
+        },
+    ).scalar_one()
+    queries.append(sql_compile(record_borrow(db, borrow_id, now)))
+    return None, queries
+
+
+def checkout_books(book_ids, borrower_id, given_by_id, db=None):
+    """
+    Lend a stack of books to one borrower with a fixed number of set-based statements.
+
+    The borrower's free loan slots go to the books in the order they are listed. Every
+    listed book gets a result, with either its new `borrow_id` or an `error`. The caller is
+    responsible for committing.
+
+    Args:
+        book_ids (list[int]): The books to lend.
+        borrower_id (int): The user borrowing the books.
+        given_by_id (int): The admin lending the books.
+        db (Session, optional): The session to use. Defaults to the global `session`.
+    Returns:
+        tuple: (error, results, queries). `error` is a (message, HTTPStatus) tuple when the
+        borrower may not borrow at all, otherwise None.
+    """
+    db = session if db is None else db
+    queries = [sql_compile(qs.BORROWER_LOANS)]
+    standing = db.execute(qs.BORROWER_LOANS, {"borrower_id": borrower_id}).first()
+    if standing is None:
+        return ("Borrower not found", HTTPStatus.NOT_FOUND), [], queries
+    if standing.outstanding_balance > MAX_OUTSTANDING_BALANCE:
+        error = (
+            f"Borrower owes {standing.outstanding_balance:g} in unpaid fines, "
+            f"more than the {MAX_OUTSTANDING_BALANCE} allowed to borrow",
+            HTTPStatus.BAD_REQUEST,
+        )
+        return error, [], queries
+
+    results = [{"book_id": book_id} for book_id in book_ids]
+    wanted = {}  # book_id -> result, in the order listed
+    for result in results:
+        if result["book_id"] in wanted:
+            result["error"] = "Book is listed more than once"
+        elif len(wanted) >= MAX_BORROWS - standing.active_loans:
+            result["error"] = (
+                f"Borrower has reached the maximum limit of {MAX_BORROWS} borrowed books"
+            )
+        else:
+            wanted[result["book_id"]] = result
+    if not wanted:
+        return None, results, queries
+
+    params = {"borrower_id": borrower_id}
+    queries.append(sql_compile(qs.START_LOANS))
+    if not db.execute(
+        qs.START_LOANS,
+        {
+            **params,
+            "loans": len(wanted),
+            "max_borrows": MAX_BORROWS,
+            "max_balance": MAX_OUTSTANDING_BALANCE,
+        },
+    ).rowcount:
+        # Another desk lent to, or fined, the borrower since their loans were read
+        return ("Borrower's loans changed, try again", HTTPStatus.CONFLICT), [], queries
+
+    queries.append(sql_compile(qs.TAKE_COPIES))
+    lent = set(db.execute(qs.TAKE_COPIES, {"book_ids": list(wanted)}).scalars())
+    missing = [book_id for book_id in wanted if book_id not in lent]
+    if missing:
+        # The borrower may be collecting copies set aside for their holds
+        queries.append(sql_compile(qs.FULFILL_HOLDS))
+        lent.update(db.execute(qs.FULFILL_HOLDS, {**params, "book_ids": missing}).scalars())
+        missing = [book_id for book_id in missing if book_id not in lent]
+    if missing:
+        queries.append(sql_compile(qs.BOOKS_EXIST))
+        found = set(db.execute(qs.BOOKS_EXIST, {"book_ids": missing}).scalars())
+        for book_id in missing:
+            wanted[book_id]["error"] = (
+                "Book is out of stock or is borrowed" if book_id in found else "Book not found"
+            )
+        queries.append(sql_compile(qs.GIVE_BACK_LOANS))
+        db.execute(qs.GIVE_BACK_LOANS, {**params, "loans": len(missing)})
+    if not lent:
+        return None, results, queries
+
+    now = datetime.now()
+    queries.append(sql_compile(qs.INSERT_BORROWS))
+    borrows = db.execute(
+        qs.INSERT_BORROWS,
+        {
+            **params,
+            "given_by_id": given_by_id,
+            "borrow_date": now,
+            "due_date": calculate_due_date(date=now),
+            "book_ids": list(lent),
+        },
+    ).all()
+    for borrow_id, book_id in borrows:
+        wanted[book_id]["borrow_id"] = borrow_id
+    queries.append(sql_compile(record_borrows(db, [(borrow_id, now) for borrow_id, _ in borrows])))
+    return None, results, queries
+
+
+def return_books(borrow_ids, received_by_id, db=None):
+    """
+    Take back a stack of borrowed books with a fixed number of set-based statements.
+
+    Overdue borrows are fined first, as for a single return. Copies nobody is waiting for
+    go back on the shelf in one update, the others to the next patron in the book's queue.
+    Every listed borrow gets a result, with an `error` if it could not be returned. The
+    caller is responsible for committing.
+
+    Args:
+        borrow_ids (list[int]): The borrows to return.
+        received_by_id (int): The admin receiving the books.
+        db (Session, optional): The session to use. Defaults to the global `session`.
+    Returns:
+        tuple: (results, queries)
+    """
+    db = session if db is None else db
+    queries = [sql_compile(qs.BORROWS_TO_RETURN)]
+    borrows = {
+        borrow.id: borrow
+        for borrow in db.execute(qs.BORROWS_TO_RETURN, {"borrow_ids": list(set(borrow_ids))})
+    }
+    results = [{"borrow_id": borrow_id} for borrow_id in borrow_ids]
+    returning = {}  # borrow_id -> result, in the order listed
+    for result in results:
+        borrow = borrows.get(result["borrow_id"])
+        if borrow is None:
+            result["error"] = "Borrow record not found"
+        elif result["borrow_id"] in returning:
+            result["error"] = "Borrow is listed more than once"
+        elif borrow.is_returned:
+            result["error"] = "Book already returned"
+        else:
+            returning[borrow.id] = result
+    if not returning:
+        return results, queries
+
+    now = datetime.now()
+    # Settle the fines while the borrows still count as unreturned
+    _, _, fine_queries = sweep_overdue_fines(now, borrow_ids=list(returning), db=db)
+    queries.extend(fine_queries)
+
+    queries.append(sql_compile(qs.MARK_MANY_RETURNED))
+    returned = set(
+        db.execute(
+            qs.MARK_MANY_RETURNED,
+            {"borrow_ids": list(returning), "received_by_id": received_by_id},
+        ).scalars()
+    )
+    for borrow_id, result in returning.items():
+        if borrow_id in returned:
+            result["book_id"] = borrows[borrow_id].book_id
+        else:
+            # Returned by a concurrent request since it was read above
+            result["error"] = "Book already returned"
+    if not returned:
+        return results, queries
 
-        return (fine_stmt, overdue_stmt)
+    queries.append(sql_compile(qs.END_LOANS))
+    db.execute(qs.END_LOANS, {"borrow_ids": list(returned)})
+    copies = Counter(borrows[borrow_id].book_id for borrow_id in returned)
+    queries.append(sql_compile(qs.RESTOCK_BOOKS))
+    restocked = set(db.execute(qs.RESTOCK_BOOKS, {"book_ids": list(copies)}).scalars())
+    for book_id, count in copies.items():
+        # Books with a queue, or a second copy in the stack, go one copy at a time
+        for _ in range(count - (book_id in restocked)):
+            queries.extend(release_copy(db, book_id, now))
+    returned = [(borrow_id, borrows[borrow_id].borrow_date) for borrow_id in returned]
+    queries.append(sql_compile(record_returns(db, returned)))
+    return results, queries
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread safe, size bounded cache whose entries expire after `ttl` seconds.
+
+    When full, the least recently used entry is evicted to make room for a new one.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def invalidate_user(db, *user_ids):
+    """Drop users from the JWT user lookup cache once the session's current transaction commits."""
+    db.info.setdefault("changed_users", set()).update(user_ids)
+
+
+def track_user_writes(session_factory):
+    """
+    Drop changed users from the user lookup cache of the current app when their write commits.
+
+    Dropping them any earlier would let a lookup made before the commit cache the old row again.
+    """
+
+    @event.listens_for(session_factory, "after_commit")
+    def after_commit(db):
+        user_ids = db.info.pop("changed_users", None)
+        if user_ids and has_app_context():
+            cache = current_app.extensions.get("user_cache")
+            if cache is not None:
+                for user_id in user_ids:
+                    cache.pop(user_id)
+
+    @event.listens_for(session_factory, "after_rollback")
+    def after_rollback(db):
+        db.info.pop("changed_users", None)
+
+
+class CatalogCache:
+    """
+    A read-through cache for catalog pages that change far less often than they are read.
+
+    Entries are keyed by the catalog version they were loaded at, and every committed catalog
+    write bumps the version, so a page loaded while a write was in flight is never served
+    after it. Hits and misses are counted for the stats endpoint.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._data = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load):
+        """Return the cached value of `key`, or call `load()` and cache what it returns."""
+        version = self.version
+        value = self._data.get((version, key), _MISSING)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                return value, True
+        value = load()
+        self._data.set((version, key), value)
+        return value, False
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "size": len(self._data),
+            "maxsize": self._data.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def invalidate_catalog(db):
+    """Drop the cached catalog pages once the session's current transaction commits."""
+    db.info["catalog_changed"] = True
+
+
+def track_catalog_writes(session_factory):
+    """Bump the catalog version of the current app whenever a catalog write commits."""
+
+    @event.listens_for(session_factory, "after_commit")
+    def after_commit(db):
+        if db.info.pop("catalog_changed", False) and has_app_context():
+            cache = current_app.extensions.get("catalog_cache")
+            if cache is not None:
+                cache.invalidate()
+
+    @event.listens_for(session_factory, "after_rollback")
+    def after_rollback(db):
+        db.info.pop("catalog_changed", None)
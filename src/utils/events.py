@@ -0,0 +1,95 @@
+import threading
+from bisect import bisect_left, insort
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from src.p_models import NotificationListSchema
+
+
+class LocalBroker:
+    """
+    In-process publish/subscribe for notification events, for the SSE stream.
+
+    The last `backlog` events are kept, filed by user, so a listener that was busy writing
+    to its client picks up everything published meanwhile without going through everyone
+    else's. Listeners block on a condition, so waiting for the next event costs neither a
+    query nor a busy loop. Only the listeners of this process see an event; a broker backed
+    by e.g. Postgres LISTEN/NOTIFY with the same two methods would reach the others.
+    """
+
+    def __init__(self, backlog: int = 1000):
+        self.backlog = backlog
+        self._events = {}  # user id -> [(event id, data)], ids ascending
+        self._published = deque()  # (event id, user id) in publish order, oldest dropped first
+        self._last_id = 0
+        self._changed = threading.Condition()
+
+    @property
+    def last_id(self) -> int:
+        with self._changed:
+            return self._last_id
+
+    def publish(self, events):
+        """
+        Publish (event id, user id, data) tuples. Transactions commit in any order, so each
+        event is filed by id rather than appended, and one published after a later id still
+        reaches a listener that has not got past it.
+        """
+        with self._changed:
+            for event_id, user_id, data in events:
+                insort(self._events.setdefault(user_id, []), (event_id, data))
+                self._published.append((event_id, user_id))
+                self._last_id = max(self._last_id, event_id)
+            while len(self._published) > self.backlog:
+                event_id, user_id = self._published.popleft()
+                user_events = self._events[user_id]
+                del user_events[bisect_left(user_events, (event_id,))]
+                if not user_events:
+                    del self._events[user_id]
+            self._changed.notify_all()
+
+    def listen(self, user_id: int, after_id: int, timeout: float) -> list:
+        """
+        The user's events with an id above `after_id`, waiting up to `timeout` seconds for
+        one to be published.
+
+        Returns:
+            list: (event id, data) tuples, empty when the wait timed out.
+        """
+
+        def pending():
+            user_events = self._events.get(user_id, [])
+            start = bisect_left(user_events, (after_id + 1,))
+            return user_events[start:]
+
+        with self._changed:
+            return self._changed.wait_for(pending, timeout)
+
+
+def notify_after_commit(db, rows):
+    """
+    Publish new notification rows to the app's broker once the session commits, so no
+    listener hears of a notification that was rolled back.
+    """
+    db.info.setdefault("notifications", []).extend(
+        (row.id, row.user_id, NotificationListSchema.model_validate(row).model_dump_json())
+        for row in rows
+    )
+
+
+def track_notifications(session_factory):
+    """Hand the notifications of every committed transaction to the current app's broker."""
+
+    @event.listens_for(session_factory, "after_commit")
+    def after_commit(db):
+        events = db.info.pop("notifications", None)
+        if events and has_app_context():
+            broker = current_app.extensions.get("notification_broker")
+            if broker is not None:
+                broker.publish(sorted(events))
+
+    @event.listens_for(session_factory, "after_rollback")
+    def after_rollback(db):
+        db.info.pop("notifications", None)
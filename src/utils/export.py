@@ -0,0 +1,51 @@
+import csv
+import io
+import json
+from datetime import date
+
+from flask import Response, stream_with_context
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_BATCH_SIZE = 1000
+
+
+def _to_json(value):
+    return value.isoformat() if isinstance(value, date) else str(value)
+
+
+def stream_export(rows, fmt: str, filename: str, fieldnames: list[str]) -> Response:
+    """
+    Stream rows to the client as newline delimited JSON or CSV.
+
+    Rows are written out in batches of EXPORT_BATCH_SIZE as they are produced, so the
+    response never holds more than one batch in memory. Pair it with a `yield_per`
+    query to keep the whole export bounded.
+
+    Args:
+        rows (iterable): Flat dicts, one per exported row. May be a generator.
+        fmt (str): One of EXPORT_FORMATS.
+        filename (str): The download name, without extension.
+        fieldnames (list[str]): The CSV columns, in order.
+    """
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames, extrasaction="ignore")
+        if fmt == "csv":
+            writer.writeheader()
+        for i, row in enumerate(rows, start=1):
+            if fmt == "csv":
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(row, default=_to_json) + "\n")
+            if i % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"},
+    )
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+from http import HTTPStatus
+
+import src.queries as qs
+from src.utils.events import notify_after_commit
+
+HOLD_STATUSES = ("waiting", "ready", "fulfilled", "cancelled", "expired")
+# Days a patron has to collect a copy set aside for them
+HOLD_PICKUP_DAYS = 3
+# Tries at the tail of a queue that other patrons keep joining at the same moment
+PLACE_HOLD_ATTEMPTS = 5
+
+
+def place_hold(db, book_id: int, user_id: int, now: datetime):
+    """
+    Queue a patron for a book with no copies on the shelf. The caller is responsible for
+    committing.
+
+    Returns:
+        tuple: (error, hold, queries). `hold` has the new hold's `id` and queue `position`.
+    """
+    queries = [qs.BOOK_SHELF.text]
+    shelf = db.execute(qs.BOOK_SHELF, {"book_id": book_id}).scalar()
+    if shelf is None:
+        return ("Book not found", HTTPStatus.NOT_FOUND), None, queries
+    if shelf > 0:
+        return ("Book has copies available to borrow", HTTPStatus.BAD_REQUEST), None, queries
+
+    params = {"book_id": book_id, "user_id": user_id}
+    queries.append(qs.ACTIVE_HOLD_EXISTS.text)
+    if db.execute(qs.ACTIVE_HOLD_EXISTS, params).scalar():
+        return ("You already have a hold on this book", HTTPStatus.BAD_REQUEST), None, queries
+
+    for _ in range(PLACE_HOLD_ATTEMPTS):
+        queries.append(qs.PLACE_HOLD.text)
+        hold_id = db.execute(qs.PLACE_HOLD, {**params, "now": now}).scalar()
+        if hold_id is not None:
+            break
+    else:
+        error = ("Too many patrons are queueing for this book, try again", HTTPStatus.CONFLICT)
+        return error, None, queries
+    queries.append(qs.USER_HOLD.text)
+    hold = db.execute(qs.USER_HOLD, {"hold_id": hold_id, "user_id": user_id}).mappings().one()
+    return None, hold, queries
+
+
+def release_copy(db, book_id: int, now: datetime) -> list[str]:
+    """
+    Put a copy that came back on the shelf, or set it aside for the next patron in the
+    book's queue and notify them. Returns the queries run.
+    """
+    queries = [qs.RESTOCK_BOOK.text]
+    if db.execute(qs.RESTOCK_BOOK, {"book_id": book_id}).rowcount:
+        return queries
+
+    promoted, promote_queries = promote_hold(db, book_id, now)
+    queries.extend(promote_queries)
+    if not promoted:
+        # The last waiting hold was cancelled in between
+        queries.append(qs.RESTOCK_BOOK.text)
+        db.execute(qs.RESTOCK_BOOK, {"book_id": book_id})
+    return queries
+
+
+def serve_waiting_holds(db, book_ids, now: datetime) -> list[str]:
+    """
+    Set copies added to the shelf of books that patrons are queueing for aside for the
+    heads of their queues, one patron per copy, and notify them. Call it after raising the
+    shelf count of `book_ids`, so a walk-in borrower cannot take a copy ahead of the queue.
+    Returns the queries run.
+    """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return []
+    queries = [qs.QUEUED_SHELF_BOOKS.text]
+    for book_id in db.execute(qs.QUEUED_SHELF_BOOKS, {"book_ids": book_ids}).scalars().all():
+        while True:
+            queries.append(qs.TAKE_SHELF_COPY.text)
+            if not db.execute(qs.TAKE_SHELF_COPY, {"book_id": book_id}).rowcount:
+                break
+            queries.extend(promote_hold(db, book_id, now)[1])
+    return queries
+
+
+def promote_hold(db, book_id: int, now: datetime):
+    """
+    Set a copy aside for the head of the book's queue and notify them.
+
+    Returns:
+        tuple: (whether there was a waiting hold to promote, queries)
+    """
+    queries = [qs.PROMOTE_HOLD.text]
+    expires_at = now + timedelta(days=HOLD_PICKUP_DAYS)
+    hold = (
+        db.execute(qs.PROMOTE_HOLD, {"book_id": book_id, "now": now, "expires_at": expires_at})
+        .mappings()
+        .first()
+    )
+    if hold is None:
+        return False, queries
+    queries.append(qs.NOTIFY_HOLD_READY.text)
+    notification = db.execute(
+        qs.NOTIFY_HOLD_READY, {"user_id": hold.user_id, "book_id": book_id, "now": now}
+    ).all()
+    notify_after_commit(db, notification)
+    return True, queries
+
+
+def cancel_hold(db, hold_id: int, user_id: int, now: datetime):
+    """
+    Cancel a waiting or ready hold. The holds behind a waiting one move up a place, as their
+    position is counted on read, and a copy set aside for a ready one goes to the next
+    patron. The caller is responsible for committing.
+
+    Returns:
+        tuple: (error, queries)
+    """
+    queries = [qs.USER_HOLD.text]
+    hold = db.execute(qs.USER_HOLD, {"hold_id": hold_id, "user_id": user_id}).mappings().first()
+    if hold is None or hold.status not in ("waiting", "ready"):
+        return ("Hold not found or no longer active", HTTPStatus.NOT_FOUND), queries
+
+    queries.append(qs.CANCEL_HOLD.text)
+    if not db.execute(qs.CANCEL_HOLD, {"hold_id": hold_id, "status": hold.status}).rowcount:
+        return ("Hold not found or no longer active", HTTPStatus.NOT_FOUND), queries
+    if hold.status == "ready":
+        queries.extend(release_copy(db, hold.book_id, now))
+    return None, queries
+
+
+def expire_holds(db, now: datetime = None) -> int:
+    """
+    Release the copies set aside for holds that were not collected in time. The caller is
+    responsible for committing.
+
+    Returns:
+        int: The number of holds expired.
+    """
+    now = now or datetime.now()
+    book_ids = db.execute(qs.EXPIRE_HOLDS, {"now": now}).scalars().all()
+    for book_id in book_ids:
+        release_copy(db, book_id, now)
+    return len(book_ids)
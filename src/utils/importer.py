@@ -0,0 +1,205 @@
+import codecs
+import csv
+import json
+from datetime import datetime
+
+from pydantic import ValidationError
+from sqlalchemy import case, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.models import Book, Category
+from src.utils.cache import invalidate_catalog
+from src.utils.holds import serve_waiting_holds
+from src.utils.rollup import shift_rollups
+from src.p_models import BookImportSchema
+
+IMPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+IMPORT_BATCH_SIZE = 1000
+
+_INSERT = {"sqlite": sqlite.insert, "postgres": postgresql.insert}
+
+
+def decode_lines(stream):
+    """The lines of a UTF-8 byte stream, decoded one at a time so a bad byte shows up on its line."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    for line in stream:
+        yield decoder.decode(line)
+
+
+def read_feed(stream, fmt: str):
+    """
+    Parse a CSV or newline delimited JSON feed lazily. A line that is not UTF-8 is reported
+    as an error, and ends the feed.
+
+    Yields:
+        tuple: (line number, row dict or None, parse error or None)
+    """
+    lines = decode_lines(stream)
+    line_num = 0
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(lines)
+            for row in reader:
+                yield reader.line_num, {k: v for k, v in row.items() if k and v != ""}, None
+            return
+        for line_num, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_num, None, f"Invalid JSON: {e.msg}"
+                continue
+            if isinstance(row, dict):
+                yield line_num, row, None
+            else:
+                yield line_num, None, "Expected a JSON object"
+    except UnicodeDecodeError:
+        if fmt == "csv":
+            line_num = reader.line_num
+        yield line_num + 1, None, "Not UTF-8 text, the rest of the feed was not read"
+
+
+def upsert_books_statement(dialect: str):
+    """
+    Insert books, or update the catalogue entry of an ISBN already held.
+
+    `quantity` is the number of copies the library holds, so lent out copies stay lent out:
+    the shelf count moves by the change in holdings.
+    """
+    stmt = _INSERT[dialect](Book.__table__)
+    shelf = Book.current_quantity + stmt.excluded.original_quantity - Book.original_quantity
+    shelf = case((shelf > 0, shelf), else_=0)
+    return stmt.on_conflict_do_update(
+        index_elements=[Book.isbn],
+        set_={
+            "title": stmt.excluded.title,
+            "author": stmt.excluded.author,
+            "category_id": stmt.excluded.category_id,
+            "location": stmt.excluded.location,
+            "original_quantity": stmt.excluded.original_quantity,
+            "current_quantity": shelf,
+            "is_available": shelf > 0,
+        },
+    ).returning(Book.id, Book.isbn)
+
+
+def _error(line, message, isbn=None):
+    return {"line": line, "isbn": isbn, "error": message}
+
+
+def import_books(db, rows, added_by_id: int, dialect: str, batch_size: int = IMPORT_BATCH_SIZE):
+    """
+    Validate and upsert a feed of books by ISBN, one transaction per batch.
+
+    A bad row never aborts the import: it is reported with its line number and skipped. If
+    a batch fails in the database, its rows are retried one by one so only the offending
+    ones are lost.
+
+    Args:
+        db (Session): The session to use, committed after every batch.
+        rows (iterable): (line number, row, parse error) tuples, as from `read_feed`.
+        added_by_id (int): The admin importing the books.
+        dialect (str): "sqlite" or "postgres".
+        batch_size (int): Rows per transaction.
+    Returns:
+        dict: The created and updated book ids, and the errors per line.
+    """
+    stmt = upsert_books_statement(dialect)
+    categories = set(db.execute(select(Category.id)).scalars())
+    now = datetime.now()
+    result = {"created": [], "updated": [], "errors": []}
+    batch = {}  # isbn -> (line, params), an ISBN only once per statement
+
+    def flush():
+        if not batch:
+            return
+        items = list(batch.values())
+        batch.clear()
+        held = {
+            isbn: (book_id, category_id)
+            for book_id, isbn, category_id in db.execute(
+                select(Book.id, Book.isbn, Book.category_id).where(
+                    Book.isbn.in_([p["isbn"] for _, p in items])
+                )
+            )
+        }
+        existing = set(held)
+        # Borrows of a recategorised book move to the rollup counts of its new category
+        moved = {
+            p["isbn"]: held[p["isbn"]][0]
+            for _, p in items
+            if p["isbn"] in held and held[p["isbn"]][1] != p["category_id"]
+        }
+        try:
+            if moved:
+                shift_rollups(db, dialect, -1, "book_id", moved.values())
+            ids = {isbn: book_id for book_id, isbn in db.execute(stmt, [p for _, p in items])}
+            if moved:
+                shift_rollups(db, dialect, 1, "book_id", moved.values())
+            # Copies added to a book patrons are queueing for go to the queue first
+            serve_waiting_holds(db, [ids[isbn] for isbn in existing if isbn in ids], now)
+            invalidate_catalog(db)
+            db.commit()
+        except SQLAlchemyError:
+            db.rollback()
+            ids = {}
+            for line, params in items:
+                try:
+                    if params["isbn"] in moved:
+                        shift_rollups(db, dialect, -1, "book_id", [moved[params["isbn"]]])
+                    ids[params["isbn"]] = db.execute(stmt, [params]).one().id
+                    if params["isbn"] in moved:
+                        shift_rollups(db, dialect, 1, "book_id", [moved[params["isbn"]]])
+                    if params["isbn"] in existing:
+                        serve_waiting_holds(db, [ids[params["isbn"]]], now)
+                    invalidate_catalog(db)
+                    db.commit()
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    message = str(getattr(e, "orig", None) or e)
+                    result["errors"].append(_error(line, message, params["isbn"]))
+        for _, params in items:
+            book_id = ids.get(params["isbn"])
+            if book_id is not None:
+                result["updated" if params["isbn"] in existing else "created"].append(book_id)
+
+    for line, row, parse_error in rows:
+        if parse_error:
+            result["errors"].append(_error(line, parse_error))
+            continue
+        try:
+            book = BookImportSchema.model_validate(row)
+        except ValidationError as e:
+            message = "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+            )
+            result["errors"].append(_error(line, message, row.get("isbn")))
+            continue
+        if book.category_id not in categories:
+            result["errors"].append(_error(line, "Category not found", book.isbn))
+            continue
+        # A later row for the same ISBN wins, so it goes in after the earlier one
+        if book.isbn in batch:
+            flush()
+        batch[book.isbn] = (
+            line,
+            {
+                "title": book.title,
+                "author": book.author,
+                "isbn": book.isbn,
+                "category_id": book.category_id,
+                "original_quantity": book.quantity,
+                "current_quantity": book.quantity,
+                "is_available": book.quantity > 0,
+                "location": book.location,
+                "date_added": now,
+                "added_by_id": added_by_id,
+            },
+        )
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    result["errors"].sort(key=lambda error: error["line"])
+    return result
@@ -0,0 +1,109 @@
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import Flask, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Every collector active in the current context receives every statement, so a test
+# tracking queries also sees the ones run by the requests it makes
+_collectors: ContextVar[tuple] = ContextVar("query_collectors", default=())
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """Reduce a statement to its shape: literals become `?` and IN lists collapse to `(?)`."""
+    statement = _LITERALS.sub("?", statement)
+    statement = _IN_LISTS.sub("(?)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+class QueryStats:
+    """The statements run while a collector was active, and the time spent running them."""
+
+    def __init__(self):
+        self.statements = []
+        self.parameters = []
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def record(self, statement: str, duration: float, parameters=None):
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold: int) -> dict:
+        """Statement shapes run at least `threshold` times, the usual sign of an N+1 loop."""
+        return {shape: n for shape, n in self.fingerprints.items() if n >= threshold}
+
+
+@contextmanager
+def track_queries():
+    """Collect every statement executed inside the block into a QueryStats."""
+    stats = QueryStats()
+    token = _collectors.set(_collectors.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _collectors.reset(token)
+
+
+def instrument_engine(engine: Engine):
+    """Time every statement the engine runs and report it to the active collectors."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start"].pop()
+        for stats in _collectors.get():
+            stats.record(statement, duration, parameters)
+
+
+def init_query_stats(app: Flask):
+    """
+    Report the statements each request ran.
+
+    Adds `X-Query-Count` and a `Server-Timing` db entry to every response, and logs a
+    warning when one statement shape repeats `N_PLUS_ONE_THRESHOLD` times in a request.
+    """
+    threshold = app.config["N_PLUS_ONE_THRESHOLD"]
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        g.query_stats_token = _collectors.set(_collectors.get() + (g.query_stats,))
+
+    @app.after_request
+    def add_query_stats_headers(response):
+        stats: QueryStats = g.get("query_stats")
+        if stats is None:
+            return response
+        response.headers["X-Query-Count"] = str(stats.count)
+        response.headers.add(
+            "Server-Timing", f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"'
+        )
+        for shape, n in stats.repeated(threshold).items():
+            app.logger.warning(
+                "Possible N+1 in %s %s, ran %d times: %s", request.method, request.path, n, shape
+            )
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(_exception=None):
+        token = g.pop("query_stats_token", None)
+        if token is not None:
+            _collectors.reset(token)
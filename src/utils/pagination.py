@@ -0,0 +1,128 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import DateTime, and_, or_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values) -> str:
+    """Turn the sort key values of the last row of a page into an opaque cursor."""
+    data = json.dumps(
+        list(values), default=lambda v: v.isoformat(" ") if isinstance(v, datetime) else str(v)
+    )
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(values, list):
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+
+def page_args(size: int = None):
+    """
+    Read the `limit` and `cursor` query arguments of the current request.
+
+    Returns:
+    tuple: (limit, cursor values or None). Raises InvalidCursor for a malformed cursor.
+    """
+    limit = request.args.get("limit", type=int) or size or DEFAULT_PAGE_SIZE
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = request.args.get("cursor")
+    return limit, decode_cursor(cursor) if cursor else None
+
+
+def keyset_filter(keys, values):
+    """
+    Build the predicate selecting the rows after a cursor.
+
+    Args:
+        keys (list): (column expression, descending) pairs, in ORDER BY order. The last key must be unique.
+        values (list): The cursor values for the keys.
+    Returns:
+        ColumnElement: `(k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...`, with `<` for descending keys.
+    """
+    if len(keys) != len(values):
+        raise InvalidCursor("Invalid cursor")
+    values = [
+        (
+            datetime.fromisoformat(value)
+            if isinstance(value, str) and isinstance(column.type, DateTime)
+            else value
+        )
+        for (column, _), value in zip(keys, values)
+    ]
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        after = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, after))
+    return or_(*clauses)
+
+
+def keyset_sql(keys, values, prefix="cursor"):
+    """
+    `keyset_filter` for hand written SQL.
+
+    Args:
+        keys (list): (SQL expression, descending) pairs, in ORDER BY order. The last key must be unique.
+        values (list): The cursor values for the keys.
+        prefix (str): Prefix of the generated bind parameter names.
+    Returns:
+        tuple: (SQL fragment, bind parameters)
+    """
+    if len(keys) != len(values):
+        raise InvalidCursor("Invalid cursor")
+    params = {f"{prefix}_{i}": value for i, value in enumerate(values)}
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [f"{keys[j][0]} = :{prefix}_{j}" for j in range(i)]
+        after = f"{column} {'<' if descending else '>'} :{prefix}_{i}"
+        clauses.append("(" + " AND ".join(equal + [after]) + ")")
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+def order_sql(keys) -> str:
+    return ", ".join(f"{column} {'DESC' if descending else 'ASC'}" for column, descending in keys)
+
+
+def order_clauses(keys) -> list:
+    return [column.desc() if descending else column.asc() for column, descending in keys]
+
+
+def keyset_select(stmt, keys, cursor, limit):
+    """Order a select by the keys, skip to the cursor and fetch one row more than the page size."""
+    if cursor:
+        stmt = stmt.where(keyset_filter(keys, cursor))
+    return stmt.order_by(*order_clauses(keys)).limit(limit + 1)
+
+
+def paginate(rows, limit, key):
+    """
+    Split the rows fetched with `LIMIT limit + 1` into a page and the cursor of the next one.
+
+    Args:
+        rows (list): The fetched rows.
+        limit (int): The page size.
+        key (callable): Returns the sort key values of a row.
+    Returns:
+        tuple: (rows of this page, next cursor or None on the last page)
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(key(rows[-1]))
@@ -0,0 +1,71 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+
+class PasswordHasher:
+    """
+    Hash and verify passwords off the request threads, in a bounded process pool.
+
+    Password hashing is deliberately slow, so a burst of logins would otherwise hold every
+    request thread and starve the cheap routes. At most `max_pending` hashes wait or run at
+    once; the next one raises HasherBusy straight away instead of queueing. With no
+    `workers`, hashing runs on the calling thread under the same limit.
+
+    `method` is a werkzeug hash method such as "scrypt:32768:8:1" or
+    "pbkdf2:sha256:600000". Hashes made with other parameters still verify, and
+    `needs_rehash` tells when to replace them.
+    """
+
+    def __init__(self, method: str, workers: int = 0, max_pending: int = 32):
+        self.method = method
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @cached_property
+    def prefix(self) -> str:
+        """The method with werkzeug's defaults filled in, as stored before the first `$`."""
+        return generate_password_hash("", self.method).split("$", 1)[0]
+
+    def _pool_executor(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                # Forking a threaded server can copy a held lock into the child
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            if not self.workers:
+                return func(*args)
+            return self._pool_executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        return password_hash.split("$", 1)[0] != self.prefix
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
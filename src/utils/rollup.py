@@ -0,0 +1,174 @@
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Date, bindparam, text
+
+ROLLUP_PERIODS = ("day", "week", "month")
+
+# First day of the period a borrow falls in. Weeks start on Monday, as in Postgres.
+PERIOD_START = {
+    "sqlite": {
+        "day": "date(borrow.borrow_date)",
+        "week": "date(borrow.borrow_date, 'weekday 0', '-6 days')",
+        "month": "date(borrow.borrow_date, 'start of month')",
+    },
+    "postgres": {
+        period: f"date_trunc('{period}', borrow.borrow_date)::date" for period in ROLLUP_PERIODS
+    },
+}
+
+UPSERT_ROLLUP = text(
+    """INSERT INTO borrow_rollup (period, period_start, category_id, role, is_returned, borrow_count)
+    SELECT :period, :period_start, book.category_id, user_account.role, :is_returned, :delta
+    FROM borrow
+    JOIN book ON book.id = borrow.book_id
+    JOIN user_account ON user_account.id = borrow.borrowed_by_id
+    WHERE borrow.id = :borrow_id
+    ON CONFLICT (period, period_start, category_id, role, is_returned)
+    DO UPDATE SET borrow_count = borrow_rollup.borrow_count + excluded.borrow_count"""
+).bindparams(bindparam("period_start", type_=Date))
+
+
+def period_start(period: str, moment) -> date:
+    """The first day of the day, week, month or year `moment` falls in."""
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment)
+    day = moment.date() if isinstance(moment, datetime) else moment
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    if period == "year":
+        return day.replace(month=1, day=1)
+    return day
+
+
+def next_period_start(period: str, start: date) -> date:
+    if period == "week":
+        return start + timedelta(weeks=1)
+    if period == "month":
+        return (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+    if period == "year":
+        return start.replace(year=start.year + 1)
+    return start + timedelta(days=1)
+
+
+def periods_between(period: str, start: date, end: date) -> int:
+    """How many periods the series from the period of `start` to that of `end` holds."""
+    start, end = period_start(period, start), period_start(period, end)
+    if period == "week":
+        return (end - start).days // 7 + 1
+    if period == "month":
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    if period == "year":
+        return end.year - start.year + 1
+    return (end - start).days + 1
+
+
+def period_range(period: str, moment) -> tuple[datetime, datetime]:
+    """The half-open [start, end) datetime range of the period `moment` falls in."""
+    start = period_start(period, moment)
+    end = next_period_start(period, start)
+    return datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time())
+
+
+def record_borrow(db, borrow_id: int, borrow_date):
+    """Count a new borrow in its day, week and month. Returns the query run."""
+    return record_borrows(db, [(borrow_id, borrow_date)])
+
+
+def record_borrows(db, borrows):
+    """Count new (borrow id, borrow date) borrows in one statement. Returns the query run."""
+    db.execute(
+        UPSERT_ROLLUP,
+        [
+            {
+                "period": period,
+                "period_start": period_start(period, borrow_date),
+                "is_returned": False,
+                "delta": 1,
+                "borrow_id": borrow_id,
+            }
+            for borrow_id, borrow_date in borrows
+            for period in ROLLUP_PERIODS
+        ],
+    )
+    return UPSERT_ROLLUP.text
+
+
+def record_return(db, borrow_id: int, borrow_date):
+    """Move a returned borrow from the unreturned to the returned counts. Returns the query run."""
+    return record_returns(db, [(borrow_id, borrow_date)])
+
+
+def record_returns(db, borrows):
+    """Move returned (borrow id, borrow date) borrows in one statement. Returns the query run."""
+    db.execute(
+        UPSERT_ROLLUP,
+        [
+            {
+                "period": period,
+                "period_start": period_start(period, borrow_date),
+                "is_returned": is_returned,
+                "delta": 1 if is_returned else -1,
+                "borrow_id": borrow_id,
+            }
+            for borrow_id, borrow_date in borrows
+            for period in ROLLUP_PERIODS
+            for is_returned in (False, True)
+        ],
+    )
+    return UPSERT_ROLLUP.text
+
+
+def shift_rollups(db, dialect: str, sign: int, column: str, ids) -> list[str]:
+    """
+    Take away (`sign` -1) or add back (`sign` 1) the counts of the borrows whose `column`,
+    "book_id" or "borrowed_by_id", is in `ids`, under their book's current category and
+    borrower's current role.
+
+    The rollups count a borrow under the category and role it has now, so a recategorised
+    book or a user whose role changes takes its borrows along: shift them out before the
+    update and back in after it, and later returns find them where they were counted.
+    Returns the queries run.
+    """
+    queries = []
+    for period in ROLLUP_PERIODS:
+        start = PERIOD_START[dialect][period]
+        stmt = text(
+            f"""INSERT INTO borrow_rollup (period, period_start, category_id, role, is_returned, borrow_count)
+            SELECT :period, {start}, book.category_id, user_account.role, borrow.is_returned, :sign * COUNT(*)
+            FROM borrow
+            JOIN book ON book.id = borrow.book_id
+            JOIN user_account ON user_account.id = borrow.borrowed_by_id
+            WHERE borrow.{column} IN :ids
+            GROUP BY {start}, book.category_id, user_account.role, borrow.is_returned
+            ON CONFLICT (period, period_start, category_id, role, is_returned)
+            DO UPDATE SET borrow_count = borrow_rollup.borrow_count + excluded.borrow_count"""
+        ).bindparams(bindparam("ids", expanding=True))
+        db.execute(stmt, {"period": period, "sign": sign, "ids": list(ids)})
+        queries.append(stmt.text)
+    return queries
+
+
+def rebuild_rollups(db, dialect: str) -> int:
+    """
+    Recount the rollups from the whole borrow history, e.g. after importing borrows. The
+    caller is responsible for committing.
+
+    Returns:
+        int: The number of rollup rows written.
+    """
+    db.execute(text("DELETE FROM borrow_rollup"))
+    rows = 0
+    for period in ROLLUP_PERIODS:
+        start = PERIOD_START[dialect][period]
+        stmt = text(
+            f"""INSERT INTO borrow_rollup (period, period_start, category_id, role, is_returned, borrow_count)
+            SELECT :period, {start}, book.category_id, user_account.role, borrow.is_returned, COUNT(*)
+            FROM borrow
+            JOIN book ON book.id = borrow.book_id
+            JOIN user_account ON user_account.id = borrow.borrowed_by_id
+            GROUP BY {start}, book.category_id, user_account.role, borrow.is_returned"""
+        )
+        rows += db.execute(stmt, {"period": period}).rowcount
+    return rows
@@ -0,0 +1,48 @@
+import json
+from functools import lru_cache
+from http import HTTPStatus
+
+from flask import Response, current_app
+from pydantic import TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def list_adapter(schema) -> TypeAdapter:
+    return TypeAdapter(list[schema])
+
+
+def serialize_rows(schema, rows) -> bytes:
+    """
+    Validate DB rows against a schema and encode them to a JSON array in one batch.
+
+    Replaces `[Schema.model_validate(row) ...]` followed by `model_dump()` and `jsonify`:
+    the whole list is validated and encoded by pydantic's core, without building a dict
+    per row in between.
+
+    Args:
+        schema (type[BaseModel]): The schema of one row.
+        rows (list): ORM objects or row mappings.
+    Returns:
+        bytes: The JSON array.
+    """
+    adapter = list_adapter(schema)
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+
+def json_response(payload: dict, status=HTTPStatus.OK) -> Response:
+    """
+    `make_response(jsonify(payload), status)` for payloads holding `serialize_rows` output.
+
+    Values that are bytes are taken as already encoded JSON, everything else goes through
+    the app's JSON provider.
+    """
+    dumps = current_app.json.dumps
+    body = b",".join(
+        json.dumps(key).encode()
+        + b":"
+        + (value if isinstance(value, bytes) else dumps(value).encode())
+        for key, value in payload.items()
+    )
+    return current_app.response_class(
+        b"{" + body + b"}", status=status, mimetype=current_app.json.mimetype
+    )
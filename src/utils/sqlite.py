@@ -0,0 +1,60 @@
+import re
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+
+_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+def configure_sqlite(engine: Engine, pragmas: dict, optimize_on_close=False):
+    """
+    Tune every connection the engine opens.
+
+    Args:
+        engine (Engine): A SQLite engine.
+        pragmas (dict): PRAGMA name to value, applied in order as each connection opens.
+        optimize_on_close (bool): Run `PRAGMA optimize` before a connection is closed, so
+            the query planner statistics stay fresh without a separate ANALYZE job.
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    if optimize_on_close:
+
+        @event.listens_for(engine, "close")
+        def optimize(dbapi_connection, _connection_record):
+            dbapi_connection.execute("PRAGMA optimize")
+
+
+def full_scans(conn: Connection, statement: str, parameters=()) -> set[str]:
+    """
+    The tables SQLite reads every row of to run `statement`, from its EXPLAIN QUERY PLAN.
+
+    A plain `SCAN` of a table is a full scan; a `SEARCH`, or a scan of an index in its
+    order, is not. Subqueries read in full are not tables and are left out. The plan names
+    a table by its alias when it has one, so aliases are looked up in the statement.
+
+    Args:
+        conn (Connection): A connection to the SQLite database to plan against.
+        statement (str): The SQL as sent to the driver, with `?` placeholders.
+        parameters: The statement's parameters, as sent to the driver.
+    """
+    tables = set(
+        conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'").scalars()
+    )
+    scanned = set()
+    for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters):
+        match = _SCAN.match(row.detail)
+        if match is None:
+            continue
+        name = match.group(1)
+        alias = re.search(rf"\b(\w+) AS {name}\b", statement)
+        name = alias.group(1) if alias else name
+        if name in tables:
+            scanned.add(name)
+    return scanned